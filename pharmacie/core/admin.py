@@ -1,4 +1,5 @@
 from django.contrib import admin
+from .database import write_transaction
 from .models import (
     Produit,
     LotProduit,
@@ -10,8 +11,10 @@ from .models import (
     LigneCommandeService,
     Utilisateur,
     Role,
-    Permission
+    Permission,
+    StockSolde,
 )
+from .stock_ledger import SoldeDelta
 
 
 @admin.register(Produit)
@@ -31,6 +34,46 @@ class LotProduitAdmin(admin.ModelAdmin):
     )
     list_filter = ("date_peremption",)
     search_fields = ("numero_lot", "produit__denomination")
+    # Kept by the reservations and by the writes themselves
+    readonly_fields = ("quantite_reservee", "version")
+
+    # Lots are written here like through the API: with the StockSolde and
+    # expiry bucket deltas of core/stock_ledger.py
+    def save_model(self, request, obj, form, change):
+        with write_transaction():
+            delta = SoldeDelta()
+            if change:
+                current = LotProduit.objects.select_for_update().get(pk=obj.pk)
+                delta.remove(current)
+                obj.quantite_reservee = current.quantite_reservee
+                obj.version = current.version
+            super().save_model(request, obj, form, change)
+            delta.add(obj)
+            delta.apply()
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, LotProduit.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        with write_transaction():
+            delta = SoldeDelta()
+            for lot in queryset.select_for_update():
+                delta.remove(lot)
+            super().delete_queryset(request, queryset)
+            delta.apply()
+
+
+@admin.register(StockSolde)
+class StockSoldeAdmin(admin.ModelAdmin):
+    list_display = (
+        "produit",
+        "magasin",
+        "quantite_totale",
+        "quantite_reservee",
+        "nombre_lots"
+    )
+    list_filter = ("magasin",)
+    search_fields = ("produit__denomination",)
 
 
 @admin.register(Magasin)
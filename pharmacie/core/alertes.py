@@ -0,0 +1,49 @@
+"""Stock alert tiers computed in a single query.
+
+The available stock of each active product (StockSolde quantite_totale -
+quantite_reservee, in one magasin or in all of them) is compared with its
+thresholds in the database:
+
+- RUPTURE: no available stock
+- SECURITE: at or below stock_securite
+- ALERTE: at or below stock_alerte
+"""
+
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import Produit
+
+RUPTURE = "RUPTURE"
+SECURITE = "SECURITE"
+ALERTE = "ALERTE"
+NIVEAUX = (RUPTURE, SECURITE, ALERTE)
+
+
+def alertes(magasin=None, niveaux=NIVEAUX):
+    """Active products in one of ``niveaux`` for ``magasin`` (all magasins if
+    None), annotated with stock_disponible and gravite (the index of the tier
+    in NIVEAUX), most severe first."""
+    solde_filter = Q(soldes__magasin=magasin) if magasin is not None else None
+    stock = Coalesce(
+        Sum("soldes__quantite_totale", filter=solde_filter), 0
+    ) - Coalesce(Sum("soldes__quantite_reservee", filter=solde_filter), 0)
+
+    gravite = Case(
+        When(stock_disponible__lte=0, then=Value(0)),
+        When(stock_disponible__lte=F("stock_securite"), then=Value(1)),
+        When(stock_disponible__lte=F("stock_alerte"), then=Value(2)),
+        default=None,
+        output_field=IntegerField(),
+    )
+    return (
+        Produit.objects.filter(actif=True)
+        .annotate(stock_disponible=stock)
+        .annotate(gravite=gravite)
+        .filter(gravite__in=[NIVEAUX.index(niveau) for niveau in niveaux])
+        .order_by("gravite", "denomination", "id")
+    )
+
+
+def niveau_label(gravite):
+    return NIVEAUX[gravite]
@@ -0,0 +1,279 @@
+"""Batched FEFO allocation used to deliver service orders.
+
+All candidate lots for an order are locked and loaded in a single query,
+the allocation is planned in memory (first expired, first out), and the
+results are written back with bulk_update / bulk_create so the number of
+queries does not depend on the number of order lines. Lot quantities are
+written as guarded deltas (see stock_mutations.py).
+
+Units reserved for other orders (LotProduit.quantite_reservee) are never
+allocated; the reservations of the delivered lines are consumed first and
+released (see reservations.py). Reserved units a partial delivery could not
+take (a lot blocked meanwhile) stay reserved for the rest of their line.
+"""
+
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import LigneCommandeService, LotProduit, MouvementStock, ReservationLot
+from .stock_ledger import SoldeDelta
+from .stock_mutations import LotMutations, create_lots
+
+
+def lock_lots(lignes, magasin, reservations=()):
+    """Lock and return, in FEFO order, the lots of ``magasin`` with unreserved
+    units for the products of ``lignes``, plus the lots of ``reservations``.
+
+    Candidates are read through the partial FEFO index (magasin, produit,
+    date_peremption), so only the lots of the ordered products are scanned.
+    """
+    candidates = Q(
+        produit_id__in={l.produit_id for l in lignes},
+        magasin=magasin,
+        statut="DISPONIBLE",
+        quantite_actuelle__gt=0,
+    ) & Q(quantite_actuelle__gt=F("quantite_reservee"))
+    reserved_ids = {r.lot_id for r in reservations}
+    if reserved_ids:
+        candidates |= Q(pk__in=reserved_ids)
+    return list(
+        LotProduit.objects.select_for_update()
+        .filter(candidates)
+        .order_by("produit_id", "date_peremption", "id")
+    )
+
+
+def release(reservations, lots, mutations):
+    """Give the units of ``reservations`` back to their lots.
+
+    ``lots`` maps lot ids to locked lots; returns the lots changed.
+    """
+    changed = {}
+    for reservation in reservations:
+        lot = lots.get(reservation.lot_id)
+        if lot is None:
+            continue
+        mutations.add(
+            lot, reservee=-min(reservation.quantite, lot.quantite_reservee)
+        )
+        changed[lot.pk] = lot
+    return list(changed.values())
+
+
+def plan_fefo(lignes, lots, reservations=()):
+    """Plan the allocation of lots to order lines.
+
+    ``lots`` must be ordered by expiry date. Lines sharing a product draw from
+    the same pool, which only holds the unreserved units of each lot
+    (quantite_actuelle - quantite_reservee). The lots of ``reservations``
+    (already released) are drawn first, up to the reserved quantity. Returns
+    a list of (ligne, lot, quantite) tuples; the lots themselves are not
+    modified.
+    """
+    pools = defaultdict(list)
+    entries = {}
+    for lot in lots:
+        entry = entries[lot.pk] = [lot, lot.quantite_actuelle - lot.quantite_reservee]
+        pools[lot.produit_id].append(entry)
+
+    reserved = defaultdict(list)
+    for reservation in reservations:
+        if reservation.lot_id in entries:
+            reserved[reservation.ligne_id].append(
+                (entries[reservation.lot_id], reservation.quantite)
+            )
+
+    allocations = {}
+    for ligne in lignes:
+        remaining = ligne.quantite_demandee - ligne.quantite_livree
+        sources = reserved[ligne.pk] + [
+            (entry, None) for entry in pools[ligne.produit_id]
+        ]
+        for entry, limit in sources:
+            if remaining <= 0:
+                break
+            lot, available = entry
+            deduct = min(available, remaining)
+            if limit is not None:
+                deduct = min(deduct, limit)
+            if deduct <= 0:
+                continue
+            entry[1] -= deduct
+            remaining -= deduct
+            key = (ligne.pk, lot.pk)
+            if key in allocations:
+                allocations[key][2] += deduct
+            else:
+                allocations[key] = [ligne, lot, deduct]
+    return [tuple(allocation) for allocation in allocations.values()]
+
+
+def deliver_lignes(lignes, source_magasin, destination_magasin, numeros):
+    """Transfer stock for ``lignes`` from ``source_magasin`` to ``destination_magasin``.
+
+    ``numeros(n)`` must return ``n`` movement numbers. Must be called inside a
+    transaction. Returns the created movements.
+    """
+    lignes = [l for l in lignes if l.quantite_livree < l.quantite_demandee]
+    if not lignes:
+        return []
+
+    now = timezone.now()
+    delta = SoldeDelta()
+    mutations = LotMutations()
+
+    reservations = list(
+        ReservationLot.objects.filter(ligne__in=lignes).order_by("ligne_id", "id")
+    )
+    lots = lock_lots(lignes, source_magasin, reservations)
+    lots_by_id = {lot.pk: lot for lot in lots}
+    source_lots = {}
+    for reservation in reservations:
+        lot = lots_by_id.get(reservation.lot_id)
+        if lot is not None and lot.pk not in source_lots:
+            delta.remove(lot)
+            source_lots[lot.pk] = lot
+    # The reservations of the delivered lines are consumed by this delivery
+    release(reservations, lots_by_id, mutations)
+    if reservations:
+        ReservationLot.objects.filter(pk__in=[r.pk for r in reservations]).delete()
+
+    allocations = plan_fefo(
+        lignes,
+        [
+            lot
+            for lot in lots
+            if lot.magasin_id == source_magasin.pk and lot.statut == "DISPONIBLE"
+        ],
+        reservations,
+    )
+
+    # Lots already present in the destination magasin for the allocated batches
+    wanted = {(lot.produit_id, lot.numero_lot) for _, lot, _ in allocations}
+    destination_lots = {
+        (lot.produit_id, lot.numero_lot): lot
+        for lot in LotProduit.objects.select_for_update().filter(
+            magasin=destination_magasin,
+            produit_id__in={produit_id for produit_id, _ in wanted},
+            numero_lot__in={numero_lot for _, numero_lot in wanted},
+        )
+        if (lot.produit_id, lot.numero_lot) in wanted
+    }
+    for lot in destination_lots.values():
+        delta.remove(lot)
+
+    new_lots = {}
+    touched_lignes = {}
+    mouvements = []
+    for ligne, lot, quantite in allocations:
+        if lot.pk not in source_lots:
+            delta.remove(lot)
+            source_lots[lot.pk] = lot
+        mutations.add(lot, quantite=-quantite)
+
+        key = (lot.produit_id, lot.numero_lot)
+        target = destination_lots.get(key) or new_lots.get(key)
+        if target is None:
+            target = new_lots[key] = LotProduit(
+                produit_id=lot.produit_id,
+                numero_lot=lot.numero_lot,
+                magasin=destination_magasin,
+                quantite_initiale=0,
+                quantite_actuelle=0,
+                date_fabrication=lot.date_fabrication,
+                date_peremption=lot.date_peremption,
+                date_reception=lot.date_reception,
+                statut="DISPONIBLE",
+            )
+        if target.pk is None:
+            target.quantite_actuelle += quantite
+        else:
+            mutations.add(target, quantite=quantite)
+
+        ligne.quantite_livree += quantite
+        if ligne.quantite_livree >= ligne.quantite_demandee:
+            ligne.statut = "LIVREE"
+        ligne.date_modification = now
+        touched_lignes[ligne.pk] = ligne
+
+        mouvements.append(
+            MouvementStock(
+                produit_id=lot.produit_id,
+                lot=lot,
+                type_mouvement="TRANSFERT",
+                quantite=quantite,
+                magasin_source=source_magasin,
+                magasin_destination=destination_magasin,
+            )
+        )
+
+    # What the delivery did not take from a reservation stays reserved, up
+    # to what is left to deliver on its line
+    drawn = defaultdict(int)
+    for ligne, lot, quantite in allocations:
+        drawn[(ligne.pk, lot.pk)] += quantite
+    reste = {l.pk: l.quantite_demandee - l.quantite_livree for l in lignes}
+    kept = []
+    for reservation in reservations:
+        lot = lots_by_id.get(reservation.lot_id)
+        if lot is None:
+            continue
+        key = (reservation.ligne_id, lot.pk)
+        consumed = min(reservation.quantite, drawn[key])
+        drawn[key] -= consumed
+        quantite = min(
+            reservation.quantite - consumed,
+            reste[reservation.ligne_id],
+            lot.quantite_actuelle - lot.quantite_reservee,
+        )
+        if quantite > 0:
+            mutations.add(lot, reservee=quantite)
+            reste[reservation.ligne_id] -= quantite
+            kept.append(
+                ReservationLot(
+                    ligne_id=reservation.ligne_id, lot=lot, quantite=quantite
+                )
+            )
+    ReservationLot.objects.bulk_create(kept)
+
+    mutations.apply(now)
+    create_lots(list(new_lots.values()))
+    if mouvements:
+        for mouvement, numero in zip(mouvements, numeros(len(mouvements))):
+            mouvement.numero_mouvement = numero
+        MouvementStock.objects.bulk_create(mouvements)
+    LigneCommandeService.objects.bulk_update(
+        touched_lignes.values(), ["quantite_livree", "statut", "date_modification"]
+    )
+
+    for lot in source_lots.values():
+        delta.add(lot)
+    for lot in destination_lots.values():
+        delta.add(lot)
+    for lot in new_lots.values():
+        delta.add(lot)
+    delta.apply()
+
+    return mouvements
+
+
+@transaction.atomic
+def deliver_commande(commande, lignes, source_magasin, numeros):
+    """Deliver what remains of ``lignes`` from ``source_magasin`` to the
+    magasin of the order's service.
+
+    Updates the order status and returns the created movements.
+    """
+    mouvements = deliver_lignes(
+        lignes, source_magasin, commande.service.magasin, numeros
+    )
+
+    if all(l.quantite_livree >= l.quantite_demandee for l in lignes):
+        commande.statut = "LIVREE"
+    else:
+        commande.statut = "EN_COURS"
+    commande.save()
+    return mouvements
@@ -1,11 +1,16 @@
+import functools
+
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.request import Request
+from django.db import transaction
 from django.db.models import QuerySet, Sum
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from datetime import datetime
 from rest_framework import status as rf_status
 from .models import (
@@ -21,6 +26,7 @@ from .models import (
     Role,
     Permission,
     Journal,
+    StockSolde,
 )
 
 from django.db.models import Count, Q
@@ -37,6 +43,37 @@ from .serializers import (
     RoleSerializer,
     PermissionSerializer,
 )
+from .alertes import NIVEAUX, alertes, niveau_label
+from .allocation import deliver_commande
+from .catalogue_import import READERS, import_file
+from .cache import invalidate_instances
+from .database import write_transaction
+from .exports import (
+    CONTENT_TYPES,
+    JOURNAL_COLUMNS,
+    LOT_COLUMNS,
+    MOUVEMENT_COLUMNS,
+    STOCK_COLUMNS,
+    export_response,
+)
+from .journal_sink import journal_sink
+from .kpi_snapshots import compute_orders_overview, get_orders_overview, get_snapshot
+from .pagination import (
+    get_page_size,
+    keyset_ordering,
+    keyset_response,
+    paginate_keyset,
+    wants_keyset,
+)
+from .peremption import HORIZONS, MAX_HORIZON, calendrier
+from .permission_matrix import get_matrix, role_has_permission
+from .product_search import search_filter, search_produits
+from .reception import receive_lignes
+from .reservations import release_commande, sync_reservations
+from .sequences import next_numero_commande, next_numeros_mouvement
+from .stock_ledger import SoldeDelta
+from .stock_mutations import StockConflict, retry_on_conflict
+from .valuation import valuation
 
 
 class LoggingMixin:
@@ -52,6 +89,7 @@ class LoggingMixin:
 
     def perform_create(self, serializer):
         instance = serializer.save()
+        invalidate_instances([instance])
         log_journal(
             request=self.request,
             categorie=self.get_categorie(),
@@ -64,6 +102,7 @@ class LoggingMixin:
 
     def perform_update(self, serializer):
         instance = serializer.save()
+        invalidate_instances([instance])
         log_journal(
             request=self.request,
             categorie=self.get_categorie(),
@@ -78,6 +117,7 @@ class LoggingMixin:
         entity_id = instance.id
         entity_desc = str(instance)
         super().perform_destroy(instance)
+        invalidate_instances([instance])
         log_journal(
             request=self.request,
             categorie=self.get_categorie(),
@@ -102,21 +142,23 @@ def log_journal(
     details=None,
 ):
     """Helper function to create journal entries"""
-    utilisateur = None
+    utilisateur_id = None
     if request and hasattr(request, "user") and request.user.is_authenticated:
-        utilisateur = request.user
-
-    Journal.objects.create(
-        categorie=categorie,
-        action=action,
-        description=description,
-        utilisateur=utilisateur,
-        entity_type=entity_type,
-        entity_id=entity_id,
-        entity_description=entity_description,
-        ancien_statut=ancien_statut,
-        nouveau_statut=nouveau_statut,
-        details=details or {},
+        utilisateur_id = request.user.id
+
+    journal_sink.write(
+        {
+            "categorie": categorie,
+            "action": action,
+            "description": description,
+            "utilisateur_id": utilisateur_id,
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "entity_description": entity_description,
+            "ancien_statut": ancien_statut,
+            "nouveau_statut": nouveau_statut,
+            "details": details or {},
+        }
     )
 
 
@@ -149,21 +191,14 @@ def build_permissions(utilisateur):
         return permissions
 
     # Build from role
-    if utilisateur.role:
-        perms = utilisateur.role.permissions.all()
+    if utilisateur.role_id:
+        matrix = get_matrix(utilisateur.role_id)
         for resource in RESOURCES:
-            permissions[f"can_view_{resource}"] = perms.filter(
-                resource=resource, can_view=True
-            ).exists()
-            permissions[f"can_add_{resource}"] = perms.filter(
-                resource=resource, can_add=True
-            ).exists()
-            permissions[f"can_change_{resource}"] = perms.filter(
-                resource=resource, can_change=True
-            ).exists()
-            permissions[f"can_delete_{resource}"] = perms.filter(
-                resource=resource, can_delete=True
-            ).exists()
+            actions = matrix.get(resource, ())
+            permissions[f"can_view_{resource}"] = "view" in actions
+            permissions[f"can_add_{resource}"] = "add" in actions
+            permissions[f"can_change_{resource}"] = "change" in actions
+            permissions[f"can_delete_{resource}"] = "delete" in actions
     else:
         # No role - no permissions by default
         for resource in RESOURCES:
@@ -175,6 +210,22 @@ def build_permissions(utilisateur):
     return permissions
 
 
+def snapshot_response(request, snapshot, response_class=Response):
+    """Response for a cached dashboard snapshot, or 304 if the client has it"""
+    response = get_conditional_response(
+        request,
+        etag=quote_etag(snapshot["etag"]),
+        last_modified=snapshot["last_modified"].timestamp(),
+    )
+    if response is None:
+        response = response_class(snapshot["data"])
+    response["ETag"] = quote_etag(snapshot["etag"])
+    response["Last-Modified"] = http_date(snapshot["last_modified"].timestamp())
+    # Clients may keep the payload but must revalidate it on every poll
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def current_user(request):
@@ -203,7 +254,20 @@ class Pagination(PageNumberPagination):
     page_size_query_param = "page_size"
     max_page_size = 100
 
+    def paginate_queryset(self, queryset, request, view=None):
+        # ?cursor= switches to keyset pagination on the queryset's ordering
+        self.keyset = None
+        if not wants_keyset(request):
+            return super().paginate_queryset(queryset, request, view)
+        self.request = request
+        self.keyset = paginate_keyset(
+            queryset, request, keyset_ordering(queryset), self.get_page_size(request)
+        )
+        return self.keyset.items
+
     def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return keyset_response(self.request, self.keyset, data)
         response = super().get_paginated_response(data)
         response["X-Total-Count"] = self.page.paginator.count
         return response
@@ -213,7 +277,25 @@ def check_permission(user, resource, action):
     """Helper to check user permission"""
     if user.is_superuser:
         return True
-    return user.has_permission(resource, action)
+    return role_has_permission(getattr(user, "role_id", None), resource, action)
+
+
+def stock_write(view):
+    """Run ``view`` again when a concurrent stock write made it fail,
+    answering 409 if the conflict persists"""
+    retrying = retry_on_conflict(view)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return retrying(*args, **kwargs)
+        except StockConflict:
+            return Response(
+                {"error": "Stock modifié simultanément, veuillez réessayer"},
+                status=409,
+            )
+
+    return wrapper
 
 
 def apply_filtering(queryset, request, search_fields):
@@ -248,27 +330,21 @@ class ProduitViewSet(LoggingMixin, viewsets.ModelViewSet):
             return Produit.objects.none()
 
         queryset = super().get_queryset()
-        queryset = apply_filtering(
-            queryset,
-            self.request,
-            [
-                "code_national",
-                "code_interne",
-                "denomination",
-                "dci",
-                "denomination_commerciale",
-            ],
-        )
+        search = self.request.query_params.get("search")
+        if search:
+            queryset = search_produits(queryset, search)
         ordering = self.request.query_params.get("ordering")
         if ordering:
             queryset = queryset.order_by(ordering)
+        elif search:
+            queryset = queryset.order_by("-search_rank", "id")
         else:
             queryset = queryset.order_by("id")
         return queryset
 
 
 class LotViewSet(LoggingMixin, viewsets.ModelViewSet):
-    queryset = LotProduit.objects.select_related("produit").all()
+    queryset = LotProduit.objects.select_related("produit", "magasin").all()
     serializer_class = LotSerializer
     pagination_class = Pagination
     permission_classes = [IsAuthenticated]
@@ -279,6 +355,45 @@ class LotViewSet(LoggingMixin, viewsets.ModelViewSet):
     def get_entity_name(self):
         return "Lot"
 
+    @transaction.atomic
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        delta = SoldeDelta()
+        delta.add(serializer.instance)
+        delta.apply()
+
+    def update(self, request, *args, **kwargs):
+        # Not retried: the client's values were based on the lot it read
+        try:
+            return super().update(request, *args, **kwargs)
+        except StockConflict:
+            return Response(
+                {"error": "Lot modifié depuis sa lecture, veuillez le recharger"},
+                status=409,
+            )
+
+    def perform_update(self, serializer):
+        # Quantities are written as absolute values: only over the version
+        # the client read (its "version", else the one read by get_object)
+        lot = serializer.instance
+        version = self.request.data.get("version", lot.version)
+        with write_transaction():
+            current = LotProduit.objects.select_for_update().get(pk=lot.pk)
+            if str(current.version) != str(version):
+                raise StockConflict("Lot modifié simultanément")
+            delta = SoldeDelta()
+            delta.remove(current)
+            super().perform_update(serializer)
+            delta.add(serializer.instance)
+            delta.apply()
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        delta = SoldeDelta()
+        delta.remove(instance)
+        super().perform_destroy(instance)
+        delta.apply()
+
     def get_queryset(self):
         user = self.request.user
         if not check_permission(user, "lots", "view"):
@@ -307,9 +422,7 @@ class LotViewSet(LoggingMixin, viewsets.ModelViewSet):
 
             queryset = queryset.filter(
                 Q(numero_lot__icontains=search)
-                | Q(produit__denomination__icontains=search)
-                | Q(produit__code_national__icontains=search)
-                | Q(produit__dci__icontains=search)
+                | search_filter(search, prefix="produit__")
             )
 
         ordering = self.request.query_params.get("ordering")
@@ -449,11 +562,9 @@ class CommandeViewSet(LoggingMixin, viewsets.ModelViewSet):
             queryset = queryset.filter(service_id=service_filter)
         else:
             # Check if user has change permission (can manage orders)
-            has_change_perm = False
-            if hasattr(user, "role") and user.role:
-                has_change_perm = user.role.permissions.filter(
-                    resource="commandes", can_change=True
-                ).exists()
+            has_change_perm = role_has_permission(
+                getattr(user, "role_id", None), "commandes", "change"
+            )
 
             # If no change permission and has service, filter by service
             if not has_change_perm and hasattr(user, "service") and user.service:
@@ -475,6 +586,32 @@ class CommandeViewSet(LoggingMixin, viewsets.ModelViewSet):
             queryset = queryset.order_by("-date_demande")
         return queryset
 
+    def update(self, request, *args, **kwargs):
+        self.manquants = {}
+        response = stock_write(super().update)(request, *args, **kwargs)
+        if self.manquants and response.status_code == 200:
+            # Validated with less stock than ordered: the lines short of it
+            response.data["reservations_manquantes"] = [
+                {"ligne_id": ligne_id, "quantite": quantite}
+                for ligne_id, quantite in sorted(self.manquants.items())
+            ]
+        return response
+
+    def destroy(self, request, *args, **kwargs):
+        return stock_write(super().destroy)(request, *args, **kwargs)
+
+    def perform_update(self, serializer):
+        # Reserve stock on validation, release it on cancellation
+        ancien_statut = serializer.instance.statut
+        with write_transaction():
+            super().perform_update(serializer)
+            self.manquants = sync_reservations(serializer.instance, ancien_statut)
+
+    def perform_destroy(self, instance):
+        with write_transaction():
+            release_commande(instance)
+            super().perform_destroy(instance)
+
     def partial_update(self, request, *args, **kwargs):
         instance = self.get_object()
         old_statut = instance.statut
@@ -630,43 +767,41 @@ class UtilisateurViewSet(LoggingMixin, viewsets.ModelViewSet):
             )
 
 
-@api_view(["GET"])
-@permission_classes([IsAuthenticated])
-def produits_with_stock(request):
-    """Get products with aggregated stock information for ordering.
-    Shows stock from Pharmacie Centrale (PRINCIPAL) for ordering purposes.
-    """
-    from django.db import models
+def produit_stock_item(p):
+    return {
+        "id": p.id,
+        "code_national": p.code_national,
+        "code_interne": p.code_interne,
+        "denomination": p.denomination,
+        "dci": p.dci,
+        "forme_pharmaceutique": p.forme_pharmaceutique,
+        "dosage": p.dosage,
+        "stock_total": p.stock_total or 0,
+    }
+
+
+def produits_with_stock_queryset(request, principal_magasin):
+    """Active products with their available stock in ``principal_magasin``"""
     from django.db.models import Sum, Q, F
     from django.db.models.functions import Coalesce
 
-    # Get Pharmacie Centrale for ordering stock
-    principal_magasin = Magasin.objects.filter(
-        code_magasin="PRINCIPAL", actif=True
-    ).first()
-
-    if not principal_magasin:
-        return Response({"count": 0, "results": []})
+    queryset = Produit.objects.filter(actif=True)
+    search = request.query_params.get("search")
+    if search:
+        queryset = search_produits(queryset, search)
 
     # Get products with stock from Pharmacie Centrale only
     queryset = (
-        Produit.objects.filter(actif=True)
-        .annotate(
+        queryset.annotate(
             lot_stock=Sum(
-                "lotproduit__quantite_actuelle",
-                filter=Q(
-                    lotproduit__magasin=principal_magasin,
-                    lotproduit__statut="DISPONIBLE",
-                ),
+                "soldes__quantite_totale",
+                filter=Q(soldes__magasin=principal_magasin),
             )
         )
         .annotate(
             lot_reserved=Sum(
-                "lotproduit__quantite_reservee",
-                filter=Q(
-                    lotproduit__magasin=principal_magasin,
-                    lotproduit__statut="DISPONIBLE",
-                ),
+                "soldes__quantite_reservee",
+                filter=Q(soldes__magasin=principal_magasin),
             )
         )
         .annotate(
@@ -674,38 +809,46 @@ def produits_with_stock(request):
         )
         .order_by("denomination")
     )
-
-    search = request.query_params.get("search")
     if search:
-        queryset = queryset.filter(
-            Q(code_national__icontains=search)
-            | Q(code_interne__icontains=search)
-            | Q(denomination__icontains=search)
-            | Q(dci__icontains=search)
-        )
+        queryset = queryset.order_by("-search_rank", "denomination")
+    return queryset
 
-    page = int(request.query_params.get("page", 1))
-    page_size = int(request.query_params.get("page_size", 25))
-    start = (page - 1) * page_size
-    end = start + page_size
 
-    total = queryset.count()
-    produits = queryset[start:end]
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def produits_with_stock(request):
+    """Get products with aggregated stock information for ordering.
+    Shows stock from Pharmacie Centrale (PRINCIPAL) for ordering purposes.
+    """
+    # Get Pharmacie Centrale for ordering stock
+    principal_magasin = Magasin.objects.filter(
+        code_magasin="PRINCIPAL", actif=True
+    ).first()
 
-    data = [
-        {
-            "id": p.id,
-            "code_national": p.code_national,
-            "code_interne": p.code_interne,
-            "denomination": p.denomination,
-            "dci": p.dci,
-            "forme_pharmaceutique": p.forme_pharmaceutique,
-            "dosage": p.dosage,
-            "stock_total": p.stock_total or 0,
-        }
-        for p in produits
-    ]
+    if not principal_magasin:
+        return Response({"count": 0, "results": []})
+
+    queryset = produits_with_stock_queryset(request, principal_magasin)
 
+    keyset = None
+    if wants_keyset(request):
+        keyset = paginate_keyset(
+            queryset, request, ["denomination", "id"], get_page_size(request, 25)
+        )
+        produits = keyset.items
+    else:
+        page = int(request.query_params.get("page", 1))
+        page_size = int(request.query_params.get("page_size", 25))
+        start = (page - 1) * page_size
+        end = start + page_size
+
+        total = queryset.count()
+        produits = queryset[start:end]
+
+    data = [produit_stock_item(p) for p in produits]
+
+    if keyset is not None:
+        return keyset_response(request, keyset, data)
     return Response(
         {
             "count": total,
@@ -732,70 +875,59 @@ def quick_order(request):
     except Service.DoesNotExist:
         return Response({"error": "Service not found"}, status=404)
 
-    today = timezone.now().strftime("%Y%m%d")
-    last_order = (
-        CommandeService.objects.filter(numero_commande__startswith=f"CMD-{today}")
-        .order_by("-numero_commande")
-        .first()
-    )
-
-    if last_order:
-        last_num = int(last_order.numero_commande.split("-")[-1])
-        new_num = last_num + 1
-    else:
-        new_num = 1
-
-    numero_commande = f"CMD-{today}-{new_num:04d}"
-
-    commande = CommandeService.objects.create(
-        numero_commande=numero_commande,
-        service=service,
-        statut="EN_ATTENTE",
-        priorite="NORMALE",
-    )
-
-    order_lines = []
-    for ligne in lignes:
-        produit_id = ligne.get("produit_id")
-        quantite = ligne.get("quantite_demandee")
-
-        if not produit_id or not quantite:
-            continue
+    with transaction.atomic():
+        numero_commande = next_numero_commande()
 
-        try:
-            produit = Produit.objects.get(id=produit_id)
-        except Produit.DoesNotExist:
-            continue
-
-        ligne_commande = LigneCommandeService.objects.create(
-            commande=commande,
-            produit=produit,
-            quantite_demandee=quantite,
-            quantite_livree=0,
+        commande = CommandeService.objects.create(
+            numero_commande=numero_commande,
+            service=service,
             statut="EN_ATTENTE",
+            priorite="NORMALE",
+        )
+
+        lignes = [
+            (ligne.get("produit_id"), ligne.get("quantite_demandee"))
+            for ligne in lignes
+        ]
+        lignes = [(int(p), q) for p, q in lignes if p and q]
+        # Unknown products are skipped
+        produits = Produit.objects.in_bulk({produit_id for produit_id, _ in lignes})
+        lignes_commande = LigneCommandeService.objects.bulk_create(
+            [
+                LigneCommandeService(
+                    commande=commande,
+                    produit=produits[produit_id],
+                    quantite_demandee=quantite,
+                    quantite_livree=0,
+                    statut="EN_ATTENTE",
+                )
+                for produit_id, quantite in lignes
+                if produit_id in produits
+            ]
         )
-        order_lines.append(
+        order_lines = [
             {
                 "id": ligne_commande.id,
-                "produit_id": produit.id,
-                "produit_denomination": produit.denomination,
-                "quantite_demandee": quantite,
+                "produit_id": ligne_commande.produit.id,
+                "produit_denomination": ligne_commande.produit.denomination,
+                "quantite_demandee": ligne_commande.quantite_demandee,
                 "quantite_livree": 0,
                 "statut": "EN_ATTENTE",
             }
-        )
+            for ligne_commande in lignes_commande
+        ]
 
-    log_journal(
-        request=request,
-        categorie="COMMANDE",
-        action="CREATE",
-        description=f"Nouvelle commande créée: {numero_commande} pour le service {service.nom}",
-        entity_type="CommandeService",
-        entity_id=commande.id,
-        entity_description=numero_commande,
-        nouveau_statut="EN_ATTENTE",
-        details={"service": service.nom, "nombre_lignes": len(order_lines)},
-    )
+        log_journal(
+            request=request,
+            categorie="COMMANDE",
+            action="CREATE",
+            description=f"Nouvelle commande créée: {numero_commande} pour le service {service.nom}",
+            entity_type="CommandeService",
+            entity_id=commande.id,
+            entity_description=numero_commande,
+            nouveau_statut="EN_ATTENTE",
+            details={"service": service.nom, "nombre_lignes": len(order_lines)},
+        )
 
     return Response(
         {
@@ -813,6 +945,7 @@ def quick_order(request):
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@stock_write
 def deliver_order(request):
     """Deliver an order and deduct stock, transfer to service's assigned magasin"""
     commande_id = request.data.get("commande_id")
@@ -820,150 +953,57 @@ def deliver_order(request):
     if not commande_id:
         return Response({"error": "commande_id is required"}, status=400)
 
-    try:
-        commande = CommandeService.objects.get(id=commande_id)
-    except CommandeService.DoesNotExist:
-        return Response({"error": "Commande not found"}, status=404)
-
-    if commande.statut != "EN_COURS":
-        return Response(
-            {"error": "La commande doit être en cours pour être livrée"}, status=400
-        )
-
-    # Check if all lines are already fully delivered
-    all_already_delivered = all(
-        ligne.quantite_livree >= ligne.quantite_demandee
-        for ligne in commande.lignes.all()
-    )
-    if all_already_delivered:
-        return Response(
-            {"error": "La commande est déjà complètement livrée"}, status=400
-        )
-
-    # Get service's assigned magasin
-    service_magasin = None
-    if hasattr(commande.service, "magasin") and commande.service.magasin:
-        service_magasin = commande.service.magasin
-
-    if not service_magasin:
-        return Response({"error": "Aucun magasin assigné au service"}, status=400)
-
-    today = timezone.now().strftime("%Y%m%d")
-    last_mouvement = (
-        MouvementStock.objects.filter(numero_mouvement__startswith=f"MVT-{today}")
-        .order_by("-numero_mouvement")
-        .first()
-    )
-
-    if last_mouvement:
-        last_num = int(last_mouvement.numero_mouvement.split("-")[-1])
-    else:
-        last_num = 0
-
-    for ligne in commande.lignes.all():
-        quantite_a_livrer = ligne.quantite_demandee - ligne.quantite_livree
-        if quantite_a_livrer <= 0:
-            continue
-
-        # Get lots from Pharmacie Centrale (PRINCIPAL code) only
-        main_magasin = Magasin.objects.filter(
-            code_magasin="PRINCIPAL", actif=True
-        ).first()
-        if not main_magasin:
-            return Response({"error": "Aucun magasin principal configuré"}, status=400)
+    # Get lots from Pharmacie Centrale (PRINCIPAL code) only
+    main_magasin = Magasin.objects.filter(code_magasin="PRINCIPAL", actif=True).first()
 
-        lots = LotProduit.objects.filter(
-            produit=ligne.produit,
-            quantite_actuelle__gt=0,
-            statut="DISPONIBLE",
-            magasin=main_magasin,
-        ).order_by("date_peremption")
-
-        remaining = quantite_a_livrer
-        for lot in lots:
-            if remaining <= 0:
-                break
-
-            available = lot.quantite_actuelle
-            deduct = min(available, remaining)
-
-            # Deduct from source
-            lot.quantite_actuelle -= deduct
-            if lot.quantite_actuelle <= 0:
-                lot.quantite_actuelle = 0
-                lot.statut = "EPuISE"
-            lot.save()
-
-            last_num += 1
-            numero_mouvement = f"MVT-{today}-{last_num:05d}"
-
-            # Create or get lot in service's magasin
-            service_lot, created = LotProduit.objects.get_or_create(
-                produit=ligne.produit,
-                numero_lot=lot.numero_lot,
-                magasin=service_magasin,
-                defaults={
-                    "quantite_initiale": 0,
-                    "quantite_actuelle": 0,
-                    "date_fabrication": lot.date_fabrication,
-                    "date_peremption": lot.date_peremption,
-                    "date_reception": lot.date_reception,
-                    "statut": "DISPONIBLE",
-                },
+    # Takes the SQLite write lock up front: concurrent deliveries queue
+    with write_transaction():
+        try:
+            commande = (
+                CommandeService.objects.select_for_update(of=("self",))
+                .select_related("service__magasin")
+                .get(id=commande_id)
             )
+        except CommandeService.DoesNotExist:
+            return Response({"error": "Commande not found"}, status=404)
 
-            # Add to service's lot
-            service_lot.quantite_actuelle += deduct
-            service_lot.save()
-
-            MouvementStock.objects.create(
-                numero_mouvement=numero_mouvement,
-                produit=ligne.produit,
-                lot=lot,
-                type_mouvement="TRANSFERT",
-                quantite=deduct,
-                magasin_source=lot.magasin,
-                magasin_destination=service_magasin,
-                date_mouvement=timezone.now(),
+        if commande.statut != "EN_COURS":
+            return Response(
+                {"error": "La commande doit être en cours pour être livrée"},
+                status=400,
             )
 
-            remaining -= deduct
-            ligne.quantite_livree += deduct
-
-        if remaining > 0:
-            ligne.quantite_livree += quantite_a_livrer - remaining
-        else:
-            ligne.quantite_livree = ligne.quantite_demandee
+        # Check if all lines are already fully delivered
+        lignes = list(commande.lignes.all())
+        all_already_delivered = all(
+            ligne.quantite_livree >= ligne.quantite_demandee for ligne in lignes
+        )
+        if all_already_delivered:
+            return Response(
+                {"error": "La commande est déjà complètement livrée"}, status=400
+            )
 
-        if ligne.quantite_livree >= ligne.quantite_demandee:
-            ligne.statut = "LIVREE"
+        # Get service's assigned magasin
+        if not commande.service.magasin:
+            return Response({"error": "Aucun magasin assigné au service"}, status=400)
 
-        ligne.save()
+        if not main_magasin:
+            return Response({"error": "Aucun magasin principal configuré"}, status=400)
 
-    all_delivered = all(
-        ligne.quantite_livree >= ligne.quantite_demandee
-        for ligne in commande.lignes.all()
-    )
+        ancien_statut = commande.statut
+        deliver_commande(commande, lignes, main_magasin, next_numeros_mouvement)
 
-    if all_delivered:
-        commande.statut = "LIVREE"
-    else:
-        commande.statut = "EN_COURS"
-
-    ancien_statut = "EN_COURS"
-    commande.save()
-
-    log_journal(
-        request=request,
-        categorie="COMMANDE",
-        action="LIVRE",
-        description=f"Commande livrée: {commande.numero_commande}",
-        entity_type="CommandeService",
-        entity_id=commande.id,
-        entity_description=commande.numero_commande,
-        ancien_statut=ancien_statut,
-        nouveau_statut=commande.statut,
-    )
+        log_journal(
+            request=request,
+            categorie="COMMANDE",
+            action="LIVRE",
+            description=f"Commande livrée: {commande.numero_commande}",
+            entity_type="CommandeService",
+            entity_id=commande.id,
+            entity_description=commande.numero_commande,
+            ancien_statut=ancien_statut,
+            nouveau_statut=commande.statut,
+        )
 
     return Response(
         {
@@ -979,6 +1019,7 @@ def deliver_order(request):
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@stock_write
 def stock_reception(request):
     """Receive stock with lots/batches and optional document, assigned to main pharmacy"""
     fournisseur_id = request.data.get("fournisseur_id")
@@ -991,6 +1032,9 @@ def stock_reception(request):
     if not lignes:
         return Response({"error": "At least one product is required"}, status=400)
 
+    if not isinstance(lignes, list):
+        return Response({"error": "lignes must be a list"}, status=400)
+
     try:
         fournisseur = Fournisseur.objects.get(id=fournisseur_id)
     except Fournisseur.DoesNotExist:
@@ -1005,91 +1049,41 @@ def stock_reception(request):
     if not main_magasin:
         return Response({"error": "Aucun magasin principal configuré"}, status=400)
 
-    lots_created = []
-
-    for ligne in lignes:
-        produit_id = ligne.get("produit_id")
-        numero_lot = ligne.get("numero_lot")
-        quantite = ligne.get("quantite")
-        date_fabrication = ligne.get("date_fabrication")
-        date_peremption = ligne.get("date_peremption")
-        date_reception = ligne.get("date_reception") or timezone.now().date()
-        prix_unitaire = ligne.get("prix_unitaire")
-
-        if not produit_id or not numero_lot or not quantite:
-            continue
+    with write_transaction():
+        accepted, rejected = receive_lignes(lignes, main_magasin)
 
-        try:
-            produit = Produit.objects.get(id=produit_id)
-        except Produit.DoesNotExist:
-            continue
-
-        # Create lot in main pharmacy with the assigned magasin
-        lot, created = LotProduit.objects.get_or_create(
-            produit=produit,
-            numero_lot=numero_lot,
-            magasin=main_magasin,
-            defaults={
-                "quantite_initiale": quantite,
-                "quantite_actuelle": quantite,
-                "quantite_reservee": 0,
-                "date_fabrication": date_fabrication,
-                "date_peremption": date_peremption,
-                "date_reception": date_reception,
-                "prix_unitaire_achat": prix_unitaire,
-                "statut": "DISPONIBLE",
-            },
-        )
-
-        if not created:
-            lot.quantite_actuelle += quantite
-            lot.save()
-
-        today = timezone.now().strftime("%Y%m%d")
-        last_mouvement = (
-            MouvementStock.objects.filter(numero_mouvement__startswith=f"MVT-{today}")
-            .order_by("-numero_mouvement")
-            .first()
-        )
-
-        if last_mouvement:
-            last_num = int(last_mouvement.numero_mouvement.split("-")[-1])
-            new_num = last_num + 1
-        else:
-            new_num = 1
-
-        numero_mouvement = f"MVT-{today}-{new_num:05d}"
-
-        MouvementStock.objects.create(
-            numero_mouvement=numero_mouvement,
-            produit=produit,
-            lot=lot,
-            type_mouvement="ENTREE_ACHAT",
-            quantite=quantite,
-            magasin_destination=main_magasin,
-            date_mouvement=timezone.now(),
-        )
-
-        lots_created.append(
+        lots_created = [
             {
-                "id": lot.id,
-                "produit_id": produit.id,
-                "produit_denomination": produit.denomination,
-                "numero_lot": lot.numero_lot,
-                "quantite": quantite,
-                "date_peremption": lot.date_peremption,
+                "id": ligne.lot.id,
+                "produit_id": ligne.produit_id,
+                "produit_denomination": ligne.produit.denomination,
+                "numero_lot": ligne.lot.numero_lot,
+                "quantite": ligne.quantite,
+                "date_peremption": ligne.lot.date_peremption.isoformat(),
+                "numero_mouvement": ligne.mouvement.numero_mouvement,
             }
+            for ligne in accepted
+        ]
+
+        log_journal(
+            request=request,
+            categorie="STOCK",
+            action="RECEPTION",
+            description=f"Réception de stock du fournisseur {fournisseur.raison_sociale}: {len(lots_created)} lot(s)",
+            entity_type="Fournisseur",
+            entity_id=fournisseur.id,
+            entity_description=fournisseur.raison_sociale,
+            details={
+                "lots": lots_created,
+                "nombre_lots": len(lots_created),
+                "lignes_rejetees": rejected,
+            },
         )
 
-    log_journal(
-        request=request,
-        categorie="STOCK",
-        action="RECEPTION",
-        description=f"Réception de stock du fournisseur {fournisseur.raison_sociale}: {len(lots_created)} lot(s)",
-        entity_type="Fournisseur",
-        entity_id=fournisseur.id,
-        entity_description=fournisseur.raison_sociale,
-        details={"lots": lots_created, "nombre_lots": len(lots_created)},
+    lignes_report = sorted(
+        [{"index": ligne.index, "statut": "ACCEPTEE"} for ligne in accepted]
+        + [{**r, "statut": "REJETEE"} for r in rejected],
+        key=lambda r: r["index"],
     )
 
     return Response(
@@ -1099,18 +1093,31 @@ def stock_reception(request):
             "document": document,
             "lots": lots_created,
             "nombre_lots": len(lots_created),
+            "lignes": lignes_report,
+            "nombre_rejetees": len(rejected),
         }
     )
 
 
+def empty_kpis(total_products):
+    return {
+        "total_stock_value": 0,
+        "products_with_stock": 0,
+        "total_products": total_products,
+        "ruptures_count": 0,
+        "lots_expiring_30": 0,
+        "lots_expiring_90": 0,
+        "low_stock_products": [],
+        "expiring_lots": [],
+    }
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def dashboard_kpis(request):
-    """Get dashboard KPIs, filtered by user's service's magasin if applicable"""
-    from django.db.models import Count, Q, F
-    from django.db.models.functions import Coalesce
-    from django.db import connection
-
+    """Get dashboard KPIs, filtered by user's service's magasin if applicable.
+    Served from a cached snapshot, with ETag / Last-Modified validators.
+    """
     user = request.user
 
     # Filter by user's service's magasin if they have one assigned
@@ -1121,142 +1128,142 @@ def dashboard_kpis(request):
         user_magasin = user.service.magasin
     else:
         # User without service assigned sees nothing - return empty KPIs
-        return Response(
-            {
-                "total_stock_value": 0,
-                "products_with_stock": 0,
-                "total_products": Produit.objects.filter(actif=True).count(),
-                "ruptures_count": 0,
-                "lots_expiring_30": 0,
-                "lots_expiring_90": 0,
-                "low_stock_products": [],
-                "expiring_lots": [],
-            }
-        )
+        return Response(empty_kpis(Produit.objects.filter(actif=True).count()))
 
-    # Base filter for lots in user's magasin
-    lot_filter = Q()
-    if user_magasin:
-        lot_filter = Q(lotproduit__magasin=user_magasin)
+    snapshot = get_snapshot(user_magasin, user.service if user_magasin else None)
+    return snapshot_response(request, snapshot)
 
-    today = timezone.now().date()
-    thirty_days = today + timezone.timedelta(days=30)
-    ninety_days = today + timezone.timedelta(days=90)
 
-    lots_with_price = LotProduit.objects.filter(
-        statut="DISPONIBLE", prix_unitaire_achat__isnull=False
-    )
-    if user_magasin:
-        lots_with_price = lots_with_price.filter(magasin=user_magasin)
-    total_stock_value = sum(
-        float(lot.quantite_actuelle) * float(lot.prix_unitaire_achat or 0)
-        for lot in lots_with_price
-    )
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def dashboard_valuation(request):
+    """Get the stock value, broken down by magasin, type_produit and
+    categorie_surveillance, filtered by user's service's magasin if applicable"""
+    user = request.user
 
-    products_with_stock_query = LotProduit.objects.filter(
-        quantite_actuelle__gt=0, statut="DISPONIBLE"
-    )
-    if user_magasin:
-        products_with_stock_query = products_with_stock_query.filter(
-            magasin=user_magasin
+    user_magasin = None
+    if user.is_superuser:
+        pass  # Admin sees all
+    elif hasattr(user, "service") and user.service and user.service.magasin:
+        user_magasin = user.service.magasin
+    else:
+        # User without service assigned sees nothing
+        return Response(
+            {
+                "valeur_totale": 0,
+                "par_magasin": [],
+                "par_type_produit": [],
+                "par_categorie_surveillance": [],
+                "details": [],
+            }
         )
-    products_with_stock = products_with_stock_query.values("produit").distinct().count()
 
-    total_products = Produit.objects.filter(actif=True).count()
-    ruptures_count = total_products - products_with_stock
+    return Response(valuation(user_magasin))
 
-    lots_expiring_30_query = LotProduit.objects.filter(
-        date_peremption__lte=thirty_days,
-        date_peremption__gte=today,
-        quantite_actuelle__gt=0,
-    )
-    if user_magasin:
-        lots_expiring_30_query = lots_expiring_30_query.filter(magasin=user_magasin)
-    lots_expiring_30 = lots_expiring_30_query.count()
 
-    lots_expiring_90_query = LotProduit.objects.filter(
-        date_peremption__lte=ninety_days,
-        date_peremption__gte=today,
-        quantite_actuelle__gt=0,
-    )
-    if user_magasin:
-        lots_expiring_90_query = lots_expiring_90_query.filter(magasin=user_magasin)
-    lots_expiring_90 = lots_expiring_90_query.count()
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def stock_alertes(request):
+    """Get products in rupture, sécurité or alerte tier, most severe first.
+    Filtered by user's service's magasin; admins may pass ?magasin=<id>
+    (all magasins otherwise). ?niveau= keeps one tier.
+    """
+    user = request.user
 
-    low_stock_products = []
-    low_stock_query = Produit.objects.filter(actif=True)
-    if user_magasin:
-        low_stock_query = low_stock_query.annotate(
-            stock_total=Sum(
-                "lotproduit__quantite_actuelle",
-                filter=Q(lotproduit__magasin=user_magasin),
-            )
-        ).filter(stock_total__lt=F("stock_securite"), stock_securite__gt=0)[:10]
+    magasin = None
+    if user.is_superuser:
+        magasin_id = request.query_params.get("magasin")
+        if magasin_id:
+            try:
+                magasin_id = int(magasin_id)
+            except ValueError:
+                return Response({"error": "magasin invalide"}, status=400)
+            magasin = Magasin.objects.filter(id=magasin_id).first()
+            if magasin is None:
+                return Response({"error": "Magasin introuvable"}, status=404)
+    elif hasattr(user, "service") and user.service and user.service.magasin:
+        magasin = user.service.magasin
     else:
-        low_stock_query = low_stock_query.annotate(
-            stock_total=Sum("lotproduit__quantite_actuelle")
-        ).filter(stock_total__lt=F("stock_securite"), stock_securite__gt=0)[:10]
-
-    for p in low_stock_query:
-        low_stock_products.append(
-            {
-                "id": p.id,
-                "denomination": p.denomination,
-                "stock_total": p.stock_total or 0,
-                "stock_securite": p.stock_securite,
-            }
-        )
+        # User without service assigned sees nothing
+        return Response({"count": 0, "next": None, "previous": None, "results": []})
 
-    expiring_lots = []
-    expiring_query = LotProduit.objects.filter(
-        date_peremption__lte=thirty_days,
-        date_peremption__gte=today,
-        quantite_actuelle__gt=0,
-    ).select_related("produit")
-    if user_magasin:
-        expiring_query = expiring_query.filter(magasin=user_magasin)
-    expiring = expiring_query[:10]
+    niveaux = NIVEAUX
+    niveau = request.query_params.get("niveau")
+    if niveau:
+        if niveau not in NIVEAUX:
+            return Response({"error": f"niveau invalide: {niveau}"}, status=400)
+        niveaux = (niveau,)
 
-    for lot in expiring:
-        expiring_lots.append(
-            {
-                "id": lot.id,
-                "produit_denomination": lot.produit.denomination,
-                "numero_lot": lot.numero_lot,
-                "quantite": lot.quantite_actuelle,
-                "date_peremption": lot.date_peremption,
-                "jours_restants": (lot.date_peremption - today).days,
-            }
-        )
-
-    pending_orders = CommandeService.objects.filter(
-        statut__in=["EN_ATTENTE", "VALIDEE"]
-    )
-    if user_magasin and hasattr(user, "service") and user.service:
-        pending_orders = pending_orders.filter(service=user.service)
-    pending_orders = pending_orders.count()
+    queryset = alertes(magasin, niveaux)
+    search = request.query_params.get("search")
+    if search:
+        queryset = queryset.filter(search_filter(search))
 
-    return Response(
+    paginator = Pagination()
+    produits = paginator.paginate_queryset(queryset, request)
+    data = [
         {
-            "stock_value": float(total_stock_value),
-            "ruptures_count": ruptures_count,
-            "total_products": total_products,
-            "products_with_stock": products_with_stock,
-            "lots_expiring_30_days": lots_expiring_30,
-            "lots_expiring_90_days": lots_expiring_90,
-            "low_stock_products": low_stock_products,
-            "expiring_lots": expiring_lots,
-            "pending_orders": pending_orders,
+            "id": p.id,
+            "code_national": p.code_national,
+            "denomination": p.denomination,
+            "dosage": p.dosage,
+            "forme_pharmaceutique": p.forme_pharmaceutique,
+            "stock_disponible": p.stock_disponible,
+            "stock_securite": p.stock_securite,
+            "stock_alerte": p.stock_alerte,
+            "niveau": niveau_label(p.gravite),
         }
-    )
+        for p in produits
+    ]
+    return paginator.get_paginated_response(data)
 
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
-def stock_list(request):
-    """Get aggregated stock by product, filtered by user's service's magasin using movements"""
-    from django.db import models
-    from django.db.models import Sum, Count, Q, F
+def lots_expiring(request):
+    """Stock expiring per week and within each horizon (?horizons=30,90,180,
+    in days), read from the expiry buckets. Filtered by user's service's
+    magasin; admins may pass ?magasin=<id> (all magasins otherwise)."""
+    user = request.user
+
+    magasin = None
+    if user.is_superuser:
+        magasin_id = request.query_params.get("magasin")
+        if magasin_id:
+            try:
+                magasin_id = int(magasin_id)
+            except ValueError:
+                return Response({"error": "magasin invalide"}, status=400)
+            magasin = Magasin.objects.filter(id=magasin_id).first()
+            if magasin is None:
+                return Response({"error": "Magasin introuvable"}, status=404)
+    elif hasattr(user, "service") and user.service and user.service.magasin:
+        magasin = user.service.magasin
+    else:
+        return Response({"error": "Aucun magasin assigné au service"}, status=403)
+
+    horizons = HORIZONS
+    param = request.query_params.get("horizons") or request.query_params.get("horizon")
+    if param:
+        try:
+            horizons = [int(h) for h in param.split(",") if h.strip()]
+        except ValueError:
+            horizons = []
+        if not horizons or not all(0 <= h <= MAX_HORIZON for h in horizons):
+            return Response(
+                {"error": f"horizons invalides (jours entre 0 et {MAX_HORIZON})"},
+                status=400,
+            )
+
+    data = calendrier(magasin, horizons)
+    data["magasin_id"] = magasin.id if magasin else None
+    return Response(data)
+
+
+def stock_queryset(request):
+    """Aggregated stock by product for the user's service's magasin (all
+    magasins for admins), or None if the user has no service"""
+    from django.db.models import Sum, Q, F
     from django.db.models.functions import Coalesce
 
     user = request.user
@@ -1268,8 +1275,7 @@ def stock_list(request):
     elif hasattr(user, "service") and user.service and hasattr(user.service, "magasin"):
         user_magasin = user.service.magasin
     else:
-        # User without service assigned sees nothing
-        return Response({"count": 0, "next": None, "previous": None, "results": []})
+        return None
 
     # Get all products
     products = Produit.objects.filter(actif=True)
@@ -1277,92 +1283,96 @@ def stock_list(request):
     # Apply search filter first
     search = request.query_params.get("search")
     if search:
-        products = products.filter(
-            Q(denomination__icontains=search)
-            | Q(code_national__icontains=search)
-            | Q(code_interne__icontains=search)
-            | Q(dci__icontains=search)
-        )
+        products = search_produits(products, search)
 
-    # Calculate stock based on lots only (movements already update lot.quantite_actuelle)
+    # Calculate stock from the per-magasin soldes (kept in sync with DISPONIBLE lots)
     if user_magasin:
         # Stock = sum of lot quantities minus reserved (only DISPONIBLE lots)
         products = (
             products.annotate(
                 lot_stock=Sum(
-                    "lotproduit__quantite_actuelle",
-                    filter=Q(
-                        lotproduit__magasin=user_magasin,
-                        lotproduit__statut="DISPONIBLE",
-                    ),
+                    "soldes__quantite_totale",
+                    filter=Q(soldes__magasin=user_magasin),
                 )
             )
             .annotate(
                 lot_reserved=Sum(
-                    "lotproduit__quantite_reservee",
-                    filter=Q(
-                        lotproduit__magasin=user_magasin,
-                        lotproduit__statut="DISPONIBLE",
-                    ),
+                    "soldes__quantite_reservee",
+                    filter=Q(soldes__magasin=user_magasin),
                 )
             )
             .annotate(
                 total_stock=F("lot_stock") - Coalesce(F("lot_reserved"), 0)
             )
             .annotate(
-                lots_count=Count(
-                    "lotproduit",
-                    filter=Q(
-                        lotproduit__magasin=user_magasin,
-                        lotproduit__statut="DISPONIBLE",
+                lots_count=Coalesce(
+                    Sum(
+                        "soldes__nombre_lots",
+                        filter=Q(soldes__magasin=user_magasin),
                     ),
+                    0,
                 )
             )
         )
     else:
         # Admin sees all stock from lots (only DISPONIBLE)
         products = products.annotate(
-            lot_stock=Sum(
-                "lotproduit__quantite_actuelle",
-                filter=Q(lotproduit__statut="DISPONIBLE"),
-            ),
-            lot_reserved=Sum(
-                "lotproduit__quantite_reservee",
-                filter=Q(lotproduit__statut="DISPONIBLE"),
-            ),
+            lot_stock=Sum("soldes__quantite_totale"),
+            lot_reserved=Sum("soldes__quantite_reservee"),
             total_stock=F("lot_stock") - Coalesce(F("lot_reserved"), 0),
-            lots_count=Count("lotproduit", filter=Q(lotproduit__statut="DISPONIBLE")),
+            lots_count=Coalesce(Sum("soldes__nombre_lots"), 0),
         )
 
-    products = products.order_by("denomination")
+    if search:
+        return products.order_by("-search_rank", "denomination")
+    return products.order_by("denomination")
+
+
+def stock_item(p):
+    return {
+        "id": p.id,
+        "code_national": p.code_national,
+        "code_interne": p.code_interne,
+        "denomination": p.denomination,
+        "forme_pharmaceutique": p.forme_pharmaceutique,
+        "dosage": p.dosage,
+        "dci": p.dci,
+        "stock_securite": p.stock_securite,
+        "stock_alerte": p.stock_alerte,
+        "total_stock": p.total_stock or 0,
+        "lots_count": p.lots_count,
+    }
 
-    # Pagination
-    page = int(request.query_params.get("page", 1))
-    page_size = int(request.query_params.get("page_size", 100))
-    start = (page - 1) * page_size
-    end = start + page_size
 
-    total = products.count()
-    products_page = products[start:end]
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def stock_list(request):
+    """Get aggregated stock by product, filtered by user's service's magasin using movements"""
+    products = stock_queryset(request)
+    if products is None:
+        # User without service assigned sees nothing
+        return Response({"count": 0, "next": None, "previous": None, "results": []})
 
-    results = []
-    for p in products_page:
-        results.append(
-            {
-                "id": p.id,
-                "code_national": p.code_national,
-                "code_interne": p.code_interne,
-                "denomination": p.denomination,
-                "forme_pharmaceutique": p.forme_pharmaceutique,
-                "dosage": p.dosage,
-                "dci": p.dci,
-                "stock_securite": p.stock_securite,
-                "stock_alerte": p.stock_alerte,
-                "total_stock": p.total_stock or 0,
-                "lots_count": p.lots_count,
-            }
+    # Pagination
+    keyset = None
+    if wants_keyset(request):
+        keyset = paginate_keyset(
+            products, request, ["denomination", "id"], get_page_size(request, 100)
         )
+        products_page = keyset.items
+    else:
+        page = int(request.query_params.get("page", 1))
+        page_size = int(request.query_params.get("page_size", 100))
+        start = (page - 1) * page_size
+        end = start + page_size
+
+        total = products.count()
+        products_page = products[start:end]
 
+    results = [stock_item(p) for p in products_page]
+
+    if keyset is not None:
+        return keyset_response(request, keyset, results)
     return Response(
         {
             "results": results,
@@ -1372,10 +1382,8 @@ def stock_list(request):
     )
 
 
-@api_view(["GET"])
-@permission_classes([IsAuthenticated])
-def journal_list(request):
-    """Get journal entries with optional filtering"""
+def journal_queryset(request):
+    """Journal entries filtered by the request's categorie, action and search"""
     categorie = request.query_params.get("categorie")
     action = request.query_params.get("action")
 
@@ -1390,34 +1398,52 @@ def journal_list(request):
     search = request.query_params.get("search")
     if search:
         queryset = queryset.filter(description__icontains=search)
+    return queryset
+
+
+def journal_item(j):
+    return {
+        "id": j.id,
+        "categorie": j.categorie,
+        "action": j.action,
+        "description": j.description,
+        "utilisateur": j.utilisateur.username if j.utilisateur else None,
+        "entity_type": j.entity_type,
+        "entity_id": j.entity_id,
+        "entity_description": j.entity_description,
+        "ancien_statut": j.ancien_statut,
+        "nouveau_statut": j.nouveau_statut,
+        "details": j.details,
+        "date_creation": j.date_creation,
+    }
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def journal_list(request):
+    """Get journal entries with optional filtering"""
+    queryset = journal_queryset(request)
 
     # Pagination
-    page = int(request.query_params.get("page", 1))
-    page_size = int(request.query_params.get("page_size", 25))
-    start = (page - 1) * page_size
-    end = start + page_size
+    keyset = None
+    if wants_keyset(request):
+        keyset = paginate_keyset(
+            queryset, request, ["-date_creation", "-id"], get_page_size(request, 25)
+        )
+        journals = keyset.items
+    else:
+        page = int(request.query_params.get("page", 1))
+        page_size = int(request.query_params.get("page_size", 25))
+        start = (page - 1) * page_size
+        end = start + page_size
 
-    total = queryset.count()
-    journals = queryset[start:end]
+        total = queryset.count()
+        journals = queryset[start:end]
 
-    data = [
-        {
-            "id": j.id,
-            "categorie": j.categorie,
-            "action": j.action,
-            "description": j.description,
-            "utilisateur": j.utilisateur.username if j.utilisateur else None,
-            "entity_type": j.entity_type,
-            "entity_id": j.entity_id,
-            "entity_description": j.entity_description,
-            "ancien_statut": j.ancien_statut,
-            "nouveau_statut": j.nouveau_statut,
-            "details": j.details,
-            "date_creation": j.date_creation,
-        }
-        for j in journals
-    ]
+    data = [journal_item(j) for j in journals]
 
+    if keyset is not None:
+        return keyset_response(request, keyset, data)
     return Response(
         {
             "count": total,
@@ -1429,63 +1455,83 @@ def journal_list(request):
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def dashboard_magasins_orders(request):
-    """Get orders grouped by service/magasin with status counts and pending orders"""
-    services = (
-        Service.objects.filter(actif=True)
-        .annotate(
-            total_commandes=Count("commandeservice"),
-            en_attente=Count(
-                "commandeservice", filter=Q(commandeservice__statut="EN_ATTENTE")
-            ),
-            validee=Count(
-                "commandeservice", filter=Q(commandeservice__statut="VALIDEE")
-            ),
-            en_cours=Count(
-                "commandeservice", filter=Q(commandeservice__statut="EN_COURS")
-            ),
-            livree=Count("commandeservice", filter=Q(commandeservice__statut="LIVREE")),
-            annulee=Count(
-                "commandeservice", filter=Q(commandeservice__statut="ANNULEE")
-            ),
-        )
-        .order_by("nom")
-    )
+    """Get orders grouped by service/magasin with status counts and pending orders.
+    Optional ?magasin=<id> keeps the services of one magasin; ?cached=0 skips
+    the snapshot cache.
+    """
+    magasin_id = request.query_params.get("magasin")
+    if magasin_id:
+        try:
+            magasin_id = int(magasin_id)
+        except ValueError:
+            return Response({"error": "magasin invalide"}, status=400)
+    else:
+        magasin_id = None
 
-    results = []
-    for service in services:
-        # Get pending orders for this service
-        pending_orders = CommandeService.objects.filter(
-            service=service, statut__in=["EN_ATTENTE", "VALIDEE"]
-        ).select_related("service")[:5]
+    if request.query_params.get("cached") == "0":
+        return Response(compute_orders_overview(magasin_id))
+    return snapshot_response(request, get_orders_overview(magasin_id))
 
-        pending_orders_list = [
-            {
-                "id": order.id,
-                "numero_commande": order.numero_commande,
-                "service_nom": order.service.nom,
-                "statut": order.statut,
-                "date_demande": order.date_demande,
-            }
-            for order in pending_orders
-        ]
 
-        results.append(
-            {
-                "service_id": service.id,
-                "service_nom": service.nom,
-                "service_code": service.code_service,
-                "total_commandes": service.total_commandes,
-                "en_attente": service.en_attente,
-                "validee": service.validee,
-                "en_cours": service.en_cours,
-                "livree": service.livree,
-                "annulee": service.annulee,
-                "pending_orders": pending_orders_list,
-            }
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def export_data(request, dataset, extension):
+    """Stream lots, mouvements, journal or the aggregated stock as CSV or XLSX,
+    with the same magasin scoping and filters as the list endpoints"""
+    if extension not in CONTENT_TYPES:
+        return Response({"error": f"Format non supporté: {extension}"}, status=404)
+
+    if dataset == "lots":
+        view = LotViewSet(request=request, format_kwarg=None)
+        queryset = view.get_queryset().select_related("magasin")
+        columns = LOT_COLUMNS
+    elif dataset == "mouvements":
+        view = MouvementViewSet(request=request, format_kwarg=None)
+        queryset = view.get_queryset()
+        columns = MOUVEMENT_COLUMNS
+    elif dataset == "journal":
+        queryset = journal_queryset(request)
+        columns = JOURNAL_COLUMNS
+    elif dataset == "stock":
+        queryset = stock_queryset(request)
+        if queryset is None:
+            queryset = Produit.objects.none()
+        columns = STOCK_COLUMNS
+    else:
+        return Response({"error": f"Export inconnu: {dataset}"}, status=404)
+
+    return export_response(queryset, columns, dataset, extension)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def produits_import(request):
+    """Bulk create / update products from an uploaded CSV, JSON or JSON Lines
+    file ("file"), matched on code_national. Returns the counts and the
+    rejected rows; ?dry_run=1 validates without writing."""
+    if not (
+        check_permission(request.user, "produits", "add")
+        and check_permission(request.user, "produits", "change")
+    ):
+        return Response(
+            {"error": "Vous n'avez pas la permission d'importer des produits"},
+            status=403,
         )
 
-    return Response(
-        {
-            "magasins": results,
-        }
-    )
+    upload = request.FILES.get("file")
+    if upload is None:
+        return Response({"error": "Fichier requis"}, status=400)
+    extension = upload.name.rsplit(".", 1)[-1].lower()
+    format = request.data.get("format") or extension
+    if format not in READERS:
+        return Response({"error": f"Format non supporté: {format}"}, status=400)
+
+    dry_run = request.query_params.get("dry_run") in ("1", "true")
+    try:
+        result = import_file(
+            upload.file, format, utilisateur=request.user, dry_run=dry_run
+        )
+    except (ValueError, UnicodeDecodeError) as e:
+        return Response({"error": str(e)}, status=400)
+
+    return Response({"dry_run": dry_run, **result.as_dict()})
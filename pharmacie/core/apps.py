@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from . import cache, journal_sink, kpi_snapshots, permission_matrix, product_search
+
+        # kpi_snapshots and permission_matrix register their cache scopes
+        cache.connect_signals()
+        journal_sink.connect_signals()
+        permission_matrix.connect_signals()
+        product_search.connect_signals()
@@ -0,0 +1,205 @@
+"""Async versions of the read-heavy endpoints, for ASGI deployments.
+
+With SERVER_PROFILE=async (gunicorn.conf.py) the API is served by uvicorn
+workers and pharmacie/urls.py routes stock_list, dashboard_kpis,
+journal_list and produits_with_stock here. A slow query then holds one
+request, not a whole worker: the event loop keeps serving other clients
+while the ORM call runs in the request's thread (Django's async ORM
+delegates to a thread; dashboard snapshots are computed there too).
+
+The views return the same payloads as their api_views counterparts, built
+with the same querysets and item functions. They are plain Django views:
+JWT authentication is done here, loading the user with its service and
+magasin in one query, and responses are rendered with DRF's JSON encoder.
+"""
+
+import functools
+
+from django.contrib.auth import get_user_model
+from django.http import JsonResponse
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .api_views import (
+    empty_kpis,
+    journal_item,
+    journal_queryset,
+    produit_stock_item,
+    produits_with_stock_queryset,
+    snapshot_response,
+    stock_item,
+    stock_queryset,
+)
+from .kpi_snapshots import aget_snapshot
+from .models import Magasin, Produit
+from .pagination import apaginate_keyset, get_page_size, keyset_response, wants_keyset
+from .product_search import aprepare_search
+from .profiling import serializing
+
+
+def json_response(data, status=200):
+    """JSON response rendered like DRF's JSONRenderer"""
+    with serializing():
+        return JsonResponse(
+            data,
+            status=status,
+            safe=False,
+            encoder=JSONEncoder,
+            json_dumps_params={"ensure_ascii": False, "separators": (",", ":")},
+        )
+
+
+async def authenticate(request):
+    """The active user of the request's JWT, with service__magasin loaded."""
+    auth = JWTAuthentication()
+    header = auth.get_header(request)
+    raw_token = auth.get_raw_token(header) if header is not None else None
+    if raw_token is None:
+        raise exceptions.NotAuthenticated()
+    token = auth.get_validated_token(raw_token)
+    try:
+        user_id = token[api_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken("Token contained no recognizable user identification")
+
+    try:
+        user = await get_user_model().objects.select_related(
+            "service__magasin"
+        ).aget(**{api_settings.USER_ID_FIELD: user_id})
+    except get_user_model().DoesNotExist:
+        raise AuthenticationFailed("User not found", code="user_not_found")
+    if not user.is_active:
+        raise AuthenticationFailed("User is inactive", code="user_inactive")
+    return user
+
+
+def _error_response(request, exc):
+    # Same payload as DRF's exception handler
+    if isinstance(exc.detail, (list, dict)):
+        data = exc.detail
+    else:
+        data = {"detail": exc.detail}
+    response = json_response(data, status=exc.status_code)
+    if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+        response["WWW-Authenticate"] = JWTAuthentication().authenticate_header(request)
+    return response
+
+
+def async_api_view(view):
+    """Authenticated GET endpoint: ``view`` receives a DRF Request (for
+    query_params) whose user is set, and API errors are rendered as DRF
+    does."""
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return json_response(
+                {"detail": f'Method "{request.method}" not allowed.'}, status=405
+            )
+        try:
+            user = await authenticate(request)
+            drf_request = Request(request)
+            drf_request.user = user
+            return await view(drf_request, *args, **kwargs)
+        except exceptions.APIException as exc:
+            return _error_response(request, exc)
+
+    return wrapper
+
+
+def _page_bounds(request, default):
+    page = int(request.query_params.get("page", 1))
+    page_size = int(request.query_params.get("page_size", default))
+    start = (page - 1) * page_size
+    return start, start + page_size, page_size
+
+
+@async_api_view
+async def stock_list(request):
+    """Async stock_list"""
+    await aprepare_search()
+    products = stock_queryset(request)
+    if products is None:
+        return json_response({"count": 0, "next": None, "previous": None, "results": []})
+
+    if wants_keyset(request):
+        keyset = await apaginate_keyset(
+            products, request, ["denomination", "id"], get_page_size(request, 100)
+        )
+        results = [stock_item(p) for p in keyset.items]
+        return keyset_response(request, keyset, results, json_response)
+
+    start, end, page_size = _page_bounds(request, 100)
+    total = await products.acount()
+    results = [stock_item(p) async for p in products[start:end]]
+    return json_response(
+        {
+            "results": results,
+            "count": total,
+            "total_pages": (total + page_size - 1) // page_size,
+        }
+    )
+
+
+@async_api_view
+async def produits_with_stock(request):
+    """Async produits_with_stock"""
+    principal_magasin = await Magasin.objects.filter(
+        code_magasin="PRINCIPAL", actif=True
+    ).afirst()
+    if not principal_magasin:
+        return json_response({"count": 0, "results": []})
+
+    await aprepare_search()
+    queryset = produits_with_stock_queryset(request, principal_magasin)
+
+    if wants_keyset(request):
+        keyset = await apaginate_keyset(
+            queryset, request, ["denomination", "id"], get_page_size(request, 25)
+        )
+        data = [produit_stock_item(p) for p in keyset.items]
+        return keyset_response(request, keyset, data, json_response)
+
+    start, end, _ = _page_bounds(request, 25)
+    total = await queryset.acount()
+    data = [produit_stock_item(p) async for p in queryset[start:end]]
+    return json_response({"count": total, "results": data})
+
+
+@async_api_view
+async def journal_list(request):
+    """Async journal_list"""
+    queryset = journal_queryset(request)
+
+    if wants_keyset(request):
+        keyset = await apaginate_keyset(
+            queryset, request, ["-date_creation", "-id"], get_page_size(request, 25)
+        )
+        data = [journal_item(j) for j in keyset.items]
+        return keyset_response(request, keyset, data, json_response)
+
+    start, end, _ = _page_bounds(request, 25)
+    total = await queryset.acount()
+    data = [journal_item(j) async for j in queryset[start:end]]
+    return json_response({"count": total, "results": data})
+
+
+@async_api_view
+async def dashboard_kpis(request):
+    """Async dashboard_kpis"""
+    user = request.user
+    user_magasin = None
+    if user.is_superuser:
+        pass
+    elif user.service and user.service.magasin:
+        user_magasin = user.service.magasin
+    else:
+        total_products = await Produit.objects.filter(actif=True).acount()
+        return json_response(empty_kpis(total_products))
+
+    snapshot = await aget_snapshot(user_magasin, user.service if user_magasin else None)
+    return snapshot_response(request, snapshot, json_response)
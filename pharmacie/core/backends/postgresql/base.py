@@ -0,0 +1,7 @@
+from django.db.backends.postgresql import base
+
+from core.database import InstrumentedMixin
+
+
+class DatabaseWrapper(InstrumentedMixin, base.DatabaseWrapper):
+    pass
@@ -0,0 +1,9 @@
+from django.db.backends.sqlite3 import base
+
+from core.database import InstrumentedMixin, copy_sqlite_template
+
+
+class DatabaseWrapper(InstrumentedMixin, base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        copy_sqlite_template(conn_params["database"])
+        return super().get_new_connection(conn_params)
@@ -0,0 +1,159 @@
+"""Project cache: key namespace, version stamps and invalidation.
+
+The cache is shared by every worker process (settings.CACHES), so an entry
+computed by one worker is reused, and invalidated, by all of them. Keys are
+built with key(namespace, ...) ("kpi:...", "permissions:..."); Django adds
+the KEY_PREFIX and VERSION of the settings, so bumping CACHE_VERSION drops
+every entry after a deploy.
+
+Entries derived from the database are keyed with the version stamps of the
+scopes they depend on (a scope is a name like "catalogue" or "magasin:3",
+see stamps()). After a write, invalidate(scopes) replaces those stamps once
+the current transaction commits, and the entries built on the old stamps
+are never read again (they expire on their own). Stamps are time based so
+they never repeat, even after the stamp itself is evicted, and need no
+atomic incr (which the file backend lacks).
+
+Models register the scopes an instance belongs to with register(); their
+saves and deletes invalidate them through signals, and code writing with
+update() / bulk_create() calls invalidate_instances() or invalidate().
+Invalidations are collected per transaction and written with one
+set_many() when it commits.
+"""
+
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+SEPARATOR = ":"
+# Timeout of the stamps (None: never expire)
+STAMP_TIMEOUT = None
+
+_registry = {}
+_local = threading.local()
+
+
+def key(namespace, *parts):
+    """Cache key of ``parts`` in ``namespace``."""
+    return SEPARATOR.join([namespace, *(str(part) for part in parts)])
+
+
+def _stamp_key(scope):
+    return key("stamp", scope)
+
+
+def stamps(scopes):
+    """Current version stamps of ``scopes`` (created as needed), in order."""
+    keys = [_stamp_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    missing = {k: time.time_ns() for k in keys if k not in found}
+    if missing:
+        cache.set_many(missing, STAMP_TIMEOUT)
+        found.update(missing)
+    return [found[k] for k in keys]
+
+
+async def astamps(scopes):
+    """stamps() for async code."""
+    keys = [_stamp_key(scope) for scope in scopes]
+    found = await cache.aget_many(keys)
+    missing = {k: time.time_ns() for k in keys if k not in found}
+    if missing:
+        await cache.aset_many(missing, STAMP_TIMEOUT)
+        found.update(missing)
+    return [found[k] for k in keys]
+
+
+def _stamped(namespace, scopes, versions, parts):
+    return key(
+        namespace,
+        *parts,
+        *(f"{scope}={version}" for scope, version in zip(scopes, versions)),
+    )
+
+
+def stamped_key(namespace, scopes, *parts):
+    """Key of ``parts`` in ``namespace`` that changes whenever one of
+    ``scopes`` is invalidated; returns (key, stamps)."""
+    scopes = list(scopes)
+    versions = stamps(scopes)
+    return _stamped(namespace, scopes, versions, parts), versions
+
+
+async def astamped_key(namespace, scopes, *parts):
+    """stamped_key() for async code."""
+    scopes = list(scopes)
+    versions = await astamps(scopes)
+    return _stamped(namespace, scopes, versions, parts), versions
+
+
+def _bump(scopes):
+    now = time.time_ns()
+    cache.set_many({_stamp_key(scope): now for scope in scopes}, STAMP_TIMEOUT)
+
+
+class _Pending(set):
+    """Scopes invalidated in the current transaction, bumped on commit."""
+
+    def __call__(self):
+        if getattr(_local, "pending", None) is self:
+            _local.pending = None
+        _bump(self)
+
+
+def invalidate(scopes):
+    """Invalidate ``scopes`` once the current transaction commits (now
+    outside of a transaction)."""
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        _bump(set(scopes))
+        return
+    pending = getattr(_local, "pending", None)
+    # A new transaction, or the callback was dropped with a rolled back
+    # savepoint: start a new set
+    if pending is None or not any(
+        callback is pending for _, callback, *_ in connection.run_on_commit
+    ):
+        pending = _local.pending = _Pending()
+        transaction.on_commit(pending)
+    pending.update(scopes)
+
+
+def register(model, scopes):
+    """Declare that ``scopes(instance)`` (an iterable of scope names) must be
+    invalidated when an instance of ``model`` is written."""
+    _registry.setdefault(model, []).append(scopes)
+
+
+def scopes_of(instance):
+    return {
+        scope
+        for scopes in _registry.get(type(instance), ())
+        for scope in scopes(instance)
+        if scope is not None
+    }
+
+
+def invalidate_instances(instances):
+    """Invalidate the registered scopes of written ``instances``."""
+    scopes = set()
+    for instance in instances:
+        scopes |= scopes_of(instance)
+    if scopes:
+        invalidate(scopes)
+
+
+def _instance_written(sender, instance, **kwargs):
+    invalidate_instances([instance])
+
+
+def connect_signals():
+    for model in _registry:
+        uid = f"cache_{model.__name__}"
+        post_save.connect(_instance_written, sender=model, dispatch_uid=f"{uid}_save")
+        post_delete.connect(
+            _instance_written, sender=model, dispatch_uid=f"{uid}_delete"
+        )
@@ -0,0 +1,323 @@
+"""Bulk import of the product catalogue from CSV or JSON.
+
+Rows are read lazily (CSV, a JSON array or JSON Lines) and processed in
+batches. Each batch is validated row by row, diffed against the existing
+products by code_national and written with one
+bulk_create(update_conflicts=True) on code_national, in its own
+transaction, followed by one summary journal entry. Rejected rows are
+reported with their line number and do not stop the import.
+"""
+
+import csv
+import io
+import json
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import BooleanField
+
+from .journal_sink import journal_sink
+from .cache import invalidate
+from .kpi_snapshots import CATALOGUE
+from .models import Produit
+from .product_search import index_produits
+
+BATCH_SIZE = 1000
+# Every editable Produit column except the BaseModel audit fields
+IMPORT_FIELDS = [
+    field.name
+    for field in Produit._meta.concrete_fields
+    if field.editable
+    and not field.primary_key
+    and field.name
+    not in (
+        "date_creation",
+        "date_modification",
+        "utilisateur_creation",
+        "utilisateur_modification",
+    )
+]
+UPDATE_FIELDS = [name for name in IMPORT_FIELDS if name != "code_national"] + [
+    "date_modification",
+    "utilisateur_modification",
+]
+
+
+# Readers
+
+
+def read_csv(stream):
+    """Yield one dict per CSV row; ``;`` or ``,`` separated, UTF-8 (BOM allowed)."""
+    if isinstance(stream.read(0), bytes):
+        stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    header = stream.readline()
+    delimiter = ";" if header.count(";") > header.count(",") else ","
+    fields = next(csv.reader([header], delimiter=delimiter))
+    for row in csv.DictReader(stream, fieldnames=fields, delimiter=delimiter):
+        yield row
+
+
+def read_json(stream, chunk_size=64 * 1024):
+    """Yield the objects of a JSON array, or of JSON Lines, without loading
+    the whole document."""
+    if isinstance(stream.read(0), bytes):
+        stream = io.TextIOWrapper(stream, encoding="utf-8-sig")
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    in_array = None
+    eof = False
+
+    while True:
+        # Skip separators
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position >= len(buffer) or (
+            in_array is None and position == len(buffer) - 1
+        ):
+            if eof:
+                if in_array:
+                    raise ValueError("JSON invalide: tableau non terminé")
+                return
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        if in_array is None:
+            in_array = buffer[position] == "["
+            if in_array:
+                position += 1
+            continue
+        if in_array and buffer[position] == "]":
+            return
+        try:
+            obj, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise ValueError("JSON invalide")
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        position = end
+        yield obj
+
+
+READERS = {"csv": read_csv, "json": read_json, "jsonl": read_json}
+
+# Spreadsheet booleans, on top of what BooleanField accepts
+BOOLEENS = {"oui": True, "o": True, "vrai": True, "non": False, "n": False, "faux": False}
+
+
+# Validation
+
+
+def parse_row(data):
+    """Return the cleaned {field: value} of one input row, raising ValueError."""
+    if not isinstance(data, dict):
+        raise ValueError("Ligne invalide")
+    values = {}
+    for name in IMPORT_FIELDS:
+        if name not in data:
+            continue
+        field = Produit._meta.get_field(name)
+        value = data[name]
+        if isinstance(value, str):
+            value = value.strip()
+            if isinstance(field, BooleanField):
+                value = BOOLEENS.get(value.lower(), value)
+        if value in ("", None):
+            if field.null:
+                values[name] = None
+                continue
+            if field.has_default():
+                values[name] = field.get_default()
+                continue
+        try:
+            values[name] = field.clean(value, None)
+        except ValidationError as exc:
+            raise ValueError(f"{name}: {' '.join(exc.messages)}")
+    if not values.get("code_national"):
+        raise ValueError("code_national est requis")
+    return values
+
+
+def _missing_required(values):
+    return [
+        field.name
+        for field in Produit._meta.concrete_fields
+        if field.name in IMPORT_FIELDS
+        and not field.null
+        and not field.has_default()
+        and values.get(field.name) in (None, "")
+    ]
+
+
+class ImportResult:
+    def __init__(self):
+        self.crees = 0
+        self.mis_a_jour = 0
+        self.inchanges = 0
+        self.erreurs = []
+        # Every code_national read so far, to reject duplicates across batches
+        self.codes = set()
+        # {code_interne: code_national} of the rows accepted so far
+        self.codes_internes = {}
+
+    @property
+    def rejetes(self):
+        return len(self.erreurs)
+
+    def as_dict(self):
+        return {
+            "crees": self.crees,
+            "mis_a_jour": self.mis_a_jour,
+            "inchanges": self.inchanges,
+            "rejetes": self.rejetes,
+            "erreurs": self.erreurs,
+        }
+
+
+def _import_batch(batch, result, utilisateur=None, dry_run=False):
+    """Validate, diff and upsert one batch of (ligne, data) pairs."""
+    parsed = {}
+    for ligne, data in batch:
+        try:
+            values = parse_row(data)
+        except ValueError as exc:
+            code = data.get("code_national") if isinstance(data, dict) else None
+            result.erreurs.append(
+                {"ligne": ligne, "code_national": code, "erreur": str(exc)}
+            )
+            continue
+        code = values["code_national"]
+        if code in result.codes:
+            result.erreurs.append(
+                {"ligne": ligne, "code_national": code, "erreur": "code_national en double"}
+            )
+            continue
+        result.codes.add(code)
+        parsed[code] = (ligne, values)
+
+    existing = Produit.objects.in_bulk(list(parsed), field_name="code_national")
+    codes_internes = {
+        values["code_interne"]: code
+        for code, (_, values) in parsed.items()
+        if values.get("code_interne")
+    }
+    taken = dict(
+        Produit.objects.filter(code_interne__in=list(codes_internes)).values_list(
+            "code_interne", "code_national"
+        )
+    )
+
+    username = getattr(utilisateur, "username", None)
+    to_write = []
+    created = updated = 0
+    for code, (ligne, values) in parsed.items():
+        code_interne = values.get("code_interne")
+        owner = result.codes_internes.get(code_interne, taken.get(code_interne))
+        if owner is not None and owner != code:
+            result.erreurs.append(
+                {
+                    "ligne": ligne,
+                    "code_national": code,
+                    "erreur": f"code_interne déjà utilisé par {owner}",
+                }
+            )
+            continue
+
+        produit = existing.get(code)
+        if produit is None:
+            missing = _missing_required(values)
+            if missing:
+                result.erreurs.append(
+                    {
+                        "ligne": ligne,
+                        "code_national": code,
+                        "erreur": f"{', '.join(missing)} requis",
+                    }
+                )
+                continue
+        if code_interne:
+            result.codes_internes[code_interne] = code
+
+        if produit is None:
+            produit = Produit(**values, utilisateur_creation=username)
+            created += 1
+        elif all(getattr(produit, name) == value for name, value in values.items()):
+            result.inchanges += 1
+            continue
+        else:
+            for name, value in values.items():
+                setattr(produit, name, value)
+            updated += 1
+        produit.utilisateur_modification = username
+        to_write.append(produit)
+
+    result.crees += created
+    result.mis_a_jour += updated
+    if dry_run or not to_write:
+        return
+
+    with transaction.atomic():
+        Produit.objects.bulk_create(
+            to_write,
+            update_conflicts=True,
+            unique_fields=["code_national"],
+            update_fields=UPDATE_FIELDS,
+        )
+        index_produits(
+            Produit.objects.filter(code_national__in=[p.code_national for p in to_write])
+            .only("id")
+        )
+        invalidate([CATALOGUE])
+        journal_sink.write(
+            {
+                "categorie": "PRODUIT",
+                "action": "IMPORT",
+                "description": (
+                    f"Import du catalogue: {created} produit(s) créé(s), "
+                    f"{updated} mis à jour"
+                ),
+                "utilisateur_id": getattr(utilisateur, "pk", None),
+                "entity_type": "Produit",
+                "details": {
+                    "crees": created,
+                    "mis_a_jour": updated,
+                    "premiere_ligne": batch[0][0],
+                    "derniere_ligne": batch[-1][0],
+                    "codes": [p.code_national for p in to_write],
+                },
+            }
+        )
+
+
+def import_catalogue(rows, batch_size=BATCH_SIZE, utilisateur=None, dry_run=False,
+                     first_line=1):
+    """Import an iterable of row dicts; returns an ImportResult.
+
+    Line numbers in the report start at ``first_line`` (2 for a CSV file
+    with a header).
+    """
+    result = ImportResult()
+    numbered = enumerate(rows, first_line)
+    while True:
+        batch = list(islice(numbered, batch_size))
+        if not batch:
+            break
+        _import_batch(batch, result, utilisateur=utilisateur, dry_run=dry_run)
+    return result
+
+
+def import_file(stream, format, **kwargs):
+    """Import a CSV / JSON / JSON Lines file object."""
+    if format not in READERS:
+        raise ValueError(f"Format non supporté: {format}")
+    first_line = 2 if format == "csv" else 1
+    return import_catalogue(READERS[format](stream), first_line=first_line, **kwargs)
@@ -0,0 +1,128 @@
+"""Write serialisation for SQLite, and connection setup timing.
+
+SQLite has a single writer. A transaction opened with a plain BEGIN starts
+as a reader and asks for the write lock at its first write; if another
+connection wrote meanwhile, the upgrade cannot wait (busy_timeout does not
+apply, as waiting could deadlock) and fails with "database is locked".
+Stock writes read the lots first, so under concurrency they hit exactly
+that.
+
+write_transaction() is atomic() beginning with BEGIN IMMEDIATE on SQLite:
+the write lock is taken up front, waiting up to busy_timeout for the
+current writer, so concurrent stock writes queue instead of failing.
+Other databases lock the rows they read with SELECT ... FOR UPDATE and get
+a plain atomic().
+
+The SQLite backend creates settings.SQLITE_PATH, when it does not exist,
+as a copy of the shipped initial data (settings.SQLITE_TEMPLATE), which is
+never opened itself. An existing database is always used as it is.
+
+The database backends of core/backends (the ENGINE of the settings) time
+every connection they open: connect, session setup (SQLite pragmas,
+PostgreSQL time zone) or checkout from the PostgreSQL pool. The totals per
+process are in connection_stats(); the connections opened and the queries
+executed while serving a request are added to its profile
+(core/profiling.py).
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import ContextDecorator
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+
+from .profiling import current_profile, profile_query
+
+logger = logging.getLogger(__name__)
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+class write_transaction(ContextDecorator):
+    """atomic() that takes the SQLite write lock when it begins."""
+
+    def __init__(self, using=None):
+        self.using = using
+        self._atomic = None
+
+    def _recreate_cm(self):
+        # A fresh instance per decorated call, so threads don't share state
+        return type(self)(self.using)
+
+    def __enter__(self):
+        connection = transaction.get_connection(self.using)
+        self._atomic = transaction.atomic(using=self.using)
+        if connection.vendor != "sqlite" or connection.in_atomic_block:
+            return self._atomic.__enter__()
+        # Opening the connection resets transaction_mode from the settings
+        connection.ensure_connection()
+        mode = connection.transaction_mode
+        connection.transaction_mode = "IMMEDIATE"
+        try:
+            return self._atomic.__enter__()
+        finally:
+            connection.transaction_mode = mode
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._atomic.__exit__(exc_type, exc_value, traceback)
+
+
+def copy_sqlite_template(database):
+    """Create ``database``, if it is settings.SQLITE_PATH and does not exist,
+    as a copy of settings.SQLITE_TEMPLATE (when there is one)."""
+    path = getattr(settings, "SQLITE_PATH", None)
+    template = getattr(settings, "SQLITE_TEMPLATE", None)
+    if path is None or template is None or str(database) != str(path):
+        return
+    path, template = Path(path), Path(template)
+    if path.exists() or not template.exists():
+        return
+    # Copied aside then linked in place, so processes starting together
+    # neither see a partial copy nor replace one another's
+    partial = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    shutil.copyfile(template, partial)
+    try:
+        os.link(partial, path)
+    except FileExistsError:
+        pass
+    else:
+        logger.info("Created %s from %s", path, template)
+    finally:
+        partial.unlink()
+
+
+def record_connect(alias, seconds):
+    with _stats_lock:
+        count, total = _stats.get(alias, (0, 0.0))
+        _stats[alias] = (count + 1, total + seconds)
+    profile = current_profile()
+    if profile is not None:
+        profile.connections += 1
+        profile.connect_time += seconds
+    logger.debug("Opened the %s connection in %.1f ms", alias, seconds * 1000)
+
+
+def connection_stats():
+    """{alias: (connections opened, seconds spent opening them)} for this process."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+class InstrumentedMixin:
+    """DatabaseWrapper mixin timing connect() and profiling the queries."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.execute_wrappers.append(profile_query)
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        record_connect(self.alias, time.perf_counter() - start)
@@ -0,0 +1,224 @@
+"""Streaming CSV / XLSX exports.
+
+Rows are read with QuerySet.iterator(chunk_size=CHUNK_SIZE) and written as
+they come: the CSV writer is a generator and the XLSX writer streams a
+zip archive (inline strings, no shared string table) through a small
+buffer that is drained every chunk, so memory does not grow with the
+number of rows.
+"""
+
+import csv
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+CHUNK_SIZE = 2000
+
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def _local(value):
+    """Naive local time, as spreadsheets have no time zones"""
+    if isinstance(value, datetime) and timezone.is_aware(value):
+        value = timezone.make_naive(value)
+    return value
+
+
+LOT_COLUMNS = [
+    ("ID", lambda l: l.id),
+    ("Code national", lambda l: l.produit.code_national),
+    ("Produit", lambda l: l.produit.denomination),
+    ("Numéro de lot", lambda l: l.numero_lot),
+    ("Magasin", lambda l: l.magasin.nom if l.magasin else None),
+    ("Date de fabrication", lambda l: l.date_fabrication),
+    ("Date de péremption", lambda l: l.date_peremption),
+    ("Date de réception", lambda l: l.date_reception),
+    ("Quantité initiale", lambda l: l.quantite_initiale),
+    ("Quantité actuelle", lambda l: l.quantite_actuelle),
+    ("Quantité réservée", lambda l: l.quantite_reservee),
+    ("Statut", lambda l: l.statut),
+    ("Prix unitaire d'achat", lambda l: l.prix_unitaire_achat),
+]
+
+MOUVEMENT_COLUMNS = [
+    ("Numéro", lambda m: m.numero_mouvement),
+    ("Date", lambda m: _local(m.date_mouvement)),
+    ("Type", lambda m: m.type_mouvement),
+    ("Code national", lambda m: m.produit.code_national),
+    ("Produit", lambda m: m.produit.denomination),
+    ("Numéro de lot", lambda m: m.lot.numero_lot if m.lot else None),
+    ("Quantité", lambda m: m.quantite),
+    ("Magasin source", lambda m: m.magasin_source.nom if m.magasin_source else None),
+    (
+        "Magasin destination",
+        lambda m: m.magasin_destination.nom if m.magasin_destination else None,
+    ),
+]
+
+JOURNAL_COLUMNS = [
+    ("Date", lambda j: _local(j.date_creation)),
+    ("Catégorie", lambda j: j.categorie),
+    ("Action", lambda j: j.action),
+    ("Description", lambda j: j.description),
+    ("Utilisateur", lambda j: j.utilisateur.username if j.utilisateur else None),
+    ("Type d'entité", lambda j: j.entity_type),
+    ("ID entité", lambda j: j.entity_id),
+    ("Entité", lambda j: j.entity_description),
+    ("Ancien statut", lambda j: j.ancien_statut),
+    ("Nouveau statut", lambda j: j.nouveau_statut),
+]
+
+STOCK_COLUMNS = [
+    ("Code national", lambda p: p.code_national),
+    ("Code interne", lambda p: p.code_interne),
+    ("Dénomination", lambda p: p.denomination),
+    ("Forme", lambda p: p.forme_pharmaceutique),
+    ("Dosage", lambda p: p.dosage),
+    ("DCI", lambda p: p.dci),
+    ("Stock de sécurité", lambda p: p.stock_securite),
+    ("Stock d'alerte", lambda p: p.stock_alerte),
+    ("Stock total", lambda p: p.total_stock or 0),
+    ("Nombre de lots", lambda p: p.lots_count),
+]
+
+
+def _rows(queryset, columns):
+    for obj in queryset.iterator(chunk_size=CHUNK_SIZE):
+        yield [accessor(obj) for _, accessor in columns]
+
+
+class _Echo:
+    """File-like object whose write() returns the data, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def csv_stream(header, rows):
+    writer = csv.writer(_Echo())
+    # BOM so that spreadsheet software detects UTF-8
+    yield "\ufeff" + writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(["" if value is None else value for value in row])
+
+
+class _Buffer:
+    """Unseekable sink for zipfile, drained by the generator."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+_XLSX_STATIC = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" '
+        'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        "</Types>"
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+        'officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        "</Relationships>"
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+        'officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        "</Relationships>"
+    ),
+}
+
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets></workbook>'
+)
+
+# Control characters are not allowed in XML 1.0
+_ILLEGAL_XML = dict.fromkeys(c for c in range(32) if c not in (9, 10, 13))
+
+
+def _cell(value):
+    if value is None:
+        return "<c/>"
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f"<c><v>{value}</v></c>"
+    if isinstance(value, datetime):
+        value = value.isoformat(sep=" ")
+    elif isinstance(value, date):
+        value = value.isoformat()
+    text = escape(str(value).translate(_ILLEGAL_XML))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _row_xml(values):
+    return ("<row>" + "".join(_cell(v) for v in values) + "</row>").encode()
+
+
+def xlsx_stream(header, rows, sheet_name="Export"):
+    buffer = _Buffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_STATIC.items():
+            archive.writestr(name, content)
+        archive.writestr("xl/workbook.xml", _WORKBOOK.format(name=escape(sheet_name)))
+        yield buffer.drain()
+
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/'
+                b'spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(_row_xml(header))
+            for count, row in enumerate(rows, 1):
+                sheet.write(_row_xml(row))
+                if count % CHUNK_SIZE == 0:
+                    yield buffer.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield buffer.drain()
+
+
+def export_response(queryset, columns, name, extension):
+    """StreamingHttpResponse exporting ``queryset`` as ``extension`` (csv/xlsx)."""
+    header = [title for title, _ in columns]
+    rows = _rows(queryset, columns)
+    if extension == "xlsx":
+        content = xlsx_stream(header, rows, sheet_name=name)
+    else:
+        content = csv_stream(header, rows)
+    response = StreamingHttpResponse(content, content_type=CONTENT_TYPES[extension])
+    filename = f"{name}-{timezone.localdate().isoformat()}.{extension}"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
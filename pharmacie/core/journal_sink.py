@@ -0,0 +1,243 @@
+"""Buffered writer for Journal entries.
+
+In "buffered" mode (settings.JOURNAL_WRITER["MODE"]) entries are queued once
+their transaction commits, appended to a per-worker spool file and written
+with bulk_create when the buffer is full, when FLUSH_INTERVAL has elapsed,
+at the end of each request (after the response has been sent) and at exit.
+In "sync" mode every entry is inserted immediately.
+
+Each worker has its own spool, named after its PID and a random suffix (a
+PID is reused after a restart), which it keeps open with an exclusive lock
+(flock, or msvcrt.locking on Windows) until it exits; it is emptied in the
+transaction of every successful flush and removed at exit, once closed.
+recover_spool() replays the spools no process holds any more: those of
+workers that died. It runs before a worker appends its first entry, and in
+the flush_journal command. A spool is emptied in the transaction that
+replays it and only then removed, so a crash in between never replays it
+twice. Without either locking module a live spool cannot be told from a
+dead one, and only flush_journal --all, with the server stopped, replays
+them.
+
+Journal.date_creation is set when the entry is flushed, not when it is logged.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import close_old_connections, transaction
+
+from .models import Journal
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "MODE": "buffered",
+    "BATCH_SIZE": 200,
+    "FLUSH_INTERVAL": 2.0,
+    "FLUSH_ON_REQUEST_END": True,
+    "SPOOL_DIR": None,
+    "FSYNC": False,
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, "JOURNAL_WRITER", {}))
+    if not config["SPOOL_DIR"]:
+        config["SPOOL_DIR"] = Path(settings.BASE_DIR) / "journal_spool"
+    config["SPOOL_DIR"] = Path(config["SPOOL_DIR"])
+    return config
+
+
+def _insert(entries, batch_size):
+    Journal.objects.bulk_create(
+        [Journal(**entry) for entry in entries], batch_size=batch_size
+    )
+
+
+def _try_lock(handle):
+    """Take the exclusive lock of an open spool; False if a process holds it."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elif msvcrt is not None:
+            # Locks the first byte, whether or not it was written yet; an
+            # append-mode handle still writes at the end of the file.
+            position = handle.tell()
+            handle.seek(0)
+            try:
+                msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+            finally:
+                handle.seek(position)
+    except OSError:
+        return False
+    return True
+
+
+class JournalSink:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spool = None
+        self._reset()
+
+    def _reset(self):
+        if self._spool is not None:
+            # Inherited from the parent process: the lock must not outlive it
+            self._spool.close()
+            self._spool = None
+        self._pid = os.getpid()
+        self._name = f"journal-{self._pid}-{uuid.uuid4().hex[:8]}.jsonl"
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._recovered = False
+
+    @property
+    def spool_path(self):
+        return get_config()["SPOOL_DIR"] / self._name
+
+    def write(self, entry):
+        """Record a journal entry given as a dict of Journal field values."""
+        if get_config()["MODE"] == "sync":
+            Journal.objects.create(**entry)
+            return
+        transaction.on_commit(lambda: self._enqueue(entry))
+
+    def _enqueue(self, entry):
+        config = get_config()
+        if os.getpid() != self._pid:
+            # Forked worker: the parent's buffer is not ours to flush
+            self._reset()
+        if not self._recovered:
+            self._recovered = True
+            recover_spool()
+
+        with self._lock:
+            self._spool_append(entry, config)
+            self._buffer.append(entry)
+            due = len(self._buffer) >= config["BATCH_SIZE"] or (
+                time.monotonic() - self._last_flush >= config["FLUSH_INTERVAL"]
+            )
+        if due:
+            self.flush()
+
+    def _spool_append(self, entry, config):
+        if self._spool is None:
+            config["SPOOL_DIR"].mkdir(parents=True, exist_ok=True)
+            # Locked before anything is written, and until this process exits
+            self._spool = open(self.spool_path, "a", encoding="utf-8")
+            _try_lock(self._spool)
+        self._spool.write(json.dumps(entry, default=str) + "\n")
+        self._spool.flush()
+        if config["FSYNC"]:
+            os.fsync(self._spool.fileno())
+
+    def flush(self):
+        """Write the buffered entries; returns how many were written."""
+        config = get_config()
+        with self._lock:
+            entries = self._buffer
+            if not entries or os.getpid() != self._pid:
+                return 0
+            try:
+                with transaction.atomic():
+                    _insert(entries, config["BATCH_SIZE"])
+                    self._spool.truncate(0)
+            except Exception:
+                # Keep the entries (and the spool) for the next attempt
+                logger.exception("Journal flush failed, %d entries kept", len(entries))
+                return 0
+            self._buffer = []
+            self._last_flush = time.monotonic()
+        return len(entries)
+
+    def close(self):
+        """Flush, and remove the spool unless entries are left in it."""
+        self.flush()
+        with self._lock:
+            if self._spool is None or os.getpid() != self._pid:
+                return
+            # Closed first: Windows does not remove a file that is still open
+            self._spool.close()
+            self._spool = None
+            if not self._buffer:
+                self.spool_path.unlink(missing_ok=True)
+
+
+def recover_spool(all_files=False):
+    """Replay the spool files of workers that died; returns the number of entries.
+
+    A spool is claimed by taking its lock, which its worker holds while it
+    lives. Without fcntl or msvcrt, only ``all_files=True`` (no server
+    running) replays them.
+    """
+    if fcntl is None and msvcrt is None and not all_files:
+        return 0
+    config = get_config()
+    spool_dir = config["SPOOL_DIR"]
+    if not spool_dir.is_dir():
+        return 0
+
+    recovered = 0
+    for path in spool_dir.glob("journal-*.jsonl"):
+        try:
+            spool = open(path, "r+", encoding="utf-8")
+        except OSError:
+            continue
+        with spool:
+            if not _try_lock(spool):
+                continue
+            try:
+                if os.stat(path).st_ino != os.fstat(spool.fileno()).st_ino:
+                    continue
+            except FileNotFoundError:
+                # Replayed and removed by another process meanwhile
+                continue
+            try:
+                entries = [json.loads(line) for line in spool if line.strip()]
+                with transaction.atomic():
+                    if entries:
+                        _insert(entries, config["BATCH_SIZE"])
+                    # Emptied with the insert: whoever claims it next replays nothing
+                    spool.truncate(0)
+            except Exception:
+                logger.exception("Journal spool recovery failed for %s", path.name)
+                continue
+        # Closed first: Windows does not remove a file that is still open
+        path.unlink(missing_ok=True)
+        recovered += len(entries)
+    return recovered
+
+
+journal_sink = JournalSink()
+
+
+def flush_on_request_finished(sender, **kwargs):
+    if not get_config()["FLUSH_ON_REQUEST_END"] or not journal_sink._buffer:
+        return
+    journal_sink.flush()
+    close_old_connections()
+
+
+def connect_signals():
+    request_finished.connect(
+        flush_on_request_finished, dispatch_uid="journal_sink_flush"
+    )
+    atexit.register(journal_sink.close)
@@ -0,0 +1,290 @@
+"""Cached dashboard snapshots.
+
+The KPI payload is computed once per scope (a magasin and the user's
+service, or everything for superusers) and kept in the shared cache under a
+key built from the version stamps of core.cache. The stamps are bumped,
+after commit, when lots, movements or orders of the magasin / service
+change, or when the product catalogue changes; the date is part of the key
+too since the expiry counters depend on it. The orders overview per service is cached the same
+way and depends on orders and services only. Snapshots carry an ETag and a
+Last-Modified date so polling clients can be answered with 304 Not Modified.
+"""
+
+import hashlib
+import json
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, F, Q, Sum, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .cache import astamped_key, invalidate, register, stamped_key
+from .models import (
+    CommandeService,
+    LotProduit,
+    MouvementStock,
+    Produit,
+    Service,
+    StockSolde,
+)
+from .valuation import stock_value
+
+# Safety net for writes that bypass both signals and the stock ledger
+SNAPSHOT_TIMEOUT = 15 * 60
+NAMESPACE = "kpi"
+ALL = "all"
+CATALOGUE = "catalogue"
+COMMANDES = "commandes"
+PENDING_PREVIEW_SIZE = 5
+
+
+def _magasin_scopes(magasin_ids):
+    return [f"magasin:{m}" for m in magasin_ids if m is not None] + [ALL]
+
+
+def invalidate_magasins(magasin_ids):
+    invalidate(_magasin_scopes(magasin_ids))
+
+
+def _scopes(magasin, service):
+    if magasin is None:
+        return [ALL, CATALOGUE]
+    scopes = [f"magasin:{magasin.pk}", CATALOGUE]
+    if service is not None:
+        scopes.append(f"service:{service.pk}")
+    return scopes
+
+
+def compute_kpis(magasin=None, service=None):
+    """Compute the dashboard KPIs of ``magasin`` (every magasin if None)."""
+    today = timezone.now().date()
+    thirty_days = today + timezone.timedelta(days=30)
+
+    total_stock_value = stock_value(magasin)
+
+    products_with_stock_query = StockSolde.objects.filter(quantite_totale__gt=0)
+    if magasin:
+        products_with_stock_query = products_with_stock_query.filter(magasin=magasin)
+    products_with_stock = products_with_stock_query.values("produit").distinct().count()
+
+    total_products = Produit.objects.filter(actif=True).count()
+    ruptures_count = total_products - products_with_stock
+
+    # Exact day counts, both in one query over lot_magasin_peremption_idx
+    # (the weekly expiry buckets are for the calendar, see peremption.py)
+    expiring_query = LotProduit.objects.filter(
+        date_peremption__lte=today + timezone.timedelta(days=90),
+        date_peremption__gte=today,
+        quantite_actuelle__gt=0,
+    )
+    if magasin:
+        expiring_query = expiring_query.filter(magasin=magasin)
+    expiring_counts = expiring_query.aggregate(
+        lots_30=Count("id", filter=Q(date_peremption__lte=thirty_days)),
+        lots_90=Count("id"),
+    )
+    lots_expiring_30 = expiring_counts["lots_30"]
+    lots_expiring_90 = expiring_counts["lots_90"]
+
+    low_stock_products = []
+    low_stock_query = Produit.objects.filter(actif=True)
+    if magasin:
+        low_stock_query = low_stock_query.annotate(
+            stock_total=Sum(
+                "soldes__quantite_totale",
+                filter=Q(soldes__magasin=magasin),
+            )
+        ).filter(stock_total__lt=F("stock_securite"), stock_securite__gt=0)[:10]
+    else:
+        low_stock_query = low_stock_query.annotate(
+            stock_total=Sum("soldes__quantite_totale")
+        ).filter(stock_total__lt=F("stock_securite"), stock_securite__gt=0)[:10]
+
+    for p in low_stock_query:
+        low_stock_products.append(
+            {
+                "id": p.id,
+                "denomination": p.denomination,
+                "stock_total": p.stock_total or 0,
+                "stock_securite": p.stock_securite,
+            }
+        )
+
+    expiring_lots = []
+    expiring_query = LotProduit.objects.filter(
+        date_peremption__lte=thirty_days,
+        date_peremption__gte=today,
+        quantite_actuelle__gt=0,
+    ).select_related("produit")
+    if magasin:
+        expiring_query = expiring_query.filter(magasin=magasin)
+    expiring = expiring_query[:10]
+
+    for lot in expiring:
+        expiring_lots.append(
+            {
+                "id": lot.id,
+                "produit_denomination": lot.produit.denomination,
+                "numero_lot": lot.numero_lot,
+                "quantite": lot.quantite_actuelle,
+                "date_peremption": lot.date_peremption,
+                "jours_restants": (lot.date_peremption - today).days,
+            }
+        )
+
+    pending_orders = CommandeService.objects.filter(
+        statut__in=["EN_ATTENTE", "VALIDEE"]
+    )
+    if magasin and service:
+        pending_orders = pending_orders.filter(service=service)
+    pending_orders = pending_orders.count()
+
+    return {
+        "stock_value": float(total_stock_value),
+        "ruptures_count": ruptures_count,
+        "total_products": total_products,
+        "products_with_stock": products_with_stock,
+        "lots_expiring_30_days": lots_expiring_30,
+        "lots_expiring_90_days": lots_expiring_90,
+        "low_stock_products": low_stock_products,
+        "expiring_lots": expiring_lots,
+        "pending_orders": pending_orders,
+    }
+
+
+def compute_orders_overview(magasin_id=None):
+    """Order counts per status and the first pending orders of each active
+    service (of ``magasin_id`` if given), in two queries."""
+    services = Service.objects.filter(actif=True)
+    if magasin_id is not None:
+        services = services.filter(magasin_id=magasin_id)
+    services = services.annotate(
+        total_commandes=Count("commandeservice"),
+        en_attente=Count(
+            "commandeservice", filter=Q(commandeservice__statut="EN_ATTENTE")
+        ),
+        validee=Count("commandeservice", filter=Q(commandeservice__statut="VALIDEE")),
+        en_cours=Count(
+            "commandeservice", filter=Q(commandeservice__statut="EN_COURS")
+        ),
+        livree=Count("commandeservice", filter=Q(commandeservice__statut="LIVREE")),
+        annulee=Count("commandeservice", filter=Q(commandeservice__statut="ANNULEE")),
+    ).order_by("nom")
+    services = list(services)
+
+    # The first pending orders of every service in one windowed query
+    pending = (
+        CommandeService.objects.filter(
+            service__in=[service.id for service in services],
+            statut__in=["EN_ATTENTE", "VALIDEE"],
+        )
+        .annotate(
+            rang=Window(RowNumber(), partition_by=F("service_id"), order_by=F("id").asc())
+        )
+        .filter(rang__lte=PENDING_PREVIEW_SIZE)
+        .order_by("service_id", "id")
+        .values("id", "numero_commande", "service_id", "statut", "date_demande")
+    )
+    pending_by_service = {}
+    for order in pending:
+        pending_by_service.setdefault(order["service_id"], []).append(order)
+
+    results = []
+    for service in services:
+        results.append(
+            {
+                "service_id": service.id,
+                "service_nom": service.nom,
+                "service_code": service.code_service,
+                "total_commandes": service.total_commandes,
+                "en_attente": service.en_attente,
+                "validee": service.validee,
+                "en_cours": service.en_cours,
+                "livree": service.livree,
+                "annulee": service.annulee,
+                "pending_orders": [
+                    {
+                        "id": order["id"],
+                        "numero_commande": order["numero_commande"],
+                        "service_nom": service.nom,
+                        "statut": order["statut"],
+                        "date_demande": order["date_demande"],
+                    }
+                    for order in pending_by_service.get(service.id, [])
+                ],
+            }
+        )
+
+    return {"magasins": results}
+
+
+def _snapshot(data, versions):
+    payload = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+    return {
+        "data": data,
+        "etag": hashlib.md5(payload.encode()).hexdigest(),
+        # Newest change stamp, truncated to seconds as in HTTP dates
+        "last_modified": datetime.fromtimestamp(
+            max(versions) // 10**9, tz=dt_timezone.utc
+        ),
+    }
+
+
+def _cached(name, scopes, compute):
+    today = timezone.now().date().isoformat()
+    key, versions = stamped_key(NAMESPACE, scopes, name, today)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = _snapshot(compute(), versions)
+        cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+async def _acached(name, scopes, compute):
+    today = timezone.now().date().isoformat()
+    key, versions = await astamped_key(NAMESPACE, scopes, name, today)
+    snapshot = await cache.aget(key)
+    if snapshot is None:
+        # The computation itself is synchronous ORM code
+        snapshot = _snapshot(await sync_to_async(compute)(), versions)
+        await cache.aset(key, snapshot, SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+def get_snapshot(magasin=None, service=None):
+    """Return the KPI snapshot {"data", "etag", "last_modified"} of the scope."""
+    return _cached(
+        "kpis", _scopes(magasin, service), lambda: compute_kpis(magasin, service)
+    )
+
+
+async def aget_snapshot(magasin=None, service=None):
+    """get_snapshot() for async views."""
+    return await _acached(
+        "kpis", _scopes(magasin, service), lambda: compute_kpis(magasin, service)
+    )
+
+
+def get_orders_overview(magasin_id=None):
+    """Return the cached compute_orders_overview() snapshot."""
+    return _cached(
+        f"orders:{magasin_id}", [COMMANDES], lambda: compute_orders_overview(magasin_id)
+    )
+
+
+register(LotProduit, lambda lot: _magasin_scopes([lot.magasin_id]))
+register(
+    MouvementStock,
+    lambda mouvement: _magasin_scopes(
+        [mouvement.magasin_source_id, mouvement.magasin_destination_id]
+    ),
+)
+register(
+    CommandeService,
+    lambda commande: [f"service:{commande.service_id}", ALL, COMMANDES],
+)
+register(Service, lambda service: [COMMANDES])
+register(Produit, lambda produit: [CATALOGUE])
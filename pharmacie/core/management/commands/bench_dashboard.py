@@ -0,0 +1,232 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What a dashboard client polls: the cached KPIs and two uncached lists
+DEFAULT_PATHS = ["/api/dashboard/kpis/", "/api/stock/", "/api/journals/"]
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    length = None
+    chunked = False
+    keep_alive = True
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "transfer-encoding" and "chunked" in value.lower():
+            chunked = True
+        elif name == "connection" and "close" in value.lower():
+            keep_alive = False
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif length:
+        await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def _client(host, port, paths, token, deadline, latencies, errors, offset):
+    reader = writer = None
+    index = offset
+    while time.perf_counter() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        request = (
+            f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+            f"Authorization: Bearer {token}\r\n\r\n"
+        ).encode()
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(request)
+            status, keep_alive = await _read_response(reader)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            errors.append("connection")
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.05)
+            continue
+        if status >= 400:
+            errors.append(status)
+        else:
+            latencies.append(time.perf_counter() - start)
+        # Sync workers close the connection after each response
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def _run_level(host, port, paths, token, clients, duration):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(
+        *[
+            _client(host, port, paths, token, deadline, latencies, errors, i)
+            for i in range(clients)
+        ]
+    )
+    return latencies, errors
+
+
+def _wait_for_port(host, port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError(f"The server exited with code {process.returncode}")
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f"The server did not listen on {host}:{port}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks how many concurrent dashboard clients the server sustains, "
+        "for each gunicorn profile (sync workers / uvicorn async workers)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--profiles",
+            default="sync,async",
+            help="SERVER_PROFILE values of gunicorn.conf.py to compare",
+        )
+        parser.add_argument(
+            "--clients",
+            default="1,10,25,50,100,200",
+            help="Comma separated numbers of concurrent clients",
+        )
+        parser.add_argument(
+            "--duration", type=float, default=10, help="Seconds per client level"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=2, help="Gunicorn workers per profile"
+        )
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument(
+            "--path",
+            action="append",
+            dest="paths",
+            help=f"Path polled by every client (repeatable, default: {DEFAULT_PATHS})",
+        )
+        parser.add_argument(
+            "--slo-ms",
+            type=float,
+            default=500,
+            help="p95 latency a level must stay under to count as sustained",
+        )
+        parser.add_argument(
+            "--base-url",
+            help="Benchmark an already running server instead of starting gunicorn",
+        )
+        parser.add_argument("--username", help="User to authenticate as (default: a superuser)")
+
+    def handle(self, *args, **options):
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        from core.models import Utilisateur
+
+        users = Utilisateur.objects.filter(is_active=True)
+        if options["username"]:
+            user = users.filter(username=options["username"]).first()
+        else:
+            user = users.filter(is_superuser=True).first()
+        if user is None:
+            raise CommandError("No user to authenticate as")
+        token = str(RefreshToken.for_user(user).access_token)
+
+        levels = [int(value) for value in options["clients"].split(",")]
+        paths = options["paths"] or DEFAULT_PATHS
+
+        if options["base_url"]:
+            url = urlsplit(options["base_url"])
+            self._bench(
+                "external", url.hostname, url.port or 80, paths, token, levels, options
+            )
+            return
+
+        for profile in options["profiles"].split(","):
+            env = dict(
+                os.environ,
+                SERVER_PROFILE=profile,
+                GUNICORN_BIND=f"127.0.0.1:{options['port']}",
+                GUNICORN_WORKERS=str(options["workers"]),
+            )
+            command = [
+                sys.executable, "-m", "gunicorn",
+                "--config", "gunicorn.conf.py",
+                "--access-logfile", "/dev/null",
+                "--error-logfile", "-",
+                "--log-level", "warning",
+            ]
+            self.stdout.write(f"Starting gunicorn ({profile}, {options['workers']} worker(s))...")
+            process = subprocess.Popen(
+                command, cwd=Path(settings.BASE_DIR), env=env
+            )
+            try:
+                _wait_for_port("127.0.0.1", options["port"], process)
+                self._bench(
+                    profile, "127.0.0.1", options["port"], paths, token, levels, options
+                )
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+
+    def _bench(self, label, host, port, paths, token, levels, options):
+        slo = options["slo_ms"] / 1000
+        sustained = 0
+        self.stdout.write(
+            f"{'profile':<9}{'clients':>8}{'req/s':>9}{'p50 ms':>9}"
+            f"{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+        )
+        for clients in levels:
+            latencies, errors = asyncio.run(
+                _run_level(host, port, paths, token, clients, options["duration"])
+            )
+            p95 = _percentile(latencies, 0.95)
+            self.stdout.write(
+                f"{label:<9}{clients:>8}{len(latencies) / options['duration']:>9.1f}"
+                f"{_percentile(latencies, 0.5) * 1000:>9.1f}{p95 * 1000:>9.1f}"
+                f"{_percentile(latencies, 0.99) * 1000:>9.1f}{len(errors):>8}"
+            )
+            if latencies and not errors and p95 <= slo:
+                sustained = clients
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{label}: sustains {sustained} concurrent client(s) "
+                f"with p95 <= {options['slo_ms']:.0f} ms and no errors"
+            )
+        )
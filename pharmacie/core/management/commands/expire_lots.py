@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from core.peremption import BATCH_SIZE, expirer_lots
+
+
+class Command(BaseCommand):
+    help = (
+        "Flips the expired DISPONIBLE lots to PERIME and records their PERIME "
+        "movements; meant to run every night (cron / Task Scheduler)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--date", help="Expire the lots expiring before this date (default: today)"
+        )
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        today = None
+        if options["date"]:
+            try:
+                today = parse_date(options["date"])
+            except ValueError:
+                today = None
+            if today is None:
+                raise CommandError(f"Date invalide: {options['date']}")
+
+        lots, quantite = expirer_lots(today=today, batch_size=options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(f"{lots} lot(s) passé(s) en PERIME, {quantite} unité(s)")
+        )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from core.journal_sink import recover_spool
+
+
+class Command(BaseCommand):
+    help = "Writes journal entries left in the spool files by stopped workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Replay the spool files even where they cannot be locked (server stopped)",
+        )
+
+    def handle(self, *args, **options):
+        count = recover_spool(all_files=options["all"])
+        self.stdout.write(self.style.SUCCESS(f"Recovered {count} journal entry(ies)"))
@@ -0,0 +1,65 @@
+import csv
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.catalogue_import import BATCH_SIZE, READERS, import_file
+
+
+class Command(BaseCommand):
+    help = "Imports the product catalogue from a CSV, JSON or JSON Lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import")
+        parser.add_argument(
+            "--format",
+            choices=sorted(READERS),
+            help="File format (default: from the file extension)",
+        )
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Validate and diff without writing",
+        )
+        parser.add_argument("--report", help="Write the rejected rows to this CSV file")
+
+    def handle(self, *args, **options):
+        path = Path(options["path"])
+        format = options["format"] or path.suffix.lstrip(".").lower()
+        if format not in READERS:
+            raise CommandError(f"Format non supporté: {format}")
+
+        self.stdout.write(f"Importing {path} ({format})...")
+        try:
+            with path.open("rb") as stream:
+                result = import_file(
+                    stream,
+                    format,
+                    batch_size=options["batch_size"],
+                    dry_run=options["dry_run"],
+                )
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            raise CommandError(str(e))
+
+        if options["report"]:
+            with open(options["report"], "w", newline="", encoding="utf-8") as report:
+                writer = csv.DictWriter(
+                    report, fieldnames=["ligne", "code_national", "erreur"]
+                )
+                writer.writeheader()
+                writer.writerows(result.erreurs)
+        else:
+            for erreur in result.erreurs[:50]:
+                self.stdout.write(
+                    f"  ligne {erreur['ligne']} ({erreur['code_national']}): "
+                    f"{erreur['erreur']}"
+                )
+
+        summary = (
+            f"{result.crees} créé(s), {result.mis_a_jour} mis à jour, "
+            f"{result.inchanges} inchangé(s), {result.rejetes} rejeté(s)"
+        )
+        if options["dry_run"]:
+            summary = f"[dry run] {summary}"
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,248 @@
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+PROFILES = ("legacy", "tuned")
+
+
+def _setup_django(profile, path):
+    """Configure Django in a spawned process for ``profile`` on the copy."""
+    os.environ["SQLITE_PROFILE"] = profile
+    import django
+
+    django.setup()
+    from django.conf import settings as worker_settings
+
+    worker_settings.DATABASES["default"]["NAME"] = path
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _prepare(profile, path, lots, stock):
+    """Create the hot lots the writers take from; returns their ids."""
+    _setup_django(profile, path)
+    from django.db import connections, transaction
+    from django.utils import timezone
+
+    from core.models import LotProduit, Magasin, Produit
+    from core.stock_ledger import SoldeDelta
+
+    magasin = Magasin.objects.filter(actif=True).first()
+    code = f"LOAD-{uuid.uuid4().hex[:8]}"
+    with transaction.atomic():
+        produit = Produit.objects.create(
+            code_national=code,
+            denomination="Load test",
+            forme_pharmaceutique="-",
+            dosage="-",
+            conditionnement="-",
+            unite_mesure="U",
+            actif=False,
+        )
+        delta = SoldeDelta()
+        ids = []
+        for i in range(lots):
+            lot = LotProduit.objects.create(
+                produit=produit,
+                magasin=magasin,
+                numero_lot=f"{code}-{i}",
+                date_peremption=timezone.now().date() + timezone.timedelta(days=365),
+                date_reception=timezone.now().date(),
+                quantite_initiale=stock,
+                quantite_actuelle=stock,
+            )
+            delta.add(lot)
+            ids.append(lot.pk)
+        delta.apply()
+    connections.close_all()
+    return produit.pk, magasin.pk, ids
+
+
+def _worker(profile, path, role, lot_ids, magasin_id, duration, seed):
+    """Run reads or writes for ``duration`` seconds, each one as a request:
+    connections are handled by close_old_connections() as Django's handler
+    does, so CONN_MAX_AGE applies."""
+    _setup_django(profile, path)
+    from django.db import OperationalError, close_old_connections, connections, transaction
+
+    from core.database import write_transaction
+    from core.kpi_snapshots import compute_kpis
+    from core.models import Journal, LotProduit, Magasin, MouvementStock
+    from core.sequences import next_numeros_mouvement
+    from core.stock_ledger import SoldeDelta
+    from core.stock_mutations import LotMutations, StockConflict, retry_on_conflict
+
+    rng = random.Random(seed)
+    # The legacy profile also stands for the previous code: plain BEGIN
+    begin = write_transaction if profile == "tuned" else transaction.atomic
+
+    @retry_on_conflict
+    def write():
+        with begin():
+            lot = LotProduit.objects.get(pk=rng.choice(lot_ids))
+            if lot.quantite_actuelle < 1:
+                return
+            delta = SoldeDelta()
+            mutations = LotMutations()
+            delta.remove(lot)
+            mutations.add(lot, quantite=-1)
+            mutations.apply()
+            delta.add(lot)
+            delta.apply()
+            (numero,) = next_numeros_mouvement(1)
+            MouvementStock.objects.create(
+                numero_mouvement=numero,
+                produit_id=lot.produit_id,
+                lot=lot,
+                type_mouvement="SORTIE_SERVICE",
+                quantite=1,
+                magasin_source_id=lot.magasin_id,
+            )
+
+    def read():
+        magasin = Magasin.objects.get(pk=magasin_id)
+        compute_kpis(magasin)
+        list(Journal.objects.select_related("utilisateur").order_by("-id")[:25])
+
+    operation = write if role == "write" else read
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        close_old_connections()
+        start = time.perf_counter()
+        try:
+            operation()
+        except (OperationalError, StockConflict):
+            errors += 1
+        else:
+            latencies.append(time.perf_counter() - start)
+        close_old_connections()
+    connections.close_all()
+    return role, latencies, errors
+
+
+def _check(profile, path, produit_id, lot_ids):
+    """Units taken (from the movements) and whether the lots, movements and
+    StockSolde rows agree."""
+    _setup_django(profile, path)
+    from django.db.models import Sum
+
+    from core.models import LotProduit, MouvementStock
+    from core.stock_ledger import check_soldes
+
+    taken = (
+        MouvementStock.objects.filter(lot_id__in=lot_ids).aggregate(total=Sum("quantite"))[
+            "total"
+        ]
+        or 0
+    )
+    remaining = (
+        LotProduit.objects.filter(pk__in=lot_ids).aggregate(total=Sum("quantite_actuelle"))[
+            "total"
+        ]
+        or 0
+    )
+    mismatches = [m for m in check_soldes() if m[0][0] == produit_id]
+    return taken, remaining, not mismatches
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test of the SQLite profiles: concurrent reader and writer processes "
+        "on a copy of the database, with the legacy defaults and the tuned profile"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--profiles", default=",".join(PROFILES), help="Profiles to compare"
+        )
+        parser.add_argument("--readers", type=int, default=4)
+        parser.add_argument("--writers", type=int, default=4)
+        parser.add_argument("--duration", type=float, default=10, help="Seconds per profile")
+        parser.add_argument("--lots", type=int, default=5, help="Number of hot lots")
+        parser.add_argument("--stock", type=int, default=100000, help="Units per lot")
+
+    def handle(self, *args, **options):
+        source = Path(settings.DATABASES["default"]["NAME"])
+        if connection.vendor != "sqlite":
+            raise CommandError("The default database is not SQLite")
+        # Creates the database from the shipped one if needed
+        connection.ensure_connection()
+        profiles = options["profiles"].split(",")
+        for profile in profiles:
+            if profile not in PROFILES:
+                raise CommandError(f"Unknown profile: {profile}")
+
+        context = multiprocessing.get_context("spawn")
+        workdir = Path(tempfile.mkdtemp(prefix="load-sqlite-"))
+        self.stdout.write(
+            f"{options['readers']} reader(s) and {options['writers']} writer(s) "
+            f"for {options['duration']:.0f}s on a copy of {source}"
+        )
+        self.stdout.write(
+            f"{'profile':<8}{'reads/s':>9}{'read p95':>10}{'writes/s':>10}"
+            f"{'write p95':>11}{'errors':>8}  consistent"
+        )
+        try:
+            for profile in profiles:
+                path = str(workdir / f"{profile}.sqlite3")
+                # Consistent copy, then the journal mode of the profile, which
+                # is stored in the file
+                with sqlite3.connect(source) as src, sqlite3.connect(path) as dst:
+                    src.backup(dst)
+                with sqlite3.connect(path) as db:
+                    db.execute(
+                        "PRAGMA journal_mode=%s" % ("WAL" if profile == "tuned" else "DELETE")
+                    )
+
+                with context.Pool(1) as pool:
+                    produit_id, magasin_id, lot_ids = pool.apply(
+                        _prepare, (profile, path, options["lots"], options["stock"])
+                    )
+                roles = ["read"] * options["readers"] + ["write"] * options["writers"]
+                with context.Pool(len(roles)) as pool:
+                    results = pool.starmap(
+                        _worker,
+                        [
+                            (profile, path, role, lot_ids, magasin_id, options["duration"], seed)
+                            for seed, role in enumerate(roles)
+                        ],
+                    )
+                with context.Pool(1) as pool:
+                    taken, remaining, consistent = pool.apply(
+                        _check, (profile, path, produit_id, lot_ids)
+                    )
+                consistent = consistent and remaining == options["lots"] * options["stock"] - taken
+
+                reads = [l for role, lats, _ in results if role == "read" for l in lats]
+                writes = [l for role, lats, _ in results if role == "write" for l in lats]
+                errors = sum(e for _, _, e in results)
+                duration = options["duration"]
+                self.stdout.write(
+                    f"{profile:<8}{len(reads) / duration:>9.1f}"
+                    f"{_percentile(reads, 0.95) * 1000:>8.1f}ms"
+                    f"{len(writes) / duration:>10.1f}"
+                    f"{_percentile(writes, 0.95) * 1000:>9.1f}ms{errors:>8}  "
+                    f"{'yes' if consistent else 'NO'}"
+                )
+                if not consistent:
+                    raise CommandError(f"{profile}: lots, movements and soldes disagree")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.stdout.write(self.style.SUCCESS("Done"))
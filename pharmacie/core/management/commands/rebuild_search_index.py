@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.product_search import index_produits
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the product search index (SQLite FTS5 table)"
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding product search index...")
+        with transaction.atomic():
+            count = index_produits()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} produit(s)"))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.stock_ledger import check_echeances, check_soldes, rebuild_soldes
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the StockSolde table and the expiry buckets from the lots "
+        "and checks them against the lots"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check-only",
+            action="store_true",
+            help="Only compare the table with the lots, do not rebuild it",
+        )
+
+    def handle(self, *args, **options):
+        if not options["check_only"]:
+            self.stdout.write("Rebuilding stock soldes...")
+            count = rebuild_soldes()
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} solde(s)"))
+
+        self.stdout.write("Checking stock soldes against lots...")
+        mismatches = check_soldes()
+        for (produit_id, magasin_id), expected, actual in mismatches:
+            self.stdout.write(
+                f"  produit={produit_id} magasin={magasin_id}: "
+                f"attendu={expected} trouvé={actual}"
+            )
+        echeances = check_echeances()
+        for (magasin_id, semaine), expected, actual in echeances:
+            self.stdout.write(
+                f"  échéance magasin={magasin_id} semaine={semaine}: "
+                f"attendu={expected} trouvé={actual}"
+            )
+        if mismatches or echeances:
+            raise CommandError(
+                f"{len(mismatches)} solde(s) et {len(echeances)} échéance(s) incorrect(s)"
+            )
+        self.stdout.write(
+            self.style.SUCCESS("Stock soldes and expiry buckets are consistent with lots")
+        )
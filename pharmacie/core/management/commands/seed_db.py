@@ -1,5 +1,12 @@
-from django.core.management.base import BaseCommand
+import multiprocessing
+import time
+
+import django
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
 from django.contrib.auth import get_user_model
+from django.db import connection, transaction
 from core.models import (
     Role,
     Permission,
@@ -8,7 +15,16 @@ from core.models import (
     Produit,
     LotProduit,
     Magasin,
+    Journal,
+    ReservationLot,
+    MouvementStock,
+    LigneCommandeService,
+    CommandeService,
+    StockSolde,
+    EcheancePeremption,
 )
+from core.stock_ledger import rebuild_soldes
+from core import synthetic
 from django.utils import timezone
 from datetime import datetime, timedelta
 import random
@@ -1143,13 +1159,61 @@ MAGASINS = [
 ]
 
 
+# Emptied with one statement per table: deleting them through the ORM
+# would load every row of a --scale database
+BULK_TABLES = (
+    Journal,
+    ReservationLot,
+    MouvementStock,
+    LigneCommandeService,
+    CommandeService,
+    StockSolde,
+    EcheancePeremption,
+    LotProduit,
+)
+
+
+def _generate(task):
+    """Generate one synthetic copy of the catalogue, possibly in a worker
+    process; ``task`` is (copy, days, seed, batch_size)."""
+    copy, days, seed, batch_size = task
+    context = synthetic.load_context()
+    return copy, synthetic.generate_copy(copy, MEDICATIONS, context, days, seed, batch_size)
+
+
 class Command(BaseCommand):
     help = "Seeds the database with realistic data"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scale",
+            type=int,
+            default=0,
+            help=(
+                "Add this many synthetic copies of the catalogue with their stock "
+                f"history (about {synthetic.ROWS_PER_COPY:,} rows each over two years)"
+            ),
+        )
+        parser.add_argument(
+            "--days", type=int, default=synthetic.DAYS, help="Days of history per copy"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=1, help="Processes generating the copies"
+        )
+        parser.add_argument("--batch-size", type=int, default=synthetic.BATCH_SIZE)
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+
     def handle(self, *args, **options):
+        if options["scale"] < 0 or options["days"] < 1 or options["workers"] < 1:
+            raise CommandError("--scale must be positive, --days and --workers at least 1")
+
         self.stdout.write("Clearing database...")
 
         # Clear all data
+        with transaction.atomic(), connection.cursor() as cursor:
+            tables = [model._meta.db_table for model in BULK_TABLES]
+            for sql in connection.ops.sql_flush(no_style(), tables):
+                cursor.execute(sql)
         LotProduit.objects.all().delete()
         Produit.objects.all().delete()
         Magasin.objects.all().delete()
@@ -1349,8 +1413,46 @@ class Command(BaseCommand):
             if (i + 1) % 10 == 0:
                 self.stdout.write(f"  Created {i + 1} produits...")
 
+        if options["scale"]:
+            self.generate(options)
+
+        self.stdout.write("Rebuilding stock soldes...")
+        rebuild_soldes()
+
         self.stdout.write(
             self.style.SUCCESS(
                 f"Successfully seeded database with {len(MEDICATIONS)} medications, {len(FOURNISSEURS)} fournisseurs, {len(SERVICES)} services, and {len(USERS)} users"
             )
         )
+
+    def generate(self, options):
+        """Add the synthetic copies 1 to --scale, in --workers processes."""
+        copies = range(1, options["scale"] + 1)
+        tasks = [
+            (copy, options["days"], options["seed"], options["batch_size"]) for copy in copies
+        ]
+        self.stdout.write(
+            f"Generating {len(copies)} synthetic copies of the catalogue "
+            f"({options['days']} days of history, {options['workers']} worker(s))..."
+        )
+        start = time.perf_counter()
+        total = 0
+
+        def report(copy, rows):
+            nonlocal total
+            total += rows
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f"  Copy {copy}: {rows:,} rows ({total:,} rows in {elapsed:.0f}s, "
+                f"{total / elapsed:,.0f} rows/s)"
+            )
+
+        if options["workers"] == 1:
+            for task in tasks:
+                report(*_generate(task))
+        else:
+            # Spawned processes set Django up before receiving their tasks
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(options["workers"], initializer=django.setup) as pool:
+                for result in pool.imap_unordered(_generate, tasks):
+                    report(*result)
@@ -0,0 +1,156 @@
+import multiprocessing
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.utils import timezone
+
+
+def _worker(lot_ids, operations, seed):
+    """Take one unit at a time from random lots; runs in a spawned process."""
+    import django
+
+    django.setup()
+    from core.database import write_transaction
+    from core.models import LotProduit
+    from core.stock_ledger import SoldeDelta
+    from core.stock_mutations import LotMutations, StockConflict, retry_on_conflict
+
+    rng = random.Random(seed)
+    attempts = 0
+
+    @retry_on_conflict
+    def take(lot_id):
+        nonlocal attempts
+        attempts += 1
+        with write_transaction():
+            lot = LotProduit.objects.select_for_update().get(pk=lot_id)
+            if lot.quantite_actuelle < 1:
+                return False
+            delta = SoldeDelta()
+            mutations = LotMutations()
+            delta.remove(lot)
+            mutations.add(lot, quantite=-1)
+            mutations.apply()
+            delta.add(lot)
+            delta.apply()
+            return True
+
+    taken = refused = failed = 0
+    start = time.perf_counter()
+    for _ in range(operations):
+        try:
+            if take(rng.choice(lot_ids)):
+                taken += 1
+            else:
+                refused += 1
+        except StockConflict:
+            failed += 1
+    elapsed = time.perf_counter() - start
+    connections.close_all()
+    return taken, refused, failed, attempts, elapsed
+
+
+class Command(BaseCommand):
+    help = (
+        "Stress test of concurrent stock mutations: worker processes take units "
+        "from the same lots, then the final quantities are checked"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument(
+            "--operations", type=int, default=200, help="Operations per worker"
+        )
+        parser.add_argument("--lots", type=int, default=1, help="Number of hot lots")
+        parser.add_argument(
+            "--stock",
+            type=int,
+            help="Initial quantity per lot (default: enough for every operation)",
+        )
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the test product and lots"
+        )
+
+    def handle(self, *args, **options):
+        from core.models import LotProduit, Magasin, Produit
+        from core.stock_ledger import SoldeDelta, check_soldes
+
+        workers = options["workers"]
+        operations = options["operations"]
+        stock = options["stock"] or workers * operations
+
+        magasin = Magasin.objects.filter(actif=True).first()
+        code = f"STRESS-{uuid.uuid4().hex[:8]}"
+        with transaction.atomic():
+            produit = Produit.objects.create(
+                code_national=code,
+                denomination="Stress test",
+                forme_pharmaceutique="-",
+                dosage="-",
+                conditionnement="-",
+                unite_mesure="U",
+                actif=False,
+            )
+            delta = SoldeDelta()
+            lots = []
+            for i in range(options["lots"]):
+                lot = LotProduit.objects.create(
+                    produit=produit,
+                    magasin=magasin,
+                    numero_lot=f"{code}-{i}",
+                    date_peremption=timezone.now().date() + timezone.timedelta(days=365),
+                    date_reception=timezone.now().date(),
+                    quantite_initiale=stock,
+                    quantite_actuelle=stock,
+                )
+                delta.add(lot)
+                lots.append(lot.pk)
+            delta.apply()
+
+        self.stdout.write(
+            f"{workers} worker(s) x {operations} operation(s) on {len(lots)} lot(s) "
+            f"of {stock} unit(s)..."
+        )
+        connections.close_all()
+        context = multiprocessing.get_context("spawn")
+        start = time.perf_counter()
+        with context.Pool(workers) as pool:
+            results = pool.starmap(
+                _worker, [(lots, operations, seed) for seed in range(workers)]
+            )
+        wall = time.perf_counter() - start
+
+        taken = sum(r[0] for r in results)
+        refused = sum(r[1] for r in results)
+        failed = sum(r[2] for r in results)
+        attempts = sum(r[3] for r in results)
+        remaining = sum(
+            LotProduit.objects.filter(pk__in=lots).values_list(
+                "quantite_actuelle", flat=True
+            )
+        )
+        mismatches = [m for m in check_soldes() if m[0][0] == produit.pk]
+
+        self.stdout.write(
+            f"taken {taken}, refused (empty) {refused}, failed {failed}, "
+            f"retries {attempts - taken - refused - failed}"
+        )
+        self.stdout.write(
+            f"{wall:.2f}s, {(taken + refused) / wall:.0f} operation(s)/s "
+            f"(workers' busy time {sum(r[4] for r in results):.2f}s)"
+        )
+        expected = stock * len(lots) - taken
+        if not options["keep"]:
+            produit.delete()
+        if remaining != expected or remaining < 0 or mismatches:
+            self.stderr.write(
+                self.style.ERROR(
+                    f"Lost updates: {remaining} unit(s) left, {expected} expected, "
+                    f"{len(mismatches)} StockSolde mismatch(es)"
+                )
+            )
+            raise SystemExit(1)
+        self.stdout.write(self.style.SUCCESS(f"OK: {remaining} unit(s) left as expected"))
@@ -0,0 +1,59 @@
+# Generated by Django 6.0.2 on 2026-10-18 17:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def build_soldes(apps, schema_editor):
+    LotProduit = apps.get_model("core", "LotProduit")
+    StockSolde = apps.get_model("core", "StockSolde")
+    rows = (
+        LotProduit.objects.filter(statut="DISPONIBLE")
+        .values("produit_id", "magasin_id")
+        .annotate(
+            totale=Sum("quantite_actuelle"),
+            reservee=Sum("quantite_reservee"),
+            lots=Count("id"),
+        )
+        .order_by()
+    )
+    StockSolde.objects.bulk_create(
+        [
+            StockSolde(
+                produit_id=row["produit_id"],
+                magasin_id=row["magasin_id"],
+                quantite_totale=row["totale"] or 0,
+                quantite_reservee=row["reservee"] or 0,
+                nombre_lots=row["lots"],
+            )
+            for row in rows
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_add_magasin_types'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSolde',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantite_totale', models.IntegerField(default=0)),
+                ('quantite_reservee', models.IntegerField(default=0)),
+                ('nombre_lots', models.IntegerField(default=0)),
+                ('date_modification', models.DateTimeField(auto_now=True)),
+                ('magasin', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='soldes', to='core.magasin')),
+                ('produit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='soldes', to='core.produit')),
+            ],
+            options={
+                'unique_together': {('produit', 'magasin')},
+            },
+        ),
+        migrations.RunPython(build_soldes, migrations.RunPython.noop),
+    ]
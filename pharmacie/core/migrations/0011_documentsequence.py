@@ -0,0 +1,25 @@
+# Generated by Django 6.0.2 on 2026-10-18 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_stocksolde'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=20)),
+                ('jour', models.DateField()),
+                ('valeur', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('prefix', 'jour')},
+            },
+        ),
+    ]
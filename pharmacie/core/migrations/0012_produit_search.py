@@ -0,0 +1,52 @@
+# Generated by Django 6.0.2 on 2026-10-18 18:05
+
+from django.db import migrations
+
+SEARCH_FIELDS = (
+    'denomination',
+    'dci',
+    'code_national',
+    'code_interne',
+    'denomination_commerciale',
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    columns = ', '.join(SEARCH_FIELDS)
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS core_produit_search "
+            f"USING fts5({columns}, tokenize = 'trigram')"
+        )
+        schema_editor.execute(
+            f"INSERT INTO core_produit_search (rowid, {columns}) "
+            f"SELECT id, {columns} FROM core_produit"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for field in SEARCH_FIELDS:
+            schema_editor.execute(
+                f'CREATE INDEX IF NOT EXISTS core_produit_{field}_trgm '
+                f'ON core_produit USING gin (UPPER({field}) gin_trgm_ops)'
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS core_produit_search')
+    elif vendor == 'postgresql':
+        for field in SEARCH_FIELDS:
+            schema_editor.execute(f'DROP INDEX IF EXISTS core_produit_{field}_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_documentsequence'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
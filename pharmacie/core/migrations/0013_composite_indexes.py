@@ -0,0 +1,49 @@
+# Generated by Django 6.0.2 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_produit_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='commandeservice',
+            index=models.Index(fields=['service', 'statut', 'date_demande'], name='commande_service_statut_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='journal',
+            index=models.Index(fields=['categorie', 'action', 'date_creation'], name='journal_categorie_action_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='journal',
+            index=models.Index(fields=['date_creation', 'id'], name='journal_date_creation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lotproduit',
+            index=models.Index(fields=['magasin', 'statut', 'produit'], name='lot_magasin_statut_prod_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lotproduit',
+            index=models.Index(fields=['magasin', 'date_peremption', 'quantite_actuelle'], name='lot_magasin_peremption_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lotproduit',
+            index=models.Index(condition=models.Q(('quantite_actuelle__gt', 0), ('statut', 'DISPONIBLE')), fields=['magasin', 'produit', 'date_peremption'], name='lot_disponible_fefo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mouvementstock',
+            index=models.Index(fields=['magasin_source', 'date_mouvement'], name='mouvement_source_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mouvementstock',
+            index=models.Index(fields=['magasin_destination', 'date_mouvement'], name='mouvement_destination_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='produit',
+            index=models.Index(fields=['denomination', 'id'], name='produit_denomination_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='journal',
+            name='action',
+            field=models.CharField(choices=[('CREATE', 'Creation'), ('UPDATE', 'Modification'), ('DELETE', 'Suppression'), ('VALIDATE', 'Validation'), ('ANNUL', 'Annulation'), ('LIVRE', 'Livraison'), ('RECEPTION', 'Reception'), ('IMPORT', 'Import')], max_length=20),
+        ),
+    ]
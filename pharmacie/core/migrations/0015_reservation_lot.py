@@ -0,0 +1,27 @@
+# Generated by Django 6.0.2 on 2026-10-18 10:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_journal_import_action'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReservationLot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantite', models.IntegerField()),
+                ('date_creation', models.DateTimeField(auto_now_add=True)),
+                ('ligne', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='core.lignecommandeservice')),
+                ('lot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='core.lotproduit')),
+            ],
+            options={
+                'unique_together': {('ligne', 'lot')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_reservation_lot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lotproduit',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 6.0.2 on 2026-10-18 11:20
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_echeances(apps, schema_editor):
+    LotProduit = apps.get_model("core", "LotProduit")
+    EcheancePeremption = apps.get_model("core", "EcheancePeremption")
+    buckets = defaultdict(lambda: [0, Decimal("0"), 0])
+    lots = LotProduit.objects.filter(
+        statut="DISPONIBLE", quantite_actuelle__gt=0
+    ).values_list("magasin_id", "date_peremption", "quantite_actuelle", "prix_unitaire_achat")
+    for magasin_id, date_peremption, quantite, prix in lots.iterator(chunk_size=2000):
+        semaine = date_peremption - timedelta(days=date_peremption.weekday())
+        bucket = buckets[(magasin_id, semaine)]
+        bucket[0] += quantite
+        bucket[1] += quantite * (prix or 0)
+        bucket[2] += 1
+    EcheancePeremption.objects.bulk_create(
+        [
+            EcheancePeremption(
+                magasin_id=magasin_id,
+                semaine=semaine,
+                quantite=quantite,
+                valeur=valeur,
+                nombre_lots=nombre_lots,
+            )
+            for (magasin_id, semaine), (quantite, valeur, nombre_lots) in buckets.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_lot_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EcheancePeremption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('semaine', models.DateField()),
+                ('quantite', models.IntegerField(default=0)),
+                ('valeur', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('nombre_lots', models.IntegerField(default=0)),
+                ('date_modification', models.DateTimeField(auto_now=True)),
+                ('magasin', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='echeances', to='core.magasin')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['semaine'], name='echeance_semaine_idx')],
+                'unique_together': {('magasin', 'semaine')},
+            },
+        ),
+        migrations.RunPython(build_echeances, migrations.RunPython.noop),
+    ]
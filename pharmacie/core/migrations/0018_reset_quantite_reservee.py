@@ -0,0 +1,48 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def reset_quantite_reservee(apps, schema_editor):
+    """Bring LotProduit.quantite_reservee back to the ReservationLot rows.
+
+    Before 0015 the field was written freely through the lot API; units
+    reserved that way have no order to release them, and would never be
+    offered again. The StockSolde reserved totals follow the lots.
+    """
+    LotProduit = apps.get_model("core", "LotProduit")
+    ReservationLot = apps.get_model("core", "ReservationLot")
+    StockSolde = apps.get_model("core", "StockSolde")
+
+    reservee = (
+        ReservationLot.objects.filter(lot=OuterRef("pk"))
+        .order_by()
+        .values("lot")
+        .annotate(total=Sum("quantite"))
+        .values("total")
+    )
+    LotProduit.objects.update(quantite_reservee=Coalesce(Subquery(reservee), Value(0)))
+
+    reservee = (
+        LotProduit.objects.filter(
+            statut="DISPONIBLE",
+            produit=OuterRef("produit"),
+            magasin=OuterRef("magasin"),
+        )
+        .order_by()
+        .values("produit")
+        .annotate(total=Sum("quantite_reservee"))
+        .values("total")
+    )
+    StockSolde.objects.update(quantite_reservee=Coalesce(Subquery(reservee), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_echeance_peremption'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_quantite_reservee, migrations.RunPython.noop),
+    ]
@@ -10,3 +10,6 @@ from .lignes_commandes import *
 from .utilisateurs import *
 from .roles import *
 from .journal import *
+from .soldes import *
+from .sequences import *
+from .reservations import *
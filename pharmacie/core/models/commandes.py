@@ -19,5 +19,13 @@ class CommandeService(BaseModel):
 
     date_demande = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["service", "statut", "date_demande"],
+                name="commande_service_statut_idx",
+            ),
+        ]
+
     def __str__(self):
         return self.numero_commande
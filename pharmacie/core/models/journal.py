@@ -19,6 +19,7 @@ class Journal(BaseModel):
         ('ANNUL', 'Annulation'),
         ('LIVRE', 'Livraison'),
         ('RECEPTION', 'Reception'),
+        ('IMPORT', 'Import'),
     ]
 
     categorie = models.CharField(max_length=20, choices=CATEGORIES)
@@ -45,6 +46,13 @@ class Journal(BaseModel):
     class Meta:
         app_label = 'core'
         ordering = ['-date_creation']
+        indexes = [
+            models.Index(
+                fields=['categorie', 'action', 'date_creation'],
+                name='journal_categorie_action_idx',
+            ),
+            models.Index(fields=['date_creation', 'id'], name='journal_date_creation_idx'),
+        ]
         verbose_name = 'Journal'
         verbose_name_plural = 'Journals'
 
@@ -39,5 +39,17 @@ class MouvementStock(BaseModel):
 
     date_mouvement = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["magasin_source", "date_mouvement"],
+                name="mouvement_source_date_idx",
+            ),
+            models.Index(
+                fields=["magasin_destination", "date_mouvement"],
+                name="mouvement_destination_idx",
+            ),
+        ]
+
     def __str__(self):
         return f"{self.numero_mouvement} - {self.type_mouvement}"
@@ -68,5 +68,10 @@ class Produit(BaseModel):
 
     actif = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["denomination", "id"], name="produit_denomination_idx"),
+        ]
+
     def __str__(self):
         return f"{self.denomination} ({self.dosage})"
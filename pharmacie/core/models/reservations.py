@@ -0,0 +1,24 @@
+from django.db import models
+
+
+class ReservationLot(models.Model):
+    """Units of a lot set aside for an order line, from validation to delivery.
+
+    LotProduit.quantite_reservee is the sum of the reservations of the lot.
+    """
+
+    ligne = models.ForeignKey(
+        "LigneCommandeService", on_delete=models.CASCADE, related_name="reservations"
+    )
+    lot = models.ForeignKey(
+        "LotProduit", on_delete=models.CASCADE, related_name="reservations"
+    )
+    quantite = models.IntegerField()
+
+    date_creation = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("ligne", "lot")
+
+    def __str__(self):
+        return f"{self.ligne_id} <- {self.lot_id}: {self.quantite}"
@@ -38,7 +38,6 @@ class Role(models.Model):
         return self.name
     
     def has_permission(self, resource, action):
-        return self.permissions.filter(
-            resource=resource,
-            **{f'can_{action}': True}
-        ).exists()
+        from core.permission_matrix import role_has_permission
+
+        return role_has_permission(self.pk, resource, action)
@@ -0,0 +1,15 @@
+from django.db import models
+
+
+class DocumentSequence(models.Model):
+    """Last number issued for a document prefix (CMD, MVT, ...) on a given day."""
+
+    prefix = models.CharField(max_length=20)
+    jour = models.DateField()
+    valeur = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("prefix", "jour")
+
+    def __str__(self):
+        return f"{self.prefix}-{self.jour:%Y%m%d}: {self.valeur}"
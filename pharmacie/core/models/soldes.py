@@ -0,0 +1,65 @@
+from django.db import models
+
+
+class StockSolde(models.Model):
+    """Stock balance per (produit, magasin), maintained from LotProduit writes.
+
+    Only DISPONIBLE lots contribute, matching what the stock endpoints display.
+    """
+
+    produit = models.ForeignKey(
+        "Produit", on_delete=models.CASCADE, related_name="soldes"
+    )
+    magasin = models.ForeignKey(
+        "Magasin",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="soldes",
+    )
+
+    quantite_totale = models.IntegerField(default=0)
+    quantite_reservee = models.IntegerField(default=0)
+    nombre_lots = models.IntegerField(default=0)
+
+    date_modification = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("produit", "magasin")
+
+    @property
+    def quantite_disponible(self):
+        return self.quantite_totale - self.quantite_reservee
+
+    def __str__(self):
+        return f"{self.produit_id}@{self.magasin_id}: {self.quantite_disponible}"
+
+
+class EcheancePeremption(models.Model):
+    """Stock expiring in a given week (semaine = Monday) per magasin.
+
+    Only DISPONIBLE lots with a positive quantity count; maintained with
+    StockSolde by the stock ledger. valeur uses prix_unitaire_achat.
+    """
+
+    magasin = models.ForeignKey(
+        "Magasin",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="echeances",
+    )
+    semaine = models.DateField()
+
+    quantite = models.IntegerField(default=0)
+    valeur = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    nombre_lots = models.IntegerField(default=0)
+
+    date_modification = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("magasin", "semaine")
+        indexes = [models.Index(fields=["semaine"], name="echeance_semaine_idx")]
+
+    def __str__(self):
+        return f"{self.magasin_id}@{self.semaine}: {self.quantite}"
@@ -24,8 +24,32 @@ class LotProduit(BaseModel):
         max_digits=15, decimal_places=2, blank=True, null=True
     )
 
+    # Bumped on every write, see core/stock_mutations.py
+    version = models.PositiveIntegerField(default=0)
+
     class Meta:
         unique_together = ("produit", "numero_lot", "magasin")
+        indexes = [
+            models.Index(
+                fields=["magasin", "statut", "produit"],
+                name="lot_magasin_statut_prod_idx",
+            ),
+            models.Index(
+                fields=["magasin", "date_peremption", "quantite_actuelle"],
+                name="lot_magasin_peremption_idx",
+            ),
+            # FEFO allocation: available lots of a product, by expiry date
+            models.Index(
+                fields=["magasin", "produit", "date_peremption"],
+                name="lot_disponible_fefo_idx",
+                condition=models.Q(statut="DISPONIBLE", quantite_actuelle__gt=0),
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            self.version += 1
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.produit} - Lot {self.numero_lot}"
@@ -48,6 +48,8 @@ class Utilisateur(AbstractUser):
         """Check if user has specific permission"""
         if self.is_superuser:
             return True
-        if self.role:
-            return self.role.has_permission(resource, action)
+        if self.role_id:
+            from core.permission_matrix import role_has_permission
+
+            return role_has_permission(self.role_id, resource, action)
         return False
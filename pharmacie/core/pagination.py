@@ -1,6 +1,221 @@
 # core/pagination.py
+"""Keyset (cursor) pagination for the large list endpoints.
+
+Cursor mode is opt-in: a request that carries a ``cursor`` query parameter
+(empty for the first page) is paginated by seeking on its ordering key, e.g.
+``WHERE (date_creation, id) < (last_date, last_id)``, instead of
+``OFFSET``/``COUNT``. The response has ``next``/``previous`` links and no
+count; pass ``approximate_count=1`` to get an estimate in the
+``X-Approximate-Count`` header.
+"""
+
+import base64
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+CURSOR_PARAM = "cursor"
+APPROXIMATE_COUNT_PARAM = "approximate_count"
+APPROXIMATE_COUNT_HEADER = "X-Approximate-Count"
+# Above this many rows backends without a planner estimate report the cap
+APPROXIMATE_COUNT_CAP = 10000
+MAX_PAGE_SIZE = 1000
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor=None, previous_cursor=None,
+                 approximate_count=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.approximate_count = approximate_count
+
+
+def wants_keyset(request):
+    return CURSOR_PARAM in request.query_params
+
+
+def encode_cursor(values, reverse=False):
+    payload = json.dumps({"v": values, "r": reverse}, default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(token):
+    """Return (values, reverse), or (None, False) for the first page."""
+    if not token:
+        return None, False
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode()))
+        values, reverse = payload["v"], bool(payload["r"])
+        if not isinstance(values, list) or not all(
+            isinstance(value, (str, int, float)) for value in values
+        ):
+            raise TypeError
+    except (ValueError, TypeError, KeyError):
+        raise ValidationError({"error": "Curseur invalide"})
+    return values, reverse
+
+
+def _flip(field):
+    return field[1:] if field.startswith("-") else f"-{field}"
+
+
+def _key(obj, ordering):
+    values = []
+    for field in ordering:
+        value = obj
+        for part in field.lstrip("-").split("__"):
+            value = getattr(value, part)
+        values.append(value)
+    return values
+
+
+def seek_filter(ordering, values, reverse=False):
+    """Rows strictly after ``values`` in ``ordering`` (before, if ``reverse``)."""
+    query = Q()
+    equal = {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip("-")
+        lookup = "lt" if field.startswith("-") != reverse else "gt"
+        query |= Q(**equal, **{f"{name}__{lookup}": value})
+        equal[name] = value
+    return query
+
+
+def keyset_ordering(queryset, pk="id"):
+    """Ordering of ``queryset`` usable as a keyset, ending with ``pk``.
+
+    Only non-nullable local fields can be sought on; any other ordering
+    falls back to the primary key.
+    """
+    ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+    fields = []
+    for field in ordering:
+        name = field.lstrip("-") if isinstance(field, str) else None
+        if name in (pk, "pk"):
+            fields.append(field.replace("pk", pk) if name == "pk" else field)
+            return fields
+        try:
+            model_field = queryset.model._meta.get_field(name)
+        except Exception:
+            return [pk]
+        if model_field.is_relation or model_field.null:
+            return [pk]
+        fields.append(field)
+    descending = bool(fields) and fields[0].startswith("-")
+    return fields + [f"-{pk}" if descending else pk]
+
+
+def approximate_count(queryset):
+    """Estimate the number of rows of ``queryset`` without a full COUNT.
+
+    PostgreSQL reports the planner's estimate; other backends count at most
+    APPROXIMATE_COUNT_CAP rows.
+    """
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    if connection.vendor == "postgresql":
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    return queryset[:APPROXIMATE_COUNT_CAP].count()
+
+
+def get_page_size(request, default, maximum=MAX_PAGE_SIZE):
+    try:
+        page_size = int(request.query_params.get("page_size", default))
+    except ValueError:
+        page_size = default
+    return max(1, min(page_size, maximum))
+
+
+def _seek(queryset, request, ordering):
+    """``queryset`` ordered and filtered for the request's cursor; returns
+    (queryset, cursor values, reverse)."""
+    values, reverse = decode_cursor(request.query_params.get(CURSOR_PARAM))
+    if values is not None and len(values) != len(ordering):
+        raise ValidationError({"error": "Curseur invalide"})
+
+    if reverse:
+        queryset = queryset.order_by(*[_flip(field) for field in ordering])
+    else:
+        queryset = queryset.order_by(*ordering)
+    if values is not None:
+        try:
+            queryset = queryset.filter(seek_filter(ordering, values, reverse))
+        except (ValueError, TypeError, DjangoValidationError):
+            # Values that do not convert to the fields' types
+            raise ValidationError({"error": "Curseur invalide"})
+    return queryset, values, reverse
+
+
+def _wants_count(request):
+    return request.query_params.get(APPROXIMATE_COUNT_PARAM) in ("1", "true")
+
+
+def _page(items, ordering, page_size, values, reverse, count):
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    if reverse:
+        items.reverse()
+
+    next_cursor = previous_cursor = None
+    if items:
+        if has_more or reverse:
+            next_cursor = encode_cursor(_key(items[-1], ordering))
+        if values is not None and (has_more or not reverse):
+            previous_cursor = encode_cursor(_key(items[0], ordering), reverse=True)
+    return KeysetPage(items, next_cursor, previous_cursor, count)
+
+
+def paginate_keyset(queryset, request, ordering, page_size):
+    """Return the KeysetPage of ``queryset`` selected by the request's cursor."""
+    seek, values, reverse = _seek(queryset, request, ordering)
+    count = approximate_count(queryset) if _wants_count(request) else None
+    items = list(seek[: page_size + 1])
+    return _page(items, ordering, page_size, values, reverse, count)
+
+
+async def apaginate_keyset(queryset, request, ordering, page_size):
+    """paginate_keyset() for async views."""
+    seek, values, reverse = _seek(queryset, request, ordering)
+    count = None
+    if _wants_count(request):
+        count = await sync_to_async(approximate_count)(queryset)
+    items = [obj async for obj in seek[: page_size + 1]]
+    return _page(items, ordering, page_size, values, reverse, count)
+
+
+def _link(request, cursor):
+    if cursor is None:
+        return None
+    url = request.build_absolute_uri()
+    return replace_query_param(remove_query_param(url, "page"), CURSOR_PARAM, cursor)
+
+
+def keyset_response(request, page, results, response_class=Response):
+    response = response_class(
+        {
+            "next": _link(request, page.next_cursor),
+            "previous": _link(request, page.previous_cursor),
+            "results": results,
+        }
+    )
+    if page.approximate_count is not None:
+        response[APPROXIMATE_COUNT_HEADER] = page.approximate_count
+    return response
+
 
 class ReactAdminPagination(PageNumberPagination):
     page_size_query_param = "perPage"
@@ -0,0 +1,158 @@
+"""Expiry calendar and nightly expiry of lots.
+
+The calendar is read from the EcheancePeremption buckets (quantity, value
+and lot count of the DISPONIBLE stock expiring each week, per magasin),
+which the stock ledger keeps up to date, so any horizon costs one small
+grouped query. Horizons are rounded up to whole weeks.
+
+expirer_lots() flips the DISPONIBLE lots whose expiry date has passed to
+PERIME, releases their reservations and records one PERIME movement per lot
+with stock, in batches.
+"""
+
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Sum
+from django.utils import timezone
+
+from .database import write_transaction
+from .journal_sink import journal_sink
+from .models import EcheancePeremption, LotProduit, MouvementStock, ReservationLot
+from .sequences import next_numeros_mouvement
+from .stock_ledger import SoldeDelta, semaine
+from .stock_mutations import LotMutations, retry_on_conflict
+
+HORIZONS = (30, 90)
+MAX_HORIZON = 5 * 365
+BATCH_SIZE = 1000
+
+
+def _bucket(row):
+    return {
+        "quantite": row["quantite"] or 0,
+        "valeur": (row["valeur"] or Decimal("0")).quantize(Decimal("0.01")),
+        "nombre_lots": row["nombre_lots"] or 0,
+    }
+
+
+def calendrier(magasin=None, horizons=HORIZONS, today=None):
+    """Expiring stock of ``magasin`` (every magasin if None) per week up to
+    the largest horizon, and cumulated for each horizon (in days).
+
+    "en_retard" is the stock of lots already expired but not flipped to
+    PERIME yet.
+    """
+    today = today or timezone.now().date()
+    debut = semaine(today)
+    fin = semaine(today + timedelta(days=max(horizons)))
+
+    buckets = EcheancePeremption.objects.filter(semaine__lte=fin, nombre_lots__gt=0)
+    if magasin is not None:
+        buckets = buckets.filter(magasin=magasin)
+    rows = list(
+        buckets.values("semaine")
+        .annotate(
+            quantite=Sum("quantite"),
+            valeur=Sum("valeur"),
+            nombre_lots=Sum("nombre_lots"),
+        )
+        .order_by("semaine")
+    )
+
+    en_retard = {"quantite": 0, "valeur": Decimal("0.00"), "nombre_lots": 0}
+    semaines = []
+    for row in rows:
+        if row["semaine"] < debut:
+            for field, value in _bucket(row).items():
+                en_retard[field] += value
+        else:
+            semaines.append({"semaine": row["semaine"], **_bucket(row)})
+
+    resultats = []
+    for jours in sorted(set(horizons)):
+        limite = semaine(today + timedelta(days=jours))
+        total = {"quantite": 0, "valeur": Decimal("0.00"), "nombre_lots": 0}
+        for row in semaines:
+            if row["semaine"] <= limite:
+                for field in total:
+                    total[field] += row[field]
+        resultats.append(
+            {"jours": jours, "jusqu_au": limite + timedelta(days=6), **total}
+        )
+
+    return {
+        "date": today,
+        "horizons": resultats,
+        "semaines": semaines,
+        "en_retard": en_retard,
+    }
+
+
+@retry_on_conflict
+def _expirer_batch(today, batch_size, utilisateur=None):
+    with write_transaction():
+        lots = list(
+            LotProduit.objects.select_for_update()
+            .filter(statut="DISPONIBLE", date_peremption__lt=today)
+            .order_by("id")[:batch_size]
+        )
+        if not lots:
+            return 0, 0
+
+        delta = SoldeDelta()
+        mutations = LotMutations()
+        for lot in lots:
+            delta.remove(lot)
+            if lot.quantite_reservee:
+                mutations.add(lot, reservee=-lot.quantite_reservee)
+            mutations.set_statut(lot, "PERIME")
+        ReservationLot.objects.filter(lot__in=lots).delete()
+        mutations.apply()
+
+        perimes = [lot for lot in lots if lot.quantite_actuelle > 0]
+        mouvements = [
+            MouvementStock(
+                numero_mouvement=numero,
+                produit_id=lot.produit_id,
+                lot=lot,
+                type_mouvement="PERIME",
+                quantite=lot.quantite_actuelle,
+                magasin_source_id=lot.magasin_id,
+            )
+            for lot, numero in zip(perimes, next_numeros_mouvement(len(perimes)))
+        ]
+        MouvementStock.objects.bulk_create(mouvements)
+
+        for lot in lots:
+            delta.add(lot)
+        delta.apply()
+
+        quantite = sum(lot.quantite_actuelle for lot in perimes)
+        journal_sink.write(
+            {
+                "categorie": "STOCK",
+                "action": "UPDATE",
+                "description": (
+                    f"Péremption: {len(lots)} lot(s) passé(s) en PERIME, "
+                    f"{quantite} unité(s)"
+                ),
+                "utilisateur_id": getattr(utilisateur, "pk", None),
+                "entity_type": "LotProduit",
+                "nouveau_statut": "PERIME",
+                "details": {"lots": [lot.pk for lot in lots], "quantite": quantite},
+            }
+        )
+        return len(lots), quantite
+
+
+def expirer_lots(today=None, batch_size=BATCH_SIZE, utilisateur=None):
+    """Flip every expired DISPONIBLE lot to PERIME; returns (lots, quantite)."""
+    today = today or timezone.now().date()
+    total_lots = total_quantite = 0
+    while True:
+        lots, quantite = _expirer_batch(today, batch_size, utilisateur)
+        if not lots:
+            return total_lots, total_quantite
+        total_lots += lots
+        total_quantite += quantite
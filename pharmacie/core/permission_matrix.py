@@ -0,0 +1,72 @@
+"""Compiled permission matrix per role, cached in the Django cache.
+
+A role's matrix maps each resource to the frozenset of actions ("view",
+"add", "change", "delete") its permissions grant. It is loaded with one
+query and cached in the shared cache under a key stamped with the
+"permissions" scope of core.cache; any change to a Permission row or to a
+role's permissions invalidates that scope.
+"""
+
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed
+
+from . import cache as project_cache
+from .models import Permission, Role
+
+ACTIONS = ("view", "add", "change", "delete")
+NAMESPACE = "permissions"
+SCOPE = "permissions"
+CACHE_TIMEOUT = 60 * 60
+
+
+def invalidate(**kwargs):
+    """Invalidate every cached matrix (usable as a signal receiver)."""
+    project_cache.invalidate([SCOPE])
+
+
+def _invalidate_m2m(action, **kwargs):
+    if action.startswith("post_"):
+        invalidate()
+
+
+def load_matrix(role_id):
+    """Build the matrix of ``role_id`` from the database."""
+    matrix = defaultdict(set)
+    rows = Permission.objects.filter(roles__id=role_id).values_list(
+        "resource", *(f"can_{action}" for action in ACTIONS)
+    )
+    for resource, *flags in rows:
+        for action, granted in zip(ACTIONS, flags):
+            if granted:
+                matrix[resource].add(action)
+    return {resource: frozenset(actions) for resource, actions in matrix.items()}
+
+
+def get_matrix(role_id):
+    """Return the cached matrix of ``role_id`` ({} for no role)."""
+    if role_id is None:
+        return {}
+    key, _ = project_cache.stamped_key(NAMESPACE, [SCOPE], role_id)
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = load_matrix(role_id)
+        cache.set(key, matrix, CACHE_TIMEOUT)
+    return matrix
+
+
+def role_has_permission(role_id, resource, action):
+    return action in get_matrix(role_id).get(resource, ())
+
+
+project_cache.register(Permission, lambda permission: [SCOPE])
+project_cache.register(Role, lambda role: [SCOPE])
+
+
+def connect_signals():
+    m2m_changed.connect(
+        _invalidate_m2m,
+        sender=Role.permissions.through,
+        dispatch_uid="permission_matrix_m2m",
+    )
@@ -0,0 +1,172 @@
+"""Indexed, ranked product search.
+
+Every word of the search term must appear (case-insensitively, anywhere)
+in one of SEARCH_FIELDS.
+
+- SQLite: an FTS5 shadow table using the trigram tokenizer (substring
+  matches, ranked with bm25), keyed by the product id and kept in sync by
+  the Produit post_save / post_delete signals. Bulk writes that bypass
+  signals must call index_produits() (or run rebuild_search_index).
+- PostgreSQL: trigram GIN indexes on UPPER(column) serve Django's
+  icontains lookups; results are ranked by trigram word similarity.
+
+Words shorter than three characters cannot use a trigram index and fall
+back to a plain icontains filter, as do other database backends.
+"""
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+
+from .models import Produit
+
+SEARCH_FIELDS = (
+    "denomination",
+    "dci",
+    "code_national",
+    "code_interne",
+    "denomination_commerciale",
+)
+FTS_TABLE = "core_produit_search"
+MIN_WORD_LENGTH = 3
+INSERT_SQL = (
+    f"INSERT INTO {FTS_TABLE} (rowid, {', '.join(SEARCH_FIELDS)}) "
+    f"VALUES (%s, {', '.join(['%s'] * len(SEARCH_FIELDS))})"
+)
+
+_fts_tables = {}
+
+
+def _fts_available(using="default"):
+    """Whether the SQLite FTS5 table exists (cached per database alias)."""
+    conn = connections[using]
+    if conn.vendor != "sqlite":
+        return False
+    if using not in _fts_tables:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+                [FTS_TABLE],
+            )
+            _fts_tables[using] = cursor.fetchone() is not None
+    return _fts_tables[using]
+
+
+async def aprepare_search(using="default"):
+    """Run the one-time FTS table lookup of search_filter() from async code,
+    where the synchronous query is not allowed."""
+    if using not in _fts_tables and connections[using].vendor == "sqlite":
+        await sync_to_async(_fts_available)(using)
+
+
+def _icontains(word, prefix):
+    query = Q()
+    for field in SEARCH_FIELDS:
+        query |= Q(**{f"{prefix}{field}__icontains": word})
+    return query
+
+
+def _fts_query(words):
+    return " AND ".join('"{}"'.format(word.replace('"', '""')) for word in words)
+
+
+def search_filter(term, prefix="", using="default"):
+    """Q object matching products for ``term``.
+
+    ``prefix`` is the path to the product from the filtered model, e.g.
+    "produit__" for lots.
+    """
+    words = term.split()
+    indexed = [w for w in words if len(w) >= MIN_WORD_LENGTH]
+    query = Q()
+    for word in words:
+        if word not in indexed or not _fts_available(using):
+            query &= _icontains(word, prefix)
+    if indexed and _fts_available(using):
+        query &= Q(
+            **{
+                f"{prefix}id__in": RawSQL(
+                    f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+                    [_fts_query(indexed)],
+                )
+            }
+        )
+    return query
+
+
+def search_rank(term, using="default"):
+    """Expression ranking a Produit queryset for ``term`` (higher is better)."""
+    words = [w for w in term.split() if len(w) >= MIN_WORD_LENGTH]
+    vendor = connections[using].vendor
+    if words and _fts_available(using):
+        table = Produit._meta.db_table
+        return RawSQL(
+            f"SELECT -bm25({FTS_TABLE}) FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH %s AND {FTS_TABLE}.rowid = {table}.id",
+            [_fts_query(words)],
+            output_field=FloatField(),
+        )
+    if words and vendor == "postgresql":
+        from django.contrib.postgres.search import TrigramWordSimilarity
+        from django.db.models.functions import Greatest
+
+        return Greatest(
+            *[TrigramWordSimilarity(term, field) for field in SEARCH_FIELDS],
+            output_field=FloatField(),
+        )
+    return Value(0.0, output_field=FloatField())
+
+
+def search_produits(queryset, term):
+    """Filter a Produit queryset by ``term`` and annotate ``search_rank``."""
+    using = queryset.db
+    return queryset.filter(search_filter(term, using=using)).annotate(
+        search_rank=search_rank(term, using=using)
+    )
+
+
+def index_produits(produits=None, using="default"):
+    """(Re)index ``produits`` in the FTS table, or every product if None."""
+    if not _fts_available(using):
+        return 0
+    rows = Produit.objects.using(using).values_list("id", *SEARCH_FIELDS)
+    delete_sql, delete_params = f"DELETE FROM {FTS_TABLE}", []
+    if produits is not None:
+        ids = [p.pk for p in produits]
+        if not ids:
+            return 0
+        rows = rows.filter(pk__in=ids)
+        delete_sql += " WHERE rowid IN (%s)" % ", ".join(["%s"] * len(ids))
+        delete_params = ids
+
+    rows = list(rows)
+    with connections[using].cursor() as cursor:
+        cursor.execute(delete_sql, delete_params)
+        cursor.executemany(INSERT_SQL, rows)
+    return len(rows)
+
+
+def _index_saved(sender, instance, using, **kwargs):
+    if not _fts_available(using):
+        return
+    values = [getattr(instance, field) for field in SEARCH_FIELDS]
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [instance.pk])
+        cursor.execute(INSERT_SQL, [instance.pk, *values])
+
+
+def _unindex_deleted(sender, instance, using, **kwargs):
+    if not _fts_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [instance.pk])
+
+
+def connect_signals():
+    post_save.connect(_index_saved, sender=Produit, dispatch_uid="product_search_save")
+    post_delete.connect(
+        _unindex_deleted, sender=Produit, dispatch_uid="product_search_delete"
+    )
+
@@ -0,0 +1,447 @@
+"""Per-request profiling: queries, DB time, serialization time, total time.
+
+ProfilingMiddleware opens a RequestProfile for each request. The database
+backends of core/backends add every query they execute (count and
+duration) and every connection they open to the profile of the current
+request, whichever thread runs the ORM call (the profile is held in a
+context variable, which sync_to_async passes on). Rendering the response
+(DRF's renderer, or json_response() for the async views) is counted as
+serialization.
+
+With SERVER_TIMING (off by default: the header tells any client how many
+queries a request made and how long they took) each response gets a
+Server-Timing header. The profile is recorded under the URL name of the
+view (resolver_match.view_name) in a MetricsStore: counters and a window of the last WINDOW samples per view,
+from which metrics_view() (/api/_metrics/) computes the percentiles, in
+the Prometheus text format. The store is a shared memory block in which
+each worker process writes to its own slot, so any worker answers for all
+of them (SHARED_MEMORY=False, or no fcntl: per process). The block outlives
+the workers; remove_shared_store() removes it when the server stops
+(gunicorn.conf.py).
+
+A request making more queries than the budget of its view (QUERY_BUDGETS,
+else QUERY_BUDGET) is logged, and raises QueryBudgetExceeded when
+FAIL_ON_QUERY_BUDGET is set, which fails the test making it.
+"""
+
+import atexit
+import contextlib
+import hashlib
+import hmac
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import URLResolver, get_resolver
+
+try:
+    import fcntl
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Windows: metrics are kept per process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    "SERVER_TIMING": False,
+    "SHARED_MEMORY": True,
+    # Worker processes that can record at the same time
+    "SLOTS": 32,
+    # Samples per view and worker the percentiles are computed from
+    "WINDOW": 256,
+    "QUERY_BUDGET": None,
+    "QUERY_BUDGETS": {},
+    "FAIL_ON_QUERY_BUDGET": False,
+    # Bearer token of the scraper; without one, /api/_metrics/ requires a
+    # superuser's JWT
+    "METRICS_TOKEN": "",
+}
+
+QUANTILES = (0.5, 0.9, 0.99)
+UNRESOLVED = "unresolved"
+
+_current = ContextVar("request_profile", default=None)
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, "PROFILING", {}))
+    return config
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.connect_time = 0.0
+        self.connections = 0
+        self.total_time = 0.0
+
+    def server_timing(self):
+        metrics = [
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} '
+            f'{"query" if self.queries == 1 else "queries"}"',
+            f"serialization;dur={self.serialization_time * 1000:.1f}",
+        ]
+        if self.connections:
+            metrics.append(f"connect;dur={self.connect_time * 1000:.1f}")
+        metrics.append(f"total;dur={self.total_time * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+def current_profile():
+    """Profile of the request being served, or None."""
+    return _current.get()
+
+
+def profile_query(execute, sql, params, many, context):
+    """Execute wrapper adding the query to the current profile."""
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.db_time += time.perf_counter() - start
+        profile.queries += 1
+
+
+@contextlib.contextmanager
+def serializing():
+    """Count the time spent in the block as serialization."""
+    profile = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.serialization_time += time.perf_counter() - start
+
+
+def view_names(patterns=None, prefix=""):
+    """Names of every URL pattern, as resolver_match.view_name gives them."""
+    if patterns is None:
+        patterns = get_resolver().url_patterns
+    names = set()
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            namespace = f"{prefix}{pattern.namespace}:" if pattern.namespace else prefix
+            names |= view_names(pattern.url_patterns, namespace)
+        elif pattern.name:
+            names.add(prefix + pattern.name)
+    return names
+
+
+# Per view and slot: the counters, then the window of samples
+COUNTERS = ("requests", "queries", "db", "serialization", "connect", "total", "connections")
+SAMPLES = ("queries", "db", "serialization", "total")
+HEADER = 8
+
+
+def _block_name(names, slots, window):
+    digest = hashlib.sha1(
+        repr((str(settings.BASE_DIR), names, slots, window)).encode()
+    ).hexdigest()[:12]
+    return f"pharmacie_metrics_{digest}"
+
+
+class MetricsStore:
+    """Counters and recent samples per view, in a block of doubles that
+    worker processes share (one slot each)."""
+
+    def __init__(self, config):
+        self.names = sorted(view_names() | {UNRESOLVED})
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.window = config["WINDOW"]
+        self.record_size = HEADER + self.window * len(SAMPLES)
+        self.shared = bool(config["SHARED_MEMORY"] and fcntl)
+        self.slots = config["SLOTS"] if self.shared else 1
+        self._lock = threading.Lock()
+        size = self.slots * len(self.names) * self.record_size * 8
+        if self.shared:
+            self.name = _block_name(self.names, self.slots, self.window)
+            self._memory = self._attach(size)
+            buffer = self._memory.buf
+            atexit.register(self.close)
+        else:
+            self.name = None
+            buffer = bytearray(size)
+        self.values = memoryview(buffer).cast("d")
+        self._pid = None
+        self._slot = None
+
+    def _attach(self, size):
+        try:
+            memory = shared_memory.SharedMemory(self.name, create=True, size=size)
+        except FileExistsError:
+            memory = shared_memory.SharedMemory(self.name)
+        # The block outlives the process that created it: the other workers
+        # and the next ones keep using it
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+    def close(self):
+        with self._lock:
+            # Requests still served at exit are not recorded
+            self._pid, self._slot = os.getpid(), None
+            self.values.release()
+            self._memory.close()
+
+    def _claim_slot(self):
+        """Slot of this process: the first one whose lock file no living
+        process holds."""
+        if not self.shared:
+            return 0
+        for slot in range(self.slots):
+            path = os.path.join(tempfile.gettempdir(), f"{self.name}.{slot}.lock")
+            handle = open(path, "a")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                continue
+            # Kept open (and locked) until the process exits
+            self._slot_file = handle
+            return slot
+        logger.warning("No free metrics slot (%d in use), not recording", self.slots)
+        return None
+
+    def _offset(self, slot, name):
+        index = self.index.get(name, self.index[UNRESOLVED])
+        return (slot * len(self.names) + index) * self.record_size
+
+    def record(self, name, profile):
+        with self._lock:
+            # Claimed after a fork too: the lock file is shared with the parent
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._slot = self._claim_slot()
+            if self._slot is None:
+                return
+            values = self.values
+            base = self._offset(self._slot, name)
+            count = int(values[base])
+            sample = base + HEADER + (count % self.window) * len(SAMPLES)
+            values[sample] = profile.queries
+            values[sample + 1] = profile.db_time
+            values[sample + 2] = profile.serialization_time
+            values[sample + 3] = profile.total_time
+            values[base + 1] += profile.queries
+            values[base + 2] += profile.db_time
+            values[base + 3] += profile.serialization_time
+            values[base + 4] += profile.connect_time
+            values[base + 5] += profile.total_time
+            values[base + 6] += profile.connections
+            # Last, so that readers only see complete samples
+            values[base] = count + 1
+
+    def snapshot(self):
+        """{view name: (counters, samples)} of the views with requests, the
+        counters summed over the slots and the samples of every slot."""
+        values = self.values
+        result = {}
+        for name in self.names:
+            counters = [0.0] * len(COUNTERS)
+            samples = [[] for _ in SAMPLES]
+            for slot in range(self.slots):
+                base = self._offset(slot, name)
+                count = int(values[base])
+                if not count:
+                    continue
+                for i in range(len(COUNTERS)):
+                    counters[i] += values[base + i]
+                for n in range(min(count, self.window)):
+                    sample = base + HEADER + n * len(SAMPLES)
+                    for i in range(len(SAMPLES)):
+                        samples[i].append(values[sample + i])
+            if counters[0]:
+                result[name] = (counters, samples)
+        return result
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = MetricsStore(get_config())
+    return _store
+
+
+def remove_shared_store():
+    """Remove the shared memory block of the store and its slot lock files.
+
+    For the process managing the workers, once they have all exited.
+    """
+    config = get_config()
+    if not (config["SHARED_MEMORY"] and fcntl):
+        return
+    name = _block_name(
+        sorted(view_names() | {UNRESOLVED}), config["SLOTS"], config["WINDOW"]
+    )
+    try:
+        memory = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        pass
+    else:
+        memory.close()
+        memory.unlink()
+    for slot in range(config["SLOTS"]):
+        path = os.path.join(tempfile.gettempdir(), f"{name}.{slot}.lock")
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _quantile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+SUMMARIES = (
+    # (metric, help, sample index, counter index)
+    ("pharmacie_request_duration_seconds", "Time to build the response", 3, 5),
+    ("pharmacie_request_db_seconds", "Time spent executing SQL queries", 1, 2),
+    ("pharmacie_request_serialization_seconds", "Time spent rendering the response", 2, 3),
+    ("pharmacie_request_queries", "SQL queries per request", 0, 1),
+)
+
+
+def prometheus_text(snapshot):
+    """The metrics of ``snapshot`` in the Prometheus text format."""
+    lines = []
+    for metric, help_text, sample, counter in SUMMARIES:
+        lines.append(f"# HELP {metric} {help_text}, by view.")
+        lines.append(f"# TYPE {metric} summary")
+        for name, (counters, samples) in snapshot.items():
+            view = f'view="{_label(name)}"'
+            for fraction in QUANTILES:
+                value = _quantile(samples[sample], fraction)
+                lines.append(f'{metric}{{{view},quantile="{fraction}"}} {value:g}')
+            lines.append(f"{metric}_sum{{{view}}} {counters[counter]:g}")
+            lines.append(f"{metric}_count{{{view}}} {counters[0]:g}")
+    for metric, help_text, counter in (
+        ("pharmacie_db_connections_total", "Database connections opened", 6),
+        ("pharmacie_db_connect_seconds_total", "Time spent opening database connections", 4),
+    ):
+        lines.append(f"# HELP {metric} {help_text}, by view.")
+        lines.append(f"# TYPE {metric} counter")
+        for name, (counters, _) in snapshot.items():
+            lines.append(f'{metric}{{view="{_label(name)}"}} {counters[counter]:g}')
+    return "\n".join(lines) + "\n"
+
+
+def _authorized(request, config):
+    if config["METRICS_TOKEN"]:
+        expected = f"Bearer {config['METRICS_TOKEN']}"
+        return hmac.compare_digest(request.headers.get("Authorization", ""), expected)
+    from rest_framework.exceptions import APIException
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except APIException:
+        return False
+    return result is not None and result[0].is_superuser
+
+
+def metrics_view(request):
+    """Request metrics of every worker, in the Prometheus text format."""
+    config = get_config()
+    if not _authorized(request, config):
+        return HttpResponse("Unauthorized\n", status=401, content_type="text/plain")
+    return HttpResponse(
+        prometheus_text(get_store().snapshot()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+class ProfilingMiddleware:
+    """Profiles each request; see the module docstring."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = get_config()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.config["ENABLED"]:
+            return self.get_response(request)
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, profile)
+
+    async def __acall__(self, request):
+        if not self.config["ENABLED"]:
+            return await self.get_response(request)
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, profile)
+
+    def process_template_response(self, request, response):
+        # Called just before DRF responses are rendered
+        profile = _current.get()
+        if profile is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                profile.serialization_time += time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def _finish(self, request, response, profile):
+        profile.total_time = time.perf_counter() - profile.start
+        match = getattr(request, "resolver_match", None)
+        name = match.view_name if match else UNRESOLVED
+        if self.config["SERVER_TIMING"]:
+            response["Server-Timing"] = profile.server_timing()
+        get_store().record(name, profile)
+
+        budget = self.config["QUERY_BUDGETS"].get(name, self.config["QUERY_BUDGET"])
+        if budget is not None and profile.queries > budget:
+            message = (
+                f"{request.method} {request.path} ({name}) made {profile.queries} "
+                f"queries, over its budget of {budget}"
+            )
+            if self.config["FAIL_ON_QUERY_BUDGET"]:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,230 @@
+"""Bulk reception of supplier deliveries into a magasin.
+
+The whole payload is validated before anything is written. Products and
+existing lots are loaded in bulk, their quantities are raised with one
+guarded UPDATE (stock_mutations.py), new lots and all movements are
+inserted with one bulk_create each, in one transaction.
+
+Existing lots used to be written with bulk_create(update_conflicts=True),
+which sets the quantity read earlier in the request: a concurrent delivery
+could be overwritten. The guarded deltas of stock_mutations.py replaced it.
+"""
+
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import LotProduit, MouvementStock, Produit
+from .sequences import next_numeros_mouvement
+from .stock_ledger import SoldeDelta, filter_keys
+from .stock_mutations import LotMutations, create_lots
+
+LOT_KEY = ("produit_id", "numero_lot")
+
+
+class LigneReception:
+    """One validated line of a reception payload."""
+
+    def __init__(self, index, produit_id, numero_lot, quantite, date_fabrication,
+                 date_peremption, date_reception, prix_unitaire):
+        self.index = index
+        self.produit_id = produit_id
+        self.numero_lot = numero_lot
+        self.quantite = quantite
+        self.date_fabrication = date_fabrication
+        self.date_peremption = date_peremption
+        self.date_reception = date_reception
+        self.prix_unitaire = prix_unitaire
+        self.produit = None
+        self.lot = None
+
+    @property
+    def key(self):
+        return (self.produit_id, self.numero_lot)
+
+
+def _parse_date(value, field):
+    if value in (None, ""):
+        return None
+    parsed = parse_date(str(value)[:10])
+    if parsed is None:
+        raise ValueError(f"{field} invalide: {value}")
+    return parsed
+
+
+def parse_ligne(index, data):
+    """Validate the syntax of one payload line, raising ValueError on error."""
+    if not isinstance(data, dict):
+        raise ValueError("Ligne invalide")
+
+    produit_id = data.get("produit_id")
+    numero_lot = str(data.get("numero_lot") or "").strip()
+    if not produit_id:
+        raise ValueError("produit_id est requis")
+    if not numero_lot:
+        raise ValueError("numero_lot est requis")
+
+    try:
+        produit_id = int(produit_id)
+        quantite = int(data.get("quantite"))
+    except (TypeError, ValueError):
+        raise ValueError("produit_id et quantite doivent être des entiers")
+    if quantite <= 0:
+        raise ValueError("quantite doit être positive")
+
+    prix_unitaire = data.get("prix_unitaire")
+    if prix_unitaire not in (None, ""):
+        try:
+            prix_unitaire = Decimal(str(prix_unitaire)).quantize(Decimal("0.01"))
+        except InvalidOperation:
+            raise ValueError(f"prix_unitaire invalide: {prix_unitaire}")
+    else:
+        prix_unitaire = None
+
+    return LigneReception(
+        index=index,
+        produit_id=produit_id,
+        numero_lot=numero_lot,
+        quantite=quantite,
+        date_fabrication=_parse_date(data.get("date_fabrication"), "date_fabrication"),
+        date_peremption=_parse_date(data.get("date_peremption"), "date_peremption"),
+        date_reception=_parse_date(data.get("date_reception"), "date_reception")
+        or timezone.now().date(),
+        prix_unitaire=prix_unitaire,
+    )
+
+
+def validate_lignes(payload, magasin):
+    """Validate the whole payload against the database.
+
+    Returns (accepted, rejected) where rejected is a list of
+    {"index", "erreur"} dicts. Existing lots of accepted lines are locked.
+    """
+    accepted = []
+    rejected = []
+    for index, data in enumerate(payload):
+        try:
+            accepted.append(parse_ligne(index, data))
+        except ValueError as exc:
+            rejected.append({"index": index, "erreur": str(exc)})
+
+    produits = Produit.objects.in_bulk({l.produit_id for l in accepted})
+
+    existing = {
+        (lot.produit_id, lot.numero_lot): lot
+        for lot in filter_keys(
+            LotProduit.objects.select_for_update().filter(magasin=magasin),
+            LOT_KEY,
+            {ligne.key for ligne in accepted},
+        )
+    }
+
+    # A line for a new lot may omit the expiry date given on another line of it
+    dates_peremption = {}
+    for ligne in accepted:
+        if ligne.date_peremption is not None:
+            dates_peremption.setdefault(ligne.key, ligne.date_peremption)
+
+    valid = []
+    for ligne in accepted:
+        ligne.produit = produits.get(ligne.produit_id)
+        ligne.lot = existing.get(ligne.key)
+        if ligne.date_peremption is None:
+            ligne.date_peremption = dates_peremption.get(ligne.key)
+        if ligne.produit is None:
+            rejected.append({"index": ligne.index, "erreur": "Produit introuvable"})
+        elif ligne.lot is None and ligne.date_peremption is None:
+            rejected.append(
+                {"index": ligne.index, "erreur": "date_peremption est requis"}
+            )
+        else:
+            valid.append(ligne)
+
+    rejected.sort(key=lambda r: r["index"])
+    return valid, rejected
+
+
+@transaction.atomic
+def receive_lignes(payload, magasin):
+    """Receive ``payload`` into ``magasin``.
+
+    Returns (lignes, rejected): the accepted LigneReception objects, each with
+    its ``lot`` and ``mouvement`` set, and the rejected lines.
+    """
+    lignes, rejected = validate_lignes(payload, magasin)
+    if not lignes:
+        return [], rejected
+
+    delta = SoldeDelta()
+    mutations = LotMutations()
+
+    # Several lines may target the same lot: merge them into one write
+    lots = {}
+    for ligne in lignes:
+        lot = lots.get(ligne.key)
+        if lot is None:
+            lot = ligne.lot
+            if lot is not None:
+                delta.remove(lot)
+            else:
+                lot = LotProduit(
+                    produit_id=ligne.produit_id,
+                    numero_lot=ligne.numero_lot,
+                    magasin=magasin,
+                    quantite_initiale=0,
+                    quantite_actuelle=0,
+                    quantite_reservee=0,
+                    date_fabrication=ligne.date_fabrication,
+                    date_peremption=ligne.date_peremption,
+                    date_reception=ligne.date_reception,
+                    prix_unitaire_achat=ligne.prix_unitaire,
+                    statut="DISPONIBLE",
+                )
+            lots[ligne.key] = lot
+        if lot.pk is None:
+            lot.quantite_initiale += ligne.quantite
+            lot.quantite_actuelle += ligne.quantite
+        else:
+            mutations.add(lot, quantite=ligne.quantite)
+        ligne.lot = lot
+
+    # Existing lots get their quantity added in SQL; new lots are inserted,
+    # a lot created meanwhile by another reception is a StockConflict
+    mutations.apply()
+    new_lots = [lot for lot in lots.values() if lot.pk is None]
+    create_lots(new_lots)
+    missing_pk = [lot for lot in new_lots if lot.pk is None]
+    if missing_pk:
+        # Backends that cannot return ids from a bulk insert
+        ids = {
+            (produit_id, numero_lot): pk
+            for pk, produit_id, numero_lot in filter_keys(
+                LotProduit.objects.filter(magasin=magasin).values_list(
+                    "pk", "produit_id", "numero_lot"
+                ),
+                LOT_KEY,
+                [(lot.produit_id, lot.numero_lot) for lot in missing_pk],
+            )
+        }
+        for lot in missing_pk:
+            lot.pk = ids[(lot.produit_id, lot.numero_lot)]
+
+    for lot in lots.values():
+        delta.add(lot)
+
+    numeros = next_numeros_mouvement(len(lignes))
+    for ligne, numero in zip(lignes, numeros):
+        ligne.mouvement = MouvementStock(
+            numero_mouvement=numero,
+            produit_id=ligne.produit_id,
+            lot=ligne.lot,
+            type_mouvement="ENTREE_ACHAT",
+            quantite=ligne.quantite,
+            magasin_destination=magasin,
+        )
+    MouvementStock.objects.bulk_create([ligne.mouvement for ligne in lignes])
+    delta.apply()
+
+    return lignes, rejected
@@ -0,0 +1,117 @@
+"""Stock reservations for validated service orders.
+
+When an order is validated, the units still to deliver on each line are
+reserved FEFO against specific lots of the main magasin: one ReservationLot
+row per (line, lot) and LotProduit.quantite_reservee raised accordingly, so
+the units are no longer offered to other orders. The order row, its lines
+and the candidate lots are locked (SELECT ... FOR UPDATE, in a fixed order)
+for the duration of the transaction. Delivery consumes the reservations
+(allocation.deliver_lignes); cancelling or reopening the order releases them.
+"""
+
+from django.db import transaction
+
+from .allocation import lock_lots, plan_fefo, release
+from .models import CommandeService, LotProduit, Magasin, ReservationLot
+from .stock_ledger import SoldeDelta
+from .stock_mutations import LotMutations
+
+# Orders whose remaining quantities are held in stock
+STATUTS_RESERVES = ("VALIDEE", "EN_COURS")
+
+
+def magasin_principal():
+    return Magasin.objects.filter(code_magasin="PRINCIPAL", actif=True).first()
+
+
+def _lock(commande):
+    # The order row first, so concurrent status changes are serialized
+    CommandeService.objects.select_for_update().get(pk=commande.pk)
+    lignes = list(commande.lignes.select_for_update().order_by("id"))
+    reservations = list(
+        ReservationLot.objects.filter(ligne__commande=commande).order_by(
+            "ligne_id", "id"
+        )
+    )
+    return lignes, reservations
+
+
+def _save(mutations, lots, delta):
+    """Write the reservation deltas and apply the StockSolde delta of ``lots``."""
+    mutations.apply()
+    for lot in lots:
+        delta.add(lot)
+    delta.apply()
+
+
+@transaction.atomic
+def reserve_commande(commande, magasin=None):
+    """(Re)reserve the undelivered quantities of ``commande`` in ``magasin``
+    (the main magasin by default).
+
+    Existing reservations are kept where the lots still hold the units, then
+    completed FEFO. Returns {ligne_id: quantite non réservée} for the lines
+    that could not be fully reserved.
+    """
+    magasin = magasin or magasin_principal()
+    lignes, reservations = _lock(commande)
+    lignes = [l for l in lignes if l.quantite_livree < l.quantite_demandee]
+    if magasin is None or not lignes:
+        return {}
+
+    delta = SoldeDelta()
+    mutations = LotMutations()
+    lots = lock_lots(lignes, magasin, reservations)
+    lots_by_id = {lot.pk: lot for lot in lots}
+    for lot in lots:
+        delta.remove(lot)
+
+    release(reservations, lots_by_id, mutations)
+    allocations = plan_fefo(
+        lignes,
+        [l for l in lots if l.magasin_id == magasin.pk and l.statut == "DISPONIBLE"],
+        reservations,
+    )
+
+    nouvelles = []
+    manquant = {l.pk: l.quantite_demandee - l.quantite_livree for l in lignes}
+    for ligne, lot, quantite in allocations:
+        mutations.add(lot, reservee=quantite)
+        manquant[ligne.pk] -= quantite
+        nouvelles.append(ReservationLot(ligne=ligne, lot=lot, quantite=quantite))
+
+    if reservations:
+        ReservationLot.objects.filter(pk__in=[r.pk for r in reservations]).delete()
+    ReservationLot.objects.bulk_create(nouvelles)
+    _save(mutations, lots, delta)
+    return {ligne_id: reste for ligne_id, reste in manquant.items() if reste > 0}
+
+
+@transaction.atomic
+def release_commande(commande):
+    """Release every reservation of ``commande``."""
+    _, reservations = _lock(commande)
+    if not reservations:
+        return
+    lots = list(
+        LotProduit.objects.select_for_update()
+        .filter(pk__in={r.lot_id for r in reservations})
+        .order_by("produit_id", "date_peremption", "id")
+    )
+    delta = SoldeDelta()
+    mutations = LotMutations()
+    for lot in lots:
+        delta.remove(lot)
+    release(reservations, {lot.pk: lot for lot in lots}, mutations)
+    ReservationLot.objects.filter(pk__in=[r.pk for r in reservations]).delete()
+    _save(mutations, lots, delta)
+
+
+def sync_reservations(commande, ancien_statut):
+    """Reserve or release stock after a status change of ``commande``."""
+    reserve = commande.statut in STATUTS_RESERVES
+    if reserve and ancien_statut not in STATUTS_RESERVES:
+        return reserve_commande(commande)
+    if not reserve and ancien_statut in STATUTS_RESERVES:
+        release_commande(commande)
+    return {}
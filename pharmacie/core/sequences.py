@@ -0,0 +1,93 @@
+"""Document numbers (CMD-YYYYMMDD-NNNN, MVT-YYYYMMDD-NNNNN) backed by DocumentSequence.
+
+Numbers are reserved by incrementing one counter row per (prefix, day), so
+concurrent workers never hand out the same number. The increment belongs to
+the caller's transaction: if the document is rolled back, so is the number,
+which keeps the sequence free of gaps.
+"""
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import CommandeService, DocumentSequence, MouvementStock
+
+# prefix -> (model, field, number of digits)
+SEQUENCES = {
+    "CMD": (CommandeService, "numero_commande", 4),
+    "MVT": (MouvementStock, "numero_mouvement", 5),
+}
+
+
+def _supports_update_returning():
+    if connection.vendor == "postgresql":
+        return True
+    return (
+        connection.vendor == "sqlite"
+        and connection.features.can_return_columns_from_insert
+    )
+
+
+def _increment(prefix, jour, count):
+    """Add ``count`` to the counter and return its new value, or None if the row is missing."""
+    if _supports_update_returning():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {DocumentSequence._meta.db_table} "
+                "SET valeur = valeur + %s WHERE prefix = %s AND jour = %s "
+                "RETURNING valeur",
+                [count, prefix, connection.ops.adapt_datefield_value(jour)],
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    sequence = DocumentSequence.objects.filter(prefix=prefix, jour=jour)
+    if not sequence.update(valeur=F("valeur") + count):
+        return None
+    return sequence.values_list("valeur", flat=True).get()
+
+
+def _last_issued(prefix, jour):
+    """Highest number already used by documents of that day (before the counter existed)."""
+    model, field, _ = SEQUENCES[prefix]
+    last = (
+        model.objects.filter(**{f"{field}__startswith": f"{prefix}-{jour:%Y%m%d}-"})
+        .order_by(f"-{field}")
+        .values_list(field, flat=True)
+        .first()
+    )
+    return int(last.split("-")[-1]) if last else 0
+
+
+def reserve(prefix, count=1, jour=None):
+    """Reserve ``count`` consecutive numbers for ``prefix`` and return them as a range."""
+    if count <= 0:
+        return range(0)
+    jour = jour or timezone.now().date()
+    with transaction.atomic():
+        last = _increment(prefix, jour, count)
+        if last is None:
+            try:
+                with transaction.atomic():
+                    DocumentSequence.objects.create(
+                        prefix=prefix, jour=jour, valeur=_last_issued(prefix, jour)
+                    )
+            except IntegrityError:
+                pass  # Created concurrently by another worker
+            last = _increment(prefix, jour, count)
+    return range(last - count + 1, last + 1)
+
+
+def numeros(prefix, count=1, jour=None):
+    """Reserve ``count`` formatted document numbers for ``prefix``."""
+    jour = jour or timezone.now().date()
+    digits = SEQUENCES[prefix][2]
+    return [f"{prefix}-{jour:%Y%m%d}-{n:0{digits}d}" for n in reserve(prefix, count, jour)]
+
+
+def next_numero_commande():
+    return numeros("CMD")[0]
+
+
+def next_numeros_mouvement(count):
+    return numeros("MVT", count)
@@ -1,3 +1,4 @@
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
 from .models import (
     Produit,
@@ -67,7 +68,11 @@ class LotSerializer(serializers.ModelSerializer):
             "produit_dci",
             "produit_stock_securite",
             "produit_stock_alerte",
+            "version",
         ]
+        # The version is sent back with updates, which are refused once the
+        # lot has changed; reserved units are the sum of its ReservationLot rows
+        read_only_fields = ["quantite_reservee", "version"]
 
 
 class MouvementSerializer(serializers.ModelSerializer):
@@ -117,6 +122,13 @@ class CommandeSerializer(serializers.ModelSerializer):
         model = CommandeService
         fields = "__all__"
 
+    def to_representation(self, instance):
+        # UpdateModelMixin drops the prefetched lines before rendering the
+        # updated order: load them again with their products (a no-op when
+        # they are still prefetched)
+        prefetch_related_objects([instance], "lignes__produit")
+        return super().to_representation(instance)
+
 
 class MagasinSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,292 @@
+"""Incremental maintenance of the StockSolde summary table and of the
+EcheancePeremption expiry buckets.
+
+Code that changes a lot records it in a SoldeDelta before and after the
+change, then calls apply() inside the same transaction:
+
+    delta = SoldeDelta()
+    delta.remove(lot)
+    lot.quantite_actuelle -= 10
+    lot.save()
+    delta.add(lot)
+    delta.apply()
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .kpi_snapshots import invalidate_magasins
+from .models import EcheancePeremption, LotProduit, StockSolde
+
+# Rows fetched at a time by the rebuilds and checks, which read whole tables
+# (through a server-side cursor on PostgreSQL)
+CHUNK_SIZE = 2000
+
+# Keys matched per query by filter_keys(): each key is one more OR, and
+# SQLite rejects expressions nested more than 1000 deep
+KEYS_PER_QUERY = 200
+
+SOLDE_FIELDS = ("quantite_totale", "quantite_reservee", "nombre_lots")
+ECHEANCE_FIELDS = ("quantite", "valeur", "nombre_lots")
+
+
+def semaine(day):
+    """Monday of the week of ``day``, the key of the expiry buckets."""
+    return day - timedelta(days=day.weekday())
+
+
+def lot_contribution(lot):
+    """Return ((produit_id, magasin_id), (totale, reservee, lots)) for a lot,
+    or None when the lot does not count towards the available stock."""
+    if lot.statut != "DISPONIBLE":
+        return None
+    return (
+        (lot.produit_id, lot.magasin_id),
+        (lot.quantite_actuelle or 0, lot.quantite_reservee or 0, 1),
+    )
+
+
+def lot_echeance(lot):
+    """Return ((magasin_id, semaine), (quantite, valeur, lots)) for a lot, or
+    None when the lot is not expiring stock."""
+    if lot.statut != "DISPONIBLE" or (lot.quantite_actuelle or 0) <= 0:
+        return None
+    return (
+        (lot.magasin_id, semaine(lot.date_peremption)),
+        (
+            lot.quantite_actuelle,
+            lot.quantite_actuelle * (lot.prix_unitaire_achat or Decimal("0")),
+            1,
+        ),
+    )
+
+
+def _keys_filter(key_fields, keys):
+    query = Q()
+    for key in keys:
+        query |= Q(**dict(zip(key_fields, key)))
+    return query
+
+
+def filter_keys(queryset, key_fields, keys):
+    """Iterate the rows of ``queryset`` whose ``key_fields`` match one of
+    ``keys`` (tuples of values), in a query per KEYS_PER_QUERY keys."""
+    keys = list(keys)
+    for start in range(0, len(keys), KEYS_PER_QUERY):
+        yield from queryset.filter(
+            _keys_filter(key_fields, keys[start : start + KEYS_PER_QUERY])
+        )
+
+
+def _write(model, key_fields, fields, changes):
+    """Add ``changes`` ({key: deltas}) to the locked rows of ``model``."""
+    if not changes:
+        return
+    rows = _lock(model, key_fields, changes.keys())
+    missing = [key for key in changes if key not in rows]
+    if missing:
+        model.objects.bulk_create(
+            [model(**dict(zip(key_fields, key))) for key in missing],
+            ignore_conflicts=True,
+        )
+        rows.update(_lock(model, key_fields, missing))
+
+    now = timezone.now()
+    for key, delta in changes.items():
+        row = rows[key]
+        row.date_modification = now
+        for field, value in zip(fields, delta):
+            setattr(row, field, getattr(row, field) + value)
+    model.objects.bulk_update(
+        [rows[key] for key in changes], list(fields) + ["date_modification"]
+    )
+
+
+def _lock(model, key_fields, keys):
+    rows = filter_keys(model.objects.select_for_update(), key_fields, keys)
+    return {tuple(getattr(row, field) for field in key_fields): row for row in rows}
+
+
+class SoldeDelta:
+    """Accumulates StockSolde and expiry bucket changes and writes them in a
+    few queries."""
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: [0, 0, 0])
+        self._echeances = defaultdict(lambda: [0, 0, 0])
+
+    def add(self, lot, sign=1):
+        for contribution, deltas in (
+            (lot_contribution(lot), self._deltas),
+            (lot_echeance(lot), self._echeances),
+        ):
+            if contribution is None:
+                continue
+            key, values = contribution
+            delta = deltas[key]
+            for i, value in enumerate(values):
+                delta[i] += sign * value
+
+    def remove(self, lot):
+        self.add(lot, sign=-1)
+
+    def apply(self):
+        changes = {key: delta for key, delta in self._deltas.items() if any(delta)}
+        echeances = {
+            key: delta for key, delta in self._echeances.items() if any(delta)
+        }
+        self._deltas.clear()
+        self._echeances.clear()
+        if not changes and not echeances:
+            return
+
+        with transaction.atomic():
+            _write(StockSolde, ("produit_id", "magasin_id"), SOLDE_FIELDS, changes)
+            _write(
+                EcheancePeremption, ("magasin_id", "semaine"), ECHEANCE_FIELDS, echeances
+            )
+        invalidate_magasins(
+            {magasin_id for _, magasin_id in changes}
+            | {magasin_id for magasin_id, _ in echeances}
+        )
+
+
+def expected_soldes():
+    """Compute the balances from the lots, keyed like lot_contribution()."""
+    rows = (
+        LotProduit.objects.filter(statut="DISPONIBLE")
+        .values("produit_id", "magasin_id")
+        .annotate(
+            totale=Sum("quantite_actuelle"),
+            reservee=Sum("quantite_reservee"),
+            lots=Count("id"),
+        )
+        .order_by()
+    )
+    return {
+        (row["produit_id"], row["magasin_id"]): (
+            row["totale"] or 0,
+            row["reservee"] or 0,
+            row["lots"],
+        )
+        for row in rows.iterator(chunk_size=CHUNK_SIZE)
+    }
+
+
+def expected_echeances():
+    """Compute the expiry buckets from the lots, keyed like lot_echeance()."""
+    buckets = defaultdict(lambda: [0, Decimal("0"), 0])
+    lots = LotProduit.objects.filter(
+        statut="DISPONIBLE", quantite_actuelle__gt=0
+    ).only(
+        "magasin_id", "date_peremption", "quantite_actuelle", "prix_unitaire_achat", "statut"
+    )
+    for lot in lots.iterator(chunk_size=CHUNK_SIZE):
+        key, values = lot_echeance(lot)
+        bucket = buckets[key]
+        for i, value in enumerate(values):
+            bucket[i] += value
+    return {key: tuple(values) for key, values in buckets.items()}
+
+
+def rebuild_echeances(batch_size=1000):
+    """Replace the whole EcheancePeremption table with buckets computed from the lots."""
+    with transaction.atomic():
+        expected = expected_echeances()
+        EcheancePeremption.objects.all().delete()
+        EcheancePeremption.objects.bulk_create(
+            [
+                EcheancePeremption(
+                    magasin_id=magasin_id,
+                    semaine=semaine,
+                    quantite=quantite,
+                    valeur=valeur,
+                    nombre_lots=nombre_lots,
+                )
+                for (magasin_id, semaine), (quantite, valeur, nombre_lots)
+                in expected.items()
+            ],
+            batch_size=batch_size,
+        )
+    return len(expected)
+
+
+def check_echeances():
+    """Return the (key, expected, actual) triples where the buckets and the lots disagree."""
+    cents = Decimal("0.01")
+    expected = {
+        key: (quantite, valeur.quantize(cents), lots)
+        for key, (quantite, valeur, lots) in expected_echeances().items()
+    }
+    actual = {
+        (e["magasin_id"], e["semaine"]): (
+            e["quantite"],
+            Decimal(e["valeur"]).quantize(cents),
+            e["nombre_lots"],
+        )
+        for e in EcheancePeremption.objects.values(
+            "magasin_id", "semaine", *ECHEANCE_FIELDS
+        ).iterator(chunk_size=CHUNK_SIZE)
+    }
+
+    empty = (0, Decimal("0.00"), 0)
+    mismatches = []
+    for key in expected.keys() | actual.keys():
+        wanted = expected.get(key, empty)
+        found = actual.get(key, empty)
+        if wanted != found:
+            mismatches.append((key, wanted, found))
+    return mismatches
+
+
+def rebuild_soldes(batch_size=1000):
+    """Replace the whole StockSolde table with balances computed from the lots,
+    and the expiry buckets with them."""
+    rebuild_echeances(batch_size)
+    with transaction.atomic():
+        expected = expected_soldes()
+        magasins = set(StockSolde.objects.values_list("magasin_id", flat=True).distinct())
+        StockSolde.objects.all().delete()
+        StockSolde.objects.bulk_create(
+            [
+                StockSolde(
+                    produit_id=produit_id,
+                    magasin_id=magasin_id,
+                    quantite_totale=totale,
+                    quantite_reservee=reservee,
+                    nombre_lots=lots,
+                )
+                for (produit_id, magasin_id), (totale, reservee, lots) in expected.items()
+            ],
+            batch_size=batch_size,
+        )
+        invalidate_magasins(magasins | {magasin_id for _, magasin_id in expected})
+    return len(expected)
+
+
+def check_soldes():
+    """Return the (key, expected, actual) triples where the table and the lots disagree."""
+    expected = expected_soldes()
+    actual = {
+        (s["produit_id"], s["magasin_id"]): (
+            s["quantite_totale"],
+            s["quantite_reservee"],
+            s["nombre_lots"],
+        )
+        for s in StockSolde.objects.values(
+            "produit_id", "magasin_id", *SOLDE_FIELDS
+        ).iterator(chunk_size=CHUNK_SIZE)
+    }
+
+    mismatches = []
+    for key in expected.keys() | actual.keys():
+        wanted = expected.get(key, (0, 0, 0))
+        found = actual.get(key, (0, 0, 0))
+        if wanted != found:
+            mismatches.append((key, wanted, found))
+    return mismatches
@@ -0,0 +1,170 @@
+"""Concurrency-safe writes of lot quantities.
+
+Lot quantities are never written back as absolute values read earlier in
+the request. LotMutations accumulates deltas and applies them with a single
+UPDATE:
+
+    quantite_actuelle = quantite_actuelle + <delta>
+    WHERE (id, version) matches what was read AND the result is >= 0
+
+and bumps LotProduit.version. A row changed by another transaction since it
+was read (optimistic versioning, which also covers SQLite where SELECT ...
+FOR UPDATE is a no-op), or a delta that would make a quantity negative,
+raises StockConflict. The whole transaction is then rolled back and can be
+run again with retry_on_conflict().
+
+Usage, like SoldeDelta:
+
+    mutations = LotMutations()
+    mutations.add(lot, quantite=-10)
+    mutations.apply()
+"""
+
+import functools
+import random
+import time
+
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils import timezone
+
+from .models import LotProduit
+
+RETRY_ATTEMPTS = 5
+RETRY_BACKOFF = 0.02
+# Lots per UPDATE: each one is an OR of the version guard and a WHEN of
+# every CASE, and SQLite limits both the expression depth and the parameters
+BATCH_SIZE = 200
+
+
+class StockConflict(Exception):
+    """A lot changed since it was read, or would go below zero."""
+
+
+def _statut(lot):
+    if lot.statut == "DISPONIBLE" and lot.quantite_actuelle <= 0:
+        return "EPuISE"
+    if lot.statut == "EPuISE" and lot.quantite_actuelle > 0:
+        return "DISPONIBLE"
+    return lot.statut
+
+
+class LotMutations:
+    """Accumulates quantity deltas per lot and applies them in one UPDATE."""
+
+    def __init__(self):
+        self._changes = {}
+
+    def add(self, lot, quantite=0, reservee=0):
+        """Record a delta for ``lot`` (read in the current transaction) and
+        apply it to the instance, updating its statut (EPuISE at zero,
+        DISPONIBLE again when an EPuISE lot is refilled)."""
+        entry = self._entry(lot)
+        entry[1] += quantite
+        entry[2] += reservee
+        lot.quantite_actuelle += quantite
+        lot.quantite_reservee += reservee
+        lot.statut = _statut(lot)
+
+    def set_statut(self, lot, statut):
+        self._entry(lot)
+        lot.statut = statut
+
+    def _entry(self, lot):
+        # [lot, quantity delta, reserved delta, statut read]
+        return self._changes.setdefault(lot.pk, [lot, 0, 0, lot.statut])
+
+    def apply(self, now=None):
+        changes = [
+            entry
+            for entry in self._changes.values()
+            if entry[1] or entry[2] or entry[0].statut != entry[3]
+        ]
+        self._changes.clear()
+        if not changes:
+            return
+        now = now or timezone.now()
+        updated = 0
+        for start in range(0, len(changes), BATCH_SIZE):
+            updated += self._update(changes[start : start + BATCH_SIZE], now)
+        if updated != len(changes):
+            raise StockConflict(
+                f"{len(changes) - updated} lot(s) modifié(s) simultanément"
+            )
+        for lot, *_ in changes:
+            lot.version += 1
+            lot.date_modification = now
+
+    @staticmethod
+    def _update(changes, now):
+        """Apply ``changes``; returns the number of lots updated."""
+        def per_lot(index, default):
+            return Case(
+                *[When(pk=entry[0].pk, then=Value(entry[index])) for entry in changes],
+                default=default,
+                output_field=IntegerField(),
+            )
+
+        read = Q()
+        for lot, *_ in changes:
+            read |= Q(pk=lot.pk, version=lot.version)
+        quantite = F("quantite_actuelle") + per_lot(1, Value(0))
+        reservee = F("quantite_reservee") + per_lot(2, Value(0))
+        statuts = Case(
+            *[When(pk=lot.pk, then=Value(lot.statut)) for lot, *_ in changes],
+            default=F("statut"),
+        )
+        return (
+            LotProduit.objects.filter(read)
+            .alias(nouvelle_quantite=quantite, nouvelle_reservee=reservee)
+            .filter(nouvelle_quantite__gte=0, nouvelle_reservee__gte=0)
+            .update(
+                quantite_actuelle=quantite,
+                quantite_reservee=reservee,
+                statut=statuts,
+                version=F("version") + 1,
+                date_modification=now,
+            )
+        )
+
+
+def create_lots(lots):
+    """Insert new lots; a lot created meanwhile by another transaction is a
+    conflict, not a silent overwrite."""
+    if not lots:
+        return
+    try:
+        with transaction.atomic():
+            LotProduit.objects.bulk_create(lots)
+    except IntegrityError:
+        raise StockConflict("Lot créé simultanément")
+
+
+def _is_lock_error(exc):
+    # SQLite: another connection holds the write lock, or the snapshot read
+    # by this transaction is stale (WAL)
+    return isinstance(exc, OperationalError) and "locked" in str(exc)
+
+
+def retry_on_conflict(func=None, attempts=RETRY_ATTEMPTS):
+    """Run ``func`` again, with a random backoff, when it fails on a
+    StockConflict or a database lock. ``func`` must open its own transaction;
+    nothing is retried inside an outer atomic block."""
+    if func is None:
+        return functools.partial(retry_on_conflict, attempts=attempts)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except (StockConflict, OperationalError) as exc:
+                if not isinstance(exc, StockConflict) and not _is_lock_error(exc):
+                    raise
+                if attempt == attempts or connection.in_atomic_block:
+                    if isinstance(exc, OperationalError):
+                        raise StockConflict(str(exc)) from exc
+                    raise
+                time.sleep(random.uniform(0, RETRY_BACKOFF * 2**attempt))
+
+    return wrapper
@@ -0,0 +1,612 @@
+"""Synthetic stock history for benchmark databases (seed_db --scale).
+
+Each unit of scale is a copy of the seed_db catalogue (MEDICATIONS) whose
+stock is simulated day by day over the last ``days`` days, ending
+yesterday:
+
+- the wards of the services that have their own magasin consume every
+  product they use at a daily rate (log-normal across products and
+  services) with a yearly seasonality per product, mostly peaking in
+  winter, and a quieter weekend;
+- on working days each ward orders what it consumed since its previous
+  order; the order is delivered from the main magasin first expired, first
+  out, as deliver_order does (TRANSFERT movements, lots of the same batch
+  in the ward's magasin), and the ward's consumption leaves its own lots
+  the same way (SORTIE_SERVICE movements). A few orders are cancelled and
+  those of the last two days are left pending;
+- the main magasin reorders a product when its stock falls under two
+  weeks of demand, up to two months, in packs: each reception is a lot
+  with part of its shelf life already elapsed (ENTREE_ACHAT movements);
+- lots past their expiry date are flipped to PERIME with one PERIME
+  movement each, as the nightly expirer_lots() does.
+
+Receptions, orders, deliveries and expiries are journaled. A copy is about
+100,000 rows over two years (so ``--scale 100`` builds a 10M-row
+database); it is simulated in memory, then written in one write
+transaction: bulk_create for the rows others refer to; the movements and
+order lines, nine rows in ten, are written as plain tuples (COPY on
+PostgreSQL, executemany elsewhere) rather than spend most of the time
+building and compiling model instances. Copies
+are independent, numbered apart from copy 0 (the plain seed_db
+catalogue), and can be generated by several processes.
+"""
+
+import math
+import random
+from bisect import insort
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .database import write_transaction
+from .models import (
+    CommandeService,
+    Fournisseur,
+    Journal,
+    LigneCommandeService,
+    LotProduit,
+    Magasin,
+    MouvementStock,
+    Produit,
+    Service,
+    Utilisateur,
+)
+from .product_search import index_produits
+
+DAYS = 730
+BATCH_SIZE = 5000
+ROWS_PER_COPY = 100_000
+
+# Share of the catalogue a ward uses, and its daily consumption per product
+USAGE = 0.4
+DEMAND_MU, DEMAND_SIGMA = 0.5, 1.0
+WEEKEND_DEMAND = 0.6
+WINTER_PEAK = 0.7
+# Reorder point and order-up-to level of the main magasin, in days of demand
+REORDER_DAYS, ORDER_UP_TO_DAYS = 14, 60
+PACKS = (10, 20, 50, 100, 200)
+# Share of the shelf life left when a lot is received
+SHELF_LIFE_LEFT = (0.35, 0.95)
+CANCELLED = 0.02
+PENDING_DAYS = 2
+
+# Simulation parameters of a product: seasonal amplitude and peak (day of
+# the year), reception pack size, purchase price and supplier
+Profile = namedtuple("Profile", "amplitude peak pack prix fournisseur")
+
+# Saved with bulk_create, with historical dates
+MODELS = (Produit, LotProduit, CommandeService, Journal)
+MOUVEMENT_FIELDS = (
+    "numero_mouvement",
+    "produit",
+    "lot",
+    "type_mouvement",
+    "quantite",
+    "magasin_source",
+    "magasin_destination",
+    "date_mouvement",
+    "date_creation",
+    "date_modification",
+)
+LIGNE_FIELDS = (
+    "commande",
+    "produit",
+    "quantite_demandee",
+    "quantite_livree",
+    "statut",
+    "date_creation",
+    "date_modification",
+)
+
+
+@contextmanager
+def historical_dates():
+    """Let the auto_now / auto_now_add dates of MODELS be set explicitly."""
+    fields = [
+        field
+        for model in MODELS
+        for field in model._meta.concrete_fields
+        if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def insert_rows(model, fields, rows, batch_size=BATCH_SIZE):
+    """INSERT ``rows``, tuples of database values for ``fields`` of ``model``:
+    COPY on PostgreSQL, executemany in batches elsewhere."""
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    columns = ", ".join(quote(model._meta.get_field(name).column) for name in fields)
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            with cursor.copy(f"COPY {table} ({columns}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+            return
+        sql = f"INSERT INTO {table} ({columns}) VALUES ({', '.join(['%s'] * len(fields))})"
+        for start in range(0, len(rows), batch_size):
+            cursor.executemany(sql, rows[start : start + batch_size])
+
+
+def _poisson(rng, mean):
+    if mean <= 0:
+        return 0
+    if mean > 30:
+        return max(0, round(rng.gauss(mean, math.sqrt(mean))))
+    # Knuth
+    limit, k, p = math.exp(-mean), 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+
+class Stock:
+    """The DISPONIBLE lots of one product in one magasin, first expired first."""
+
+    def __init__(self):
+        self.lots = []
+
+    def add(self, lot):
+        insort(self.lots, (lot.date_peremption, id(lot), lot))
+
+    @property
+    def quantite(self):
+        return sum(lot.quantite_actuelle for _, _, lot in self.lots)
+
+    def take(self, quantite):
+        """Take up to ``quantite`` units; returns the (lot, quantity) taken."""
+        taken = []
+        while quantite > 0 and self.lots:
+            lot = self.lots[0][2]
+            part = min(quantite, lot.quantite_actuelle)
+            lot.quantite_actuelle -= part
+            quantite -= part
+            taken.append((lot, part))
+            if lot.quantite_actuelle == 0:
+                self.lots.pop(0)
+        return taken
+
+    def expire(self, day):
+        """Remove and return the lots expired before ``day``."""
+        expired = []
+        while self.lots and self.lots[0][0] < day:
+            lot = self.lots.pop(0)[2]
+            lot.statut = "PERIME"
+            expired.append(lot)
+        return expired
+
+
+class Copy:
+    """The simulated history of one copy of the catalogue, as unsaved objects."""
+
+    def __init__(self, copy, catalogue, context, days, seed):
+        self.copy = copy
+        self.context = context
+        self.rng = random.Random(f"{seed}-{copy}")
+        self.tz = timezone.get_current_timezone() if settings.USE_TZ else None
+        self.end = timezone.now().date() - timedelta(days=1)
+        self.start = self.end - timedelta(days=days - 1)
+        self.produits = [self.produit(i, med) for i, med in enumerate(catalogue)]
+        self.profiles = [self.profile() for _ in self.produits]
+        self.lots = []
+        # (numero, lot, type, quantite, source, destination, date)
+        self.mouvements = []
+        self.commandes = []
+        # [commande, produit, demandee, livree, statut, creation, modification]
+        self.lignes = []
+        # (journal, object whose pk is its entity_id)
+        self.journals = []
+        self._numeros = defaultdict(int)
+
+    def produit(self, i, med):
+        rng = self.rng
+        produit = Produit(
+            code_national=f"{3000 + self.copy}{i + 1:08d}",
+            code_interne=f"PR{self.copy:04d}{i + 1:04d}",
+            denomination=f"{med['name']} ({self.copy})",
+            forme_pharmaceutique=med["form"],
+            dosage=med["dosage"],
+            dci=med["dci"],
+            conditionnement=med["cond"],
+            unite_mesure="Unité",
+            stock_securite=rng.randint(20, 100),
+            stock_alerte=rng.randint(50, 200),
+            duree_peremption_mois=rng.choice([12, 24, 36]),
+            necessite_chaine_froid=med["form"]
+            in ["Solution injectable", "Aérosol", "Emulsion injectable"],
+            type_produit="MEDICAMENT",
+            categorie_surveillance=rng.choice(["NORMAL", "NORMAL", "NORMAL", "PSYCHOTROPE"]),
+            fabricant=med["fab"],
+        )
+        produit.date_creation = produit.date_modification = self.at(
+            self.start - timedelta(days=1), 8
+        )
+        return produit
+
+    def profile(self):
+        rng = self.rng
+        return Profile(
+            amplitude=rng.uniform(0, 0.5),
+            peak=rng.gauss(15, 30) if rng.random() < WINTER_PEAK else rng.uniform(0, 365),
+            pack=rng.choice(PACKS),
+            prix=rng.uniform(50, 5000),
+            fournisseur=rng.choice(self.context["fournisseurs"]),
+        )
+
+    def at(self, day, hour, minute=0):
+        return datetime.combine(day, time(hour, minute), tzinfo=self.tz)
+
+    def numero(self, prefix, day, digits):
+        key = (prefix, day)
+        self._numeros[key] += 1
+        return f"{prefix}-{day:%Y%m%d}-{self.copy:04d}{self._numeros[key]:0{digits}d}"
+
+    def journal(self, day, hour, entity=None, **fields):
+        journal = Journal(**fields)
+        journal.date_creation = journal.date_modification = self.at(
+            day, hour, self.rng.randrange(60)
+        )
+        self.journals.append((journal, entity))
+
+    def mouvement(self, day, hour, lot, type_mouvement, quantite, source=None, destination=None):
+        self.mouvements.append(
+            (
+                self.numero("MVT", day, 5),
+                lot,
+                type_mouvement,
+                quantite,
+                source,
+                destination,
+                self.at(day, hour, self.rng.randrange(60)),
+            )
+        )
+
+    def new_lot(self, day, produit, magasin, **fields):
+        lot = LotProduit(produit=produit, magasin=magasin, statut="DISPONIBLE", **fields)
+        lot.date_creation = lot.date_modification = self.at(day, 10)
+        self.lots.append(lot)
+        return lot
+
+    def simulate(self):
+        rng = self.rng
+        context = self.context
+        principal = context["principal"]
+        wards = context["wards"]
+        # Products are referred to by their index: unsaved, they are unhashable
+        stocks = defaultdict(Stock)
+        # Daily demand of each ward for the products it uses
+        demand = {
+            (service, i): rng.lognormvariate(DEMAND_MU, DEMAND_SIGMA)
+            for service in wards
+            for i in range(len(self.produits))
+            if rng.random() < USAGE
+        }
+        daily = [0.0] * len(self.produits)
+        for (_, i), rate in demand.items():
+            daily[i] += rate
+        consumed = defaultdict(float)
+        ward_lots = {}
+        lots_received = [0] * len(self.produits)
+
+        day = self.start
+        while day <= self.end:
+            working = day.weekday() < 5
+            season_day = day.timetuple().tm_yday
+
+            # Nightly expiry
+            expired = [lot for stock in stocks.values() for lot in stock.expire(day)]
+            for lot in expired:
+                if lot.quantite_actuelle:
+                    self.mouvement(day, 0, lot, "PERIME", lot.quantite_actuelle, source=lot.magasin)
+            if expired:
+                quantite = sum(lot.quantite_actuelle for lot in expired)
+                self.journal(
+                    day,
+                    0,
+                    expired,
+                    categorie="STOCK",
+                    action="UPDATE",
+                    description=(
+                        f"Péremption: {len(expired)} lot(s) passé(s) en PERIME, "
+                        f"{quantite} unité(s)"
+                    ),
+                    entity_type="LotProduit",
+                    nouveau_statut="PERIME",
+                    details={"quantite": quantite},
+                )
+
+            # Receptions in the main magasin
+            if working or day == self.start:
+                receptions = defaultdict(list)
+                for i, (produit, profile) in enumerate(zip(self.produits, self.profiles)):
+                    stock = stocks[principal.pk, i]
+                    if stock.quantite >= REORDER_DAYS * daily[i]:
+                        continue
+                    quantite = ORDER_UP_TO_DAYS * daily[i] - stock.quantite
+                    quantite = max(1, math.ceil(quantite / profile.pack)) * profile.pack
+                    shelf_life = produit.duree_peremption_mois * 30
+                    lots_received[i] += 1
+                    lot = self.new_lot(
+                        day,
+                        produit,
+                        principal,
+                        numero_lot=f"L{produit.code_national[-9:]}-{lots_received[i]:03d}",
+                        date_fabrication=day - timedelta(days=rng.randint(30, 180)),
+                        date_peremption=day
+                        + timedelta(days=round(shelf_life * rng.uniform(*SHELF_LIFE_LEFT))),
+                        date_reception=day,
+                        quantite_initiale=quantite,
+                        quantite_actuelle=quantite,
+                        prix_unitaire_achat=Decimal(
+                            f"{profile.prix * rng.uniform(0.9, 1.1):.2f}"
+                        ),
+                    )
+                    stock.add(lot)
+                    self.mouvement(day, 10, lot, "ENTREE_ACHAT", quantite, destination=principal)
+                    receptions[profile.fournisseur].append(lot)
+                for fournisseur, lots in receptions.items():
+                    self.journal(
+                        day,
+                        10,
+                        fournisseur,
+                        categorie="STOCK",
+                        action="RECEPTION",
+                        description=(
+                            f"Réception de stock du fournisseur {fournisseur.raison_sociale}: "
+                            f"{len(lots)} lot(s)"
+                        ),
+                        utilisateur_id=rng.choice(context["pharmaciens"]),
+                        entity_type="Fournisseur",
+                        entity_description=fournisseur.raison_sociale,
+                        details={"nombre_lots": len(lots)},
+                    )
+
+            # Ward consumption, with its seasonality
+            weekday = 1 if working else WEEKEND_DEMAND
+            for (service, i), rate in demand.items():
+                profile = self.profiles[i]
+                season = 1 + profile.amplitude * math.cos(
+                    2 * math.pi * (season_day - profile.peak) / 365.25
+                )
+                consumed[service, i] += rate * season * weekday
+
+            # Ward orders, delivered first expired first out
+            if working:
+                for service in wards:
+                    magasin = service.magasin
+                    quantities = []
+                    for i in range(len(self.produits)):
+                        if (service, i) not in demand:
+                            continue
+                        quantite = _poisson(rng, consumed.pop((service, i), 0))
+                        if quantite:
+                            quantities.append((i, quantite))
+                            for lot, part in stocks[magasin.pk, i].take(quantite):
+                                self.mouvement(day, 7, lot, "SORTIE_SERVICE", part, source=magasin)
+                    if quantities:
+                        self.order(day, service, quantities, stocks, ward_lots)
+            day += timedelta(days=1)
+
+    def order(self, day, service, quantities, stocks, ward_lots):
+        rng = self.rng
+        context = self.context
+        principal = context["principal"]
+        magasin = service.magasin
+        demandeur = rng.choice(context["users"].get(service.pk) or context["pharmaciens"])
+        numero = self.numero("CMD", day, 4)
+        pending = (self.end - day).days < PENDING_DAYS
+        cancelled = not pending and rng.random() < CANCELLED
+
+        commande = CommandeService(
+            numero_commande=numero, service=service, statut="EN_ATTENTE", priorite="NORMALE"
+        )
+        commande.date_demande = commande.date_creation = self.at(day, 8, rng.randrange(60))
+        commande.date_modification = commande.date_creation
+        self.commandes.append(commande)
+        self.journal(
+            day,
+            8,
+            commande,
+            categorie="COMMANDE",
+            action="CREATE",
+            description=f"Nouvelle commande créée: {numero} pour le service {service.nom}",
+            utilisateur_id=demandeur,
+            entity_type="CommandeService",
+            entity_description=numero,
+            nouveau_statut="EN_ATTENTE",
+            details={"service": service.nom, "nombre_lignes": len(quantities)},
+        )
+
+        lignes = [
+            [commande, i, quantite, 0, "EN_ATTENTE", commande.date_creation, commande.date_creation]
+            for i, quantite in quantities
+        ]
+        self.lignes.extend(lignes)
+        if pending:
+            return
+        if cancelled:
+            commande.statut = "ANNULEE"
+            self.journal(
+                day,
+                9,
+                commande,
+                categorie="COMMANDE",
+                action="ANNUL",
+                description=f"Commande annulée: {numero}",
+                utilisateur_id=rng.choice(context["pharmaciens"]),
+                entity_type="CommandeService",
+                entity_description=numero,
+                ancien_statut="EN_ATTENTE",
+                nouveau_statut="ANNULEE",
+            )
+            return
+
+        delivered = self.at(day, 11)
+        for ligne in lignes:
+            _, i, demandee = ligne[:3]
+            for lot, part in stocks[principal.pk, i].take(demandee):
+                key = (magasin.pk, lot.numero_lot)
+                target = ward_lots.get(key)
+                if target is None:
+                    target = ward_lots[key] = self.new_lot(
+                        day,
+                        self.produits[i],
+                        magasin,
+                        numero_lot=lot.numero_lot,
+                        date_fabrication=lot.date_fabrication,
+                        date_peremption=lot.date_peremption,
+                        date_reception=lot.date_reception,
+                        quantite_initiale=0,
+                        quantite_actuelle=0,
+                    )
+                if target.quantite_actuelle == 0:
+                    stocks[magasin.pk, i].add(target)
+                target.quantite_actuelle += part
+                ligne[3] += part
+                self.mouvement(
+                    day, 11, lot, "TRANSFERT", part, source=principal, destination=magasin
+                )
+            if ligne[3] >= demandee:
+                ligne[4] = "LIVREE"
+            ligne[6] = delivered
+        livree = all(ligne[4] == "LIVREE" for ligne in lignes)
+        commande.statut = "LIVREE" if livree else "EN_COURS"
+        commande.date_modification = delivered
+        self.journal(
+            day,
+            11,
+            commande,
+            categorie="COMMANDE",
+            action="LIVRE",
+            description=f"Commande livrée: {numero}",
+            utilisateur_id=rng.choice(context["pharmaciens"]),
+            entity_type="CommandeService",
+            entity_description=numero,
+            ancien_statut="EN_COURS",
+            nouveau_statut=commande.statut,
+        )
+
+    def save(self, batch_size=BATCH_SIZE):
+        """Write the copy in one transaction; returns the number of rows."""
+        with write_transaction(), historical_dates():
+            Produit.objects.bulk_create(self.produits, batch_size=batch_size)
+            LotProduit.objects.bulk_create(self.lots, batch_size=batch_size)
+            CommandeService.objects.bulk_create(self.commandes, batch_size=batch_size)
+            # Timestamps are to the minute: adapt each one once
+            adapted = {}
+
+            def adapt(moment):
+                value = adapted.get(moment)
+                if value is None:
+                    value = adapted[moment] = connection.ops.adapt_datetimefield_value(moment)
+                return value
+
+            mouvements = []
+            for numero, lot, type_mouvement, quantite, source, destination, moment in (
+                self.mouvements
+            ):
+                moment = adapt(moment)
+                mouvements.append(
+                    (
+                        numero,
+                        lot.produit_id,
+                        lot.pk,
+                        type_mouvement,
+                        quantite,
+                        source and source.pk,
+                        destination and destination.pk,
+                        moment,
+                        moment,
+                        moment,
+                    )
+                )
+            insert_rows(MouvementStock, MOUVEMENT_FIELDS, mouvements, batch_size)
+            insert_rows(
+                LigneCommandeService,
+                LIGNE_FIELDS,
+                [
+                    (
+                        commande.pk,
+                        self.produits[i].pk,
+                        demandee,
+                        livree,
+                        statut,
+                        adapt(creation),
+                        adapt(modification),
+                    )
+                    for commande, i, demandee, livree, statut, creation, modification in (
+                        self.lignes
+                    )
+                ],
+                batch_size,
+            )
+            for journal, entity in self.journals:
+                if isinstance(entity, list):
+                    journal.details["lots"] = [lot.pk for lot in entity]
+                elif entity is not None:
+                    journal.entity_id = entity.pk
+            Journal.objects.bulk_create(
+                [journal for journal, _ in self.journals], batch_size=batch_size
+            )
+            index_produits(self.produits)
+        return (
+            len(self.produits)
+            + len(self.lots)
+            + len(self.mouvements)
+            + len(self.commandes)
+            + len(self.lignes)
+            + len(self.journals)
+        )
+
+
+def load_context():
+    """The magasins, services, suppliers and users the copies refer to."""
+    principal = Magasin.objects.get(code_magasin="PRINCIPAL")
+    wards = list(
+        Service.objects.select_related("magasin")
+        .filter(actif=True, magasin__isnull=False)
+        .exclude(magasin=principal)
+        .order_by("pk")
+    )
+    if not wards:
+        raise ValueError("No service with its own magasin to order from the main magasin")
+    fournisseurs = list(Fournisseur.objects.order_by("pk"))
+    if not fournisseurs:
+        raise ValueError("No fournisseur to receive stock from")
+    users = defaultdict(list)
+    for pk, service_id in Utilisateur.objects.filter(is_active=True).values_list(
+        "pk", "service_id"
+    ):
+        users[service_id].append(pk)
+    pharmaciens = list(
+        Utilisateur.objects.filter(
+            is_active=True, fonction__in=["PHARMACIEN", "ADMIN"]
+        ).values_list("pk", flat=True)
+    ) or [None]
+    return {
+        "principal": principal,
+        "wards": wards,
+        "fournisseurs": fournisseurs,
+        "users": dict(users),
+        "pharmaciens": pharmaciens,
+    }
+
+
+def generate_copy(copy, catalogue, context, days=DAYS, seed=0, batch_size=BATCH_SIZE):
+    """Simulate and write copy number ``copy``; returns the number of rows."""
+    history = Copy(copy, catalogue, context, days, seed)
+    history.simulate()
+    return history.save(batch_size)
@@ -1,3 +1,1804 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import random
+import tempfile
+import zipfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from multiprocessing import shared_memory
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import Sum
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.client import MULTIPART_CONTENT
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import api_views, async_views, product_search, sequences
+from . import cache as project_cache
+from .catalogue_import import import_file
+from .database import connection_stats, copy_sqlite_template, write_transaction
+from .exports import LOT_COLUMNS
+from .journal_sink import JournalSink, recover_spool
+from .kpi_snapshots import PENDING_PREVIEW_SIZE, compute_kpis, compute_orders_overview
+from .management.commands.seed_db import (
+    FOURNISSEURS,
+    MAGASINS,
+    MEDICATIONS,
+    PERMISSIONS_CONFIG,
+    RESOURCES,
+    SERVICES,
+    USERS,
+)
+from .models import (
+    CommandeService,
+    DocumentSequence,
+    Fournisseur,
+    Journal,
+    LigneCommandeService,
+    LotProduit,
+    Magasin,
+    MouvementStock,
+    Permission,
+    Produit,
+    ReservationLot,
+    Role,
+    Service,
+    Utilisateur,
+)
+from .pagination import encode_cursor
+from .peremption import expirer_lots
+from .product_search import index_produits, search_produits
+from .profiling import (
+    MetricsStore,
+    QueryBudgetExceeded,
+    get_config,
+    remove_shared_store,
+    view_names,
+)
+from .sequences import next_numero_commande, numeros, reserve
+from .stock_ledger import SoldeDelta, check_echeances, check_soldes, rebuild_soldes
+from .stock_mutations import LotMutations, StockConflict, retry_on_conflict
+from .valuation import stock_value, valuation
+from .views_dashboard import produits_en_alerte
+
+# The cache tests clear the cache; never the one of the installation.
+TEST_CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "core-tests",
+    }
+}
+
+
+class QueryIndexTests(TestCase):
+    """The hot dashboard / stock queries must be served by the composite indexes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.magasin = Magasin.objects.create(
+            code_magasin="PRINCIPAL", nom="Pharmacie Centrale", type_magasin="PRINCIPAL"
+        )
+        cls.service = Service.objects.create(
+            code_service="CARDIO", nom="Cardiologie", magasin=cls.magasin
+        )
+        today = timezone.now().date()
+        produits = [
+            Produit.objects.create(
+                code_national=f"CN{i:04d}",
+                denomination=f"Produit {i}",
+                forme_pharmaceutique="Comprimé",
+                dosage="500mg",
+                conditionnement="Boîte",
+                unite_mesure="CP",
+            )
+            for i in range(5)
+        ]
+        for produit in produits:
+            for j in range(4):
+                LotProduit.objects.create(
+                    produit=produit,
+                    magasin=cls.magasin,
+                    numero_lot=f"L{produit.pk}-{j}",
+                    date_peremption=today + timedelta(days=30 * j),
+                    date_reception=today,
+                    quantite_initiale=100,
+                    quantite_actuelle=100 * (j % 2),
+                    statut="DISPONIBLE" if j % 2 else "EPuISE",
+                )
+            MouvementStock.objects.create(
+                numero_mouvement=f"MVT-{produit.pk}",
+                produit=produit,
+                type_mouvement="TRANSFERT",
+                quantite=10,
+                magasin_source=cls.magasin,
+            )
+        for i in range(5):
+            CommandeService.objects.create(
+                numero_commande=f"CMD-{i}", service=cls.service, statut="EN_ATTENTE"
+            )
+            Journal.objects.create(categorie="STOCK", action="CREATE", description="x")
+        cls.produits = produits
+        cls.today = today
+
+    def assertUsesIndex(self, queryset, index_name):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # Tiny test tables would otherwise always be scanned
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_fefo_allocation_uses_partial_index(self):
+        queryset = LotProduit.objects.filter(
+            produit_id__in=[p.pk for p in self.produits],
+            magasin=self.magasin,
+            statut="DISPONIBLE",
+            quantite_actuelle__gt=0,
+        ).order_by("produit_id", "date_peremption", "id")
+        self.assertUsesIndex(queryset, "lot_disponible_fefo_idx")
+
+    def test_expiring_lots(self):
+        queryset = LotProduit.objects.filter(
+            magasin=self.magasin,
+            date_peremption__gte=self.today,
+            date_peremption__lte=self.today + timedelta(days=30),
+            quantite_actuelle__gt=0,
+        )
+        self.assertUsesIndex(queryset, "lot_magasin_peremption_idx")
+
+    def test_lots_by_magasin_and_statut(self):
+        queryset = LotProduit.objects.filter(
+            magasin=self.magasin, statut="DISPONIBLE", prix_unitaire_achat__isnull=False
+        )
+        self.assertUsesIndex(queryset, "lot_magasin_statut_prod_idx")
+
+    def test_pending_orders_of_service(self):
+        queryset = CommandeService.objects.filter(
+            service=self.service, statut__in=["EN_ATTENTE", "VALIDEE"]
+        )
+        self.assertUsesIndex(queryset, "commande_service_statut_idx")
+
+    def test_journal_filters(self):
+        queryset = Journal.objects.filter(categorie="STOCK", action="CREATE")
+        self.assertUsesIndex(queryset, "journal_categorie_action_idx")
+
+    def test_journal_keyset_ordering(self):
+        queryset = Journal.objects.order_by("-date_creation", "-id")[:25]
+        self.assertUsesIndex(queryset, "journal_date_creation_idx")
+
+    def test_mouvements_of_magasin(self):
+        queryset = MouvementStock.objects.filter(magasin_source=self.magasin).order_by(
+            "-date_mouvement"
+        )
+        self.assertUsesIndex(queryset, "mouvement_source_date_idx")
+
+    def test_products_by_denomination(self):
+        queryset = Produit.objects.order_by("denomination", "id")[:25]
+        self.assertUsesIndex(queryset, "produit_denomination_idx")
+
+
+class DocumentSequenceTests(TestCase):
+    def test_consecutive_numbers_without_gaps(self):
+        jour = timezone.now().date()
+        self.assertEqual(
+            numeros("MVT", 3), [f"MVT-{jour:%Y%m%d}-{n:05d}" for n in (1, 2, 3)]
+        )
+        # A rolled back document gives its number back
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            numeros("MVT")
+            raise RuntimeError
+        self.assertEqual(numeros("MVT", 2), [f"MVT-{jour:%Y%m%d}-{n:05d}" for n in (4, 5)])
+        self.assertEqual(list(reserve("MVT", 1, jour + timedelta(days=1))), [1])
+
+    def test_counter_starts_after_existing_documents(self):
+        jour = timezone.now().date()
+        service = Service.objects.create(code_service="S", nom="Service", type_service="CLINIQUE")
+        CommandeService.objects.create(numero_commande=f"CMD-{jour:%Y%m%d}-0007", service=service)
+        self.assertEqual(next_numero_commande(), f"CMD-{jour:%Y%m%d}-0008")
+
+    def test_counter_created_concurrently(self):
+        jour = timezone.now().date()
+        # Created by another worker between our UPDATE and our INSERT
+        DocumentSequence.objects.create(prefix="MVT", jour=jour, valeur=41)
+        increment = sequences._increment
+        missed = []
+
+        def increment_after_race(prefix, day, count):
+            if not missed:
+                missed.append(prefix)
+                return None
+            return increment(prefix, day, count)
+
+        with mock.patch.object(sequences, "_increment", side_effect=increment_after_race):
+            self.assertEqual(list(reserve("MVT", 2, jour)), [42, 43])
+        self.assertEqual(DocumentSequence.objects.get(prefix="MVT", jour=jour).valeur, 43)
+
+
+class StockMutationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.magasin = Magasin.objects.create(
+            code_magasin="PRINCIPAL", nom="Pharmacie Centrale", type_magasin="PRINCIPAL"
+        )
+        cls.produit = Produit.objects.create(
+            code_national="CN0001",
+            denomination="Produit",
+            forme_pharmaceutique="Comprimé",
+            dosage="500mg",
+            conditionnement="Boîte",
+            unite_mesure="CP",
+        )
+        today = timezone.now().date()
+        cls.lots = [
+            LotProduit.objects.create(
+                produit=cls.produit,
+                magasin=cls.magasin,
+                numero_lot=f"L{i}",
+                date_peremption=today,
+                date_reception=today,
+                quantite_initiale=10,
+                quantite_actuelle=10,
+            )
+            for i in range(2)
+        ]
+
+    def test_deltas_applied_in_one_update(self):
+        first, second = LotProduit.objects.order_by("id")
+        mutations = LotMutations()
+        mutations.add(first, quantite=-10)
+        mutations.add(second, quantite=5, reservee=3)
+        with self.assertNumQueries(1):
+            mutations.apply()
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.quantite_actuelle, first.statut), (0, "EPuISE"))
+        self.assertEqual(
+            (second.quantite_actuelle, second.quantite_reservee, second.version),
+            (15, 3, 1),
+        )
+
+    def test_stale_version_conflicts(self):
+        lot = LotProduit.objects.get(pk=self.lots[0].pk)
+        stale = LotProduit.objects.get(pk=self.lots[0].pk)
+        mutations = LotMutations()
+        mutations.add(lot, quantite=-4)
+        mutations.apply()
+
+        mutations.add(stale, quantite=-4)
+        with self.assertRaises(StockConflict):
+            mutations.apply()
+        lot.refresh_from_db()
+        self.assertEqual(lot.quantite_actuelle, 6)
+
+    def test_lot_update_refuses_stale_versions(self):
+        admin = Utilisateur.objects.create_superuser("lots", "l@x.dz", "x")
+        rebuild_soldes()
+        url = f"/api/lots/{self.lots[0].pk}/"
+        headers = {
+            "HTTP_AUTHORIZATION": f"Bearer {RefreshToken.for_user(admin).access_token}"
+        }
+        read = self.client.get(url, **headers).json()
+
+        # A delivery commits after the client read the lot
+        lot = LotProduit.objects.get(pk=self.lots[0].pk)
+        delta = SoldeDelta()
+        delta.remove(lot)
+        mutations = LotMutations()
+        mutations.add(lot, quantite=-4)
+        mutations.apply()
+        delta.add(lot)
+        delta.apply()
+        response = self.client.patch(
+            url,
+            {"quantite_actuelle": 8, "version": read["version"]},
+            content_type="application/json",
+            **headers,
+        )
+        self.assertEqual(response.status_code, 409)
+        lot.refresh_from_db()
+        self.assertEqual(lot.quantite_actuelle, 6)
+
+        response = self.client.patch(
+            url,
+            {"quantite_actuelle": 8, "version": lot.version},
+            content_type="application/json",
+            **headers,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["version"], lot.version + 1)
+        lot.refresh_from_db()
+        self.assertEqual(lot.quantite_actuelle, 8)
+        self.assertEqual(check_soldes(), [])
+
+    def test_negative_quantity_conflicts(self):
+        lot = LotProduit.objects.get(pk=self.lots[0].pk)
+        LotProduit.objects.filter(pk=lot.pk).update(quantite_actuelle=3)
+        mutations = LotMutations()
+        mutations.add(lot, quantite=-5)
+        with self.assertRaises(StockConflict):
+            mutations.apply()
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class StockWorkflowTests(TestCase):
+    """Orders through the API: reservations, FEFO deliveries and the ledger."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.principal = Magasin.objects.create(
+            code_magasin="PRINCIPAL", nom="Pharmacie Centrale", type_magasin="PRINCIPAL"
+        )
+        cls.service = Service.objects.create(
+            code_service="CHIR",
+            nom="Chirurgie",
+            type_service="CLINIQUE",
+            magasin=Magasin.objects.create(
+                code_magasin="CHIR", nom="Magasin Chirurgie", type_magasin="CONSOMMABLES"
+            ),
+        )
+        cls.produit = Produit.objects.create(
+            code_national="CN0001",
+            denomination="Produit",
+            forme_pharmaceutique="Comprimé",
+            dosage="500mg",
+            conditionnement="Boîte",
+            unite_mesure="CP",
+        )
+        today = timezone.now().date()
+        # Received in the reverse order of their expiry
+        for numero_lot, days in (("TARD", 90), ("TOT", 30)):
+            LotProduit.objects.create(
+                produit=cls.produit,
+                magasin=cls.principal,
+                numero_lot=numero_lot,
+                date_peremption=today + timedelta(days=days),
+                date_reception=today,
+                quantite_initiale=10,
+                quantite_actuelle=10,
+            )
+        rebuild_soldes()
+        cls.admin = Utilisateur.objects.create_superuser("flux", "f@x.dz", "x")
+
+    def setUp(self):
+        token = RefreshToken.for_user(self.admin).access_token
+        self.client.defaults["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+        self.commandes = 0
+
+    def commande(self, quantite, statut="EN_ATTENTE"):
+        self.commandes += 1
+        commande = CommandeService.objects.create(
+            numero_commande=f"CMD-{self.commandes}", service=self.service, statut=statut
+        )
+        LigneCommandeService.objects.create(
+            commande=commande, produit=self.produit, quantite_demandee=quantite
+        )
+        return commande
+
+    def set_statut(self, commande, statut):
+        response = self.client.patch(
+            f"/api/commandes/{commande.pk}/",
+            {"statut": statut},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def deliver(self, commande):
+        response = self.client.post(
+            "/api/commandes/livrer/",
+            {"commande_id": commande.pk},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def lots(self, magasin=None):
+        """{numero_lot: (quantite_actuelle, quantite_reservee)} of a magasin."""
+        return {
+            lot.numero_lot: (lot.quantite_actuelle, lot.quantite_reservee)
+            for lot in LotProduit.objects.filter(magasin=magasin or self.principal)
+        }
+
+    def reservations(self, commande):
+        return {
+            r.lot.numero_lot: r.quantite
+            for r in ReservationLot.objects.filter(ligne__commande=commande).select_related(
+                "lot"
+            )
+        }
+
+    def assertLedgerConsistent(self):
+        self.assertEqual(check_soldes(), [])
+        self.assertEqual(check_echeances(), [])
+
+    def test_competing_validations_do_not_share_units(self):
+        first, second = self.commande(15), self.commande(10)
+        data = self.set_statut(first, "VALIDEE")
+        self.assertNotIn("reservations_manquantes", data)
+        self.assertEqual(self.reservations(first), {"TOT": 10, "TARD": 5})
+
+        data = self.set_statut(second, "VALIDEE")
+        ligne = second.lignes.get()
+        self.assertEqual(
+            data["reservations_manquantes"], [{"ligne_id": ligne.pk, "quantite": 5}]
+        )
+        self.assertEqual(self.reservations(second), {"TARD": 5})
+        self.assertEqual(self.lots(), {"TOT": (10, 10), "TARD": (10, 10)})
+        self.assertLedgerConsistent()
+
+    def test_delivery_consumes_its_own_reservations(self):
+        first, second = self.commande(10), self.commande(5)
+        self.set_statut(first, "VALIDEE")
+        self.set_statut(second, "VALIDEE")
+        self.set_statut(second, "EN_COURS")
+        self.assertEqual(self.deliver(second)["statut"], "LIVREE")
+
+        # From its reservation on TARD, not from TOT, reserved for the first
+        self.assertEqual(self.lots(), {"TOT": (10, 10), "TARD": (5, 0)})
+        self.assertEqual(self.reservations(first), {"TOT": 10})
+        self.assertEqual(self.reservations(second), {})
+        self.assertEqual(self.lots(self.service.magasin), {"TARD": (5, 0)})
+        self.assertLedgerConsistent()
+
+    def test_cancelling_or_deleting_releases_reservations(self):
+        first, second = self.commande(8), self.commande(6)
+        self.set_statut(first, "VALIDEE")
+        self.set_statut(second, "VALIDEE")
+        self.assertEqual(self.lots(), {"TOT": (10, 10), "TARD": (10, 4)})
+
+        self.set_statut(first, "ANNULEE")
+        self.assertEqual(self.reservations(first), {})
+        self.assertEqual(self.lots(), {"TOT": (10, 2), "TARD": (10, 4)})
+
+        response = self.client.delete(f"/api/commandes/{second.pk}/")
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(ReservationLot.objects.exists())
+        self.assertEqual(self.lots(), {"TOT": (10, 0), "TARD": (10, 0)})
+        self.assertLedgerConsistent()
+
+    def test_fefo_and_partial_delivery(self):
+        commande = self.commande(25, statut="EN_COURS")
+        data = self.deliver(commande)
+        self.assertEqual((data["statut"], data["message"]), ("EN_COURS", "Partiellement livrée"))
+        mouvements = MouvementStock.objects.filter(type_mouvement="TRANSFERT").order_by("id")
+        self.assertEqual(
+            [(m.lot.numero_lot, m.quantite) for m in mouvements], [("TOT", 10), ("TARD", 10)]
+        )
+        ligne = commande.lignes.get()
+        self.assertEqual((ligne.quantite_livree, ligne.statut), (20, "EN_ATTENTE"))
+        self.assertEqual(self.lots(), {"TOT": (0, 0), "TARD": (0, 0)})
+        self.assertEqual(
+            LotProduit.objects.get(magasin=self.principal, numero_lot="TOT").statut, "EPuISE"
+        )
+
+        lot = LotProduit.objects.create(
+            produit=self.produit,
+            magasin=self.principal,
+            numero_lot="NOUVEAU",
+            date_peremption=timezone.now().date() + timedelta(days=60),
+            date_reception=timezone.now().date(),
+            quantite_initiale=8,
+            quantite_actuelle=8,
+        )
+        delta = SoldeDelta()
+        delta.add(lot)
+        delta.apply()
+        self.assertEqual(self.deliver(commande)["statut"], "LIVREE")
+        ligne.refresh_from_db()
+        self.assertEqual((ligne.quantite_livree, ligne.statut), (25, "LIVREE"))
+        self.assertEqual(
+            self.lots(self.service.magasin),
+            {"TOT": (10, 0), "TARD": (10, 0), "NOUVEAU": (5, 0)},
+        )
+        self.assertLedgerConsistent()
+
+    def test_partial_delivery_keeps_the_rest_reserved(self):
+        commande = self.commande(12)
+        self.set_statut(commande, "VALIDEE")
+        self.assertEqual(self.reservations(commande), {"TOT": 10, "TARD": 2})
+        tard = LotProduit.objects.get(magasin=self.principal, numero_lot="TARD")
+        response = self.client.patch(
+            f"/api/lots/{tard.pk}/", {"statut": "BLOQUE"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+
+        self.set_statut(commande, "EN_COURS")
+        self.assertEqual(self.deliver(commande)["statut"], "EN_COURS")
+        self.assertEqual(self.reservations(commande), {"TARD": 2})
+        self.assertEqual(self.lots(), {"TOT": (0, 0), "TARD": (10, 2)})
+        self.assertLedgerConsistent()
+
+        response = self.client.patch(
+            f"/api/lots/{tard.pk}/", {"statut": "DISPONIBLE"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.deliver(commande)["statut"], "LIVREE")
+        self.assertEqual(self.reservations(commande), {})
+        self.assertEqual(self.lots(), {"TOT": (0, 0), "TARD": (8, 0)})
+        self.assertLedgerConsistent()
+
+    def test_every_write_path_keeps_the_ledger(self):
+        today = timezone.now().date()
+        # Lot API: create, change the quantity, the price and the statut, delete
+        response = self.client.post(
+            "/api/lots/",
+            {
+                "produit": self.produit.pk,
+                "magasin": self.principal.pk,
+                "numero_lot": "API",
+                "date_peremption": (today + timedelta(days=200)).isoformat(),
+                "date_reception": today.isoformat(),
+                "quantite_initiale": 12,
+                "quantite_actuelle": 12,
+                "prix_unitaire_achat": "3.50",
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        url = f"/api/lots/{response.json()['id']}/"
+        self.assertLedgerConsistent()
+        for change in (
+            {"quantite_actuelle": 7},
+            {"prix_unitaire_achat": "4.00"},
+            {"statut": "BLOQUE"},
+            {"statut": "DISPONIBLE"},
+        ):
+            response = self.client.patch(url, change, content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            self.assertLedgerConsistent()
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertLedgerConsistent()
+
+        # Reception into an existing and a new lot
+        fournisseur = Fournisseur.objects.create(
+            code_fournisseur="F1", raison_sociale="Fournisseur", type_fournisseur="GROSSISTE"
+        )
+        response = self.client.post(
+            "/api/stock/reception/",
+            {
+                "fournisseur_id": fournisseur.pk,
+                "lignes": [
+                    {"produit_id": self.produit.pk, "numero_lot": "TOT", "quantite": 5},
+                    {
+                        "produit_id": self.produit.pk,
+                        "numero_lot": "PERIME",
+                        "quantite": 4,
+                        "date_peremption": (today - timedelta(days=1)).isoformat(),
+                    },
+                ],
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["nombre_rejetees"], 0)
+        self.assertLedgerConsistent()
+
+        # Validation, delivery, and the nightly expiry of a reserved lot
+        commande = self.commande(6)
+        self.set_statut(commande, "VALIDEE")
+        self.assertLedgerConsistent()
+        self.set_statut(commande, "EN_COURS")
+        self.deliver(commande)
+        self.assertLedgerConsistent()
+        self.set_statut(self.commande(3), "VALIDEE")
+        self.assertEqual(expirer_lots(), (1, 4))
+        self.assertLedgerConsistent()
+
+    def test_expiry_counts_are_exact_days(self):
+        today = timezone.now().date()
+        for numero_lot, days, statut in (
+            ("PERIME", -1, "DISPONIBLE"),
+            ("BLOQUE", 31, "BLOQUE"),
+            ("LOIN", 91, "DISPONIBLE"),
+        ):
+            LotProduit.objects.create(
+                produit=self.produit,
+                magasin=self.principal,
+                numero_lot=numero_lot,
+                date_peremption=today + timedelta(days=days),
+                date_reception=today,
+                quantite_initiale=5,
+                quantite_actuelle=5,
+                statut=statut,
+            )
+        kpis = compute_kpis(self.principal)
+        self.assertEqual((kpis["lots_expiring_30_days"], kpis["lots_expiring_90_days"]), (1, 3))
+
+    def test_produits_en_alerte(self):
+        # No lot at all: not listed, unlike the RUPTURE tier of core.alertes
+        Produit.objects.create(
+            code_national="CN0002",
+            denomination="Sans lot",
+            forme_pharmaceutique="-",
+            dosage="-",
+            conditionnement="-",
+            unite_mesure="U",
+            stock_securite=5,
+        )
+        self.assertEqual(produits_en_alerte(), [])
+        Produit.objects.filter(pk=self.produit.pk).update(stock_securite=20)
+        self.assertEqual(produits_en_alerte(), [self.produit])
+
+    def test_invalid_magasin_parameter(self):
+        for url in ("/api/stock/alertes/", "/api/lots/expiring/"):
+            self.assertEqual(self.client.get(url, {"magasin": "abc"}).status_code, 400)
+            self.assertEqual(self.client.get(url, {"magasin": "999"}).status_code, 404)
+            response = self.client.get(url, {"magasin": self.principal.pk})
+            self.assertEqual(response.status_code, 200)
+
+    def test_reserved_quantity_is_read_only(self):
+        lot = LotProduit.objects.get(numero_lot="TOT")
+        response = self.client.patch(
+            f"/api/lots/{lot.pk}/", {"quantite_reservee": 7}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        lot.refresh_from_db()
+        self.assertEqual(lot.quantite_reservee, 0)
+
+    def test_admin_keeps_the_ledger(self):
+        self.client.force_login(self.admin)
+        lot = LotProduit.objects.get(numero_lot="TOT", magasin=self.principal)
+        form = {
+            "produit": self.produit.pk,
+            "magasin": self.principal.pk,
+            "numero_lot": "TOT",
+            "date_peremption": (lot.date_peremption + timedelta(days=60)).isoformat(),
+            "date_reception": lot.date_reception.isoformat(),
+            "quantite_initiale": 10,
+            "quantite_actuelle": 4,
+            "statut": "DISPONIBLE",
+            "prix_unitaire_achat": "2.50",
+        }
+        # The admin has no query budget of its own
+        with self.assertLogs("core.profiling", "WARNING"):
+            response = self.client.post(f"/admin/core/lotproduit/{lot.pk}/change/", form)
+        self.assertEqual(response.status_code, 302)
+        lot.refresh_from_db()
+        self.assertEqual(lot.quantite_actuelle, 4)
+        self.assertLedgerConsistent()
+
+        with self.assertLogs("core.profiling", "WARNING"):
+            response = self.client.post(
+                "/admin/core/lotproduit/",
+                {"action": "delete_selected", "_selected_action": [lot.pk], "post": "yes"},
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(LotProduit.objects.filter(pk=lot.pk).exists())
+        self.assertLedgerConsistent()
+
+
+class RetryOnConflictTests(SimpleTestCase):
+    def test_retries_until_success(self):
+        calls = []
+
+        @retry_on_conflict
+        def mutate():
+            calls.append(1)
+            if len(calls) < 3:
+                raise StockConflict()
+            return "ok"
+
+        self.assertEqual(mutate(), "ok")
+        self.assertEqual(len(calls), 3)
+
+    def test_gives_up(self):
+        @retry_on_conflict(attempts=2)
+        def mutate():
+            raise StockConflict()
+
+        with self.assertRaises(StockConflict):
+            mutate()
+
+
+class StockReceptionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.magasin = Magasin.objects.create(
+            code_magasin="PRINCIPAL", nom="Pharmacie Centrale", type_magasin="PRINCIPAL"
+        )
+        cls.fournisseur = Fournisseur.objects.create(
+            code_fournisseur="F1", raison_sociale="Fournisseur", type_fournisseur="GROSSISTE"
+        )
+        cls.produits = Produit.objects.bulk_create(
+            [
+                Produit(
+                    code_national=f"CN{i:04d}",
+                    denomination=f"Produit {i}",
+                    forme_pharmaceutique="Comprimé",
+                    dosage="500mg",
+                    conditionnement="Boîte",
+                    unite_mesure="CP",
+                )
+                for i in range(10)
+            ]
+        )
+        cls.admin = Utilisateur.objects.create_superuser("recep", "r@x.dz", "x")
+
+    def test_large_reception(self):
+        # Half of the lines go to existing lots, half create new ones: more
+        # lots than SQLite accepts in one OR chain
+        today = timezone.now().date()
+        LotProduit.objects.bulk_create(
+            [
+                LotProduit(
+                    produit=self.produits[i % 10],
+                    magasin=self.magasin,
+                    numero_lot=f"OLD{i}",
+                    date_peremption=today + timedelta(days=365),
+                    date_reception=today,
+                    quantite_initiale=5,
+                    quantite_actuelle=5,
+                )
+                for i in range(600)
+            ]
+        )
+        rebuild_soldes()
+        lignes = [
+            {
+                "produit_id": self.produits[i % 10].pk,
+                "numero_lot": f"{'OLD' if i < 600 else 'NEW'}{i}",
+                "quantite": 2,
+                "date_peremption": (today + timedelta(days=400)).isoformat(),
+            }
+            for i in range(1200)
+        ]
+        token = RefreshToken.for_user(self.admin).access_token
+        # Over its budget: a query more per KEYS_PER_QUERY lots
+        with self.assertLogs("core.profiling", "WARNING") as logs:
+            response = self.client.post(
+                "/api/stock/reception/",
+                {"fournisseur_id": self.fournisseur.pk, "lignes": lignes},
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Bearer {token}",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("(stock_reception) made", logs.output[0])
+        self.assertIn("over its budget of 30", logs.output[0])
+        self.assertEqual(LotProduit.objects.count(), 1200)
+        self.assertEqual(
+            LotProduit.objects.aggregate(total=Sum("quantite_actuelle"))["total"],
+            600 * 5 + 1200 * 2,
+        )
+        self.assertEqual(MouvementStock.objects.count(), 1200)
+        self.assertEqual(check_soldes(), [])
+        self.assertEqual(check_echeances(), [])
+
+
+class CatalogueImportTests(TestCase):
+    def test_code_interne_claimed_once_per_import(self):
+        Produit.objects.create(
+            code_national="CN0",
+            code_interne="PR0",
+            denomination="Existant",
+            forme_pharmaceutique="Comprimé",
+            dosage="500mg",
+            conditionnement="Boîte",
+            unite_mesure="CP",
+        )
+        rows = [
+            "code_national;code_interne;denomination;forme_pharmaceutique;dosage;"
+            "conditionnement;unite_mesure"
+        ] + [
+            f"CN{i};{code_interne};Produit {i};Comprimé;500mg;Boîte;CP"
+            for i, code_interne in enumerate(["PR0", "PR1", "PR1", "PR1", "PR2"], 1)
+        ]
+        stream = io.BytesIO("\n".join(rows).encode())
+        result = import_file(stream, "csv", batch_size=3)
+
+        self.assertEqual((result.crees, result.rejetes), (2, 3))
+        self.assertEqual(
+            [(e["ligne"], e["code_national"]) for e in result.erreurs],
+            [(2, "CN1"), (4, "CN3"), (5, "CN4")],
+        )
+        self.assertEqual(Produit.objects.get(code_interne="PR1").code_national, "CN2")
+        self.assertEqual(Produit.objects.get(code_interne="PR2").code_national, "CN5")
+
+
+class ProductSearchTests(TestCase):
+    def produit(self, code_national, denomination, dci=""):
+        return Produit.objects.create(
+            code_national=code_national,
+            denomination=denomination,
+            dci=dci,
+            forme_pharmaceutique="Comprimé",
+            dosage="500mg",
+            conditionnement="Boîte",
+            unite_mesure="CP",
+        )
+
+    def search(self, term):
+        return set(
+            search_produits(Produit.objects.all(), term).values_list(
+                "code_national", flat=True
+            )
+        )
+
+    def test_every_word_must_match(self):
+        if connection.vendor == "sqlite":
+            self.assertTrue(product_search._fts_available())
+        self.produit("CN1", "Doliprane 500", dci="Paracétamol")
+        self.produit("CN2", "Clamoxyl 500", dci="Amoxicilline")
+        self.assertEqual(self.search("500"), {"CN1", "CN2"})
+        self.assertEqual(self.search("dolip 500"), {"CN1"})
+        # Words found in different fields, in any order
+        self.assertEqual(self.search("amoxi CLAMOX"), {"CN2"})
+        self.assertEqual(self.search("doliprane amoxicilline"), set())
+        # Too short for the index
+        self.assertEqual(self.search("cl 500"), {"CN2"})
+
+    def test_index_follows_saves_and_deletes(self):
+        produit = self.produit("CN1", "Doliprane")
+        self.assertEqual(self.search("doliprane"), {"CN1"})
+        produit.denomination = "Efferalgan"
+        produit.save()
+        self.assertEqual(self.search("doliprane"), set())
+        self.assertEqual(self.search("efferalgan"), {"CN1"})
+        produit.delete()
+        self.assertEqual(self.search("efferalgan"), set())
+
+    def test_catalogue_import_is_indexed(self):
+        self.produit("CN1", "Doliprane")
+        rows = [
+            "code_national;denomination;forme_pharmaceutique;dosage;conditionnement;unite_mesure",
+            "CN1;Efferalgan;Comprimé;500mg;Boîte;CP",
+            "CN2;Clamoxyl;Gélule;500mg;Boîte;GEL",
+        ]
+        result = import_file(io.BytesIO("\n".join(rows).encode()), "csv")
+        self.assertEqual((result.crees, result.mis_a_jour), (1, 1))
+        self.assertEqual(self.search("doliprane"), set())
+        self.assertEqual(self.search("efferalgan"), {"CN1"})
+        self.assertEqual(self.search("clamoxyl"), {"CN2"})
+
+
+class ValuationTests(TestCase):
+    def test_totals_match_the_lots(self):
+        rng = random.Random(11)
+        magasins = [
+            Magasin.objects.create(code_magasin=f"M{i}", nom=f"Magasin {i}") for i in range(2)
+        ]
+        produits = [
+            Produit.objects.create(
+                code_national=f"CN{i}",
+                denomination=f"Produit {i}",
+                forme_pharmaceutique="-",
+                dosage="-",
+                conditionnement="-",
+                unite_mesure="U",
+                type_produit=type_produit,
+                categorie_surveillance=categorie,
+            )
+            for i, (type_produit, categorie) in enumerate(
+                [("MEDICAMENT", "NORMAL"), ("MEDICAMENT", "PSYCHOTROPE"), ("CONSOMMABLE", "NORMAL")]
+            )
+        ]
+        today = timezone.now().date()
+        lots = LotProduit.objects.bulk_create(
+            [
+                LotProduit(
+                    produit=rng.choice(produits),
+                    magasin=rng.choice(magasins),
+                    numero_lot=f"L{i}",
+                    date_peremption=today + timedelta(days=100),
+                    date_reception=today,
+                    quantite_initiale=100,
+                    quantite_actuelle=rng.randint(0, 100),
+                    # Some lots have no price, some are not available
+                    prix_unitaire_achat=(
+                        None if i % 7 == 0 else Decimal(rng.randint(1, 99999)) / 100
+                    ),
+                    statut="BLOQUE" if i % 5 == 0 else "DISPONIBLE",
+                )
+                for i in range(60)
+            ]
+        )
+
+        def expected(magasin=None):
+            return sum(
+                (
+                    lot.quantite_actuelle * lot.prix_unitaire_achat
+                    for lot in lots
+                    if lot.statut == "DISPONIBLE"
+                    and lot.prix_unitaire_achat is not None
+                    and magasin in (None, lot.magasin)
+                ),
+                Decimal("0.00"),
+            )
+
+        self.assertEqual(stock_value(), expected())
+        result = valuation()
+        self.assertEqual(result["valeur_totale"], expected())
+        for breakdown in ("par_magasin", "par_type_produit", "par_categorie_surveillance"):
+            self.assertEqual(sum(row["valeur"] for row in result[breakdown]), expected())
+        for magasin in magasins:
+            self.assertEqual(stock_value(magasin), expected(magasin))
+            self.assertEqual(
+                next(r for r in result["par_magasin"] if r["magasin_id"] == magasin.pk)["valeur"],
+                expected(magasin),
+            )
+
+
+class OrdersOverviewTests(TestCase):
+    def test_pending_previews_per_service(self):
+        statuts = {
+            "A": ["EN_ATTENTE", "VALIDEE", "LIVREE"] * 4,
+            "B": ["VALIDEE", "ANNULEE"],
+            "C": [],
+        }
+        services = {
+            code: Service.objects.create(code_service=code, nom=f"Service {code}")
+            for code in statuts
+        }
+        # Interleaved, so that the ids of a service are not contiguous
+        for i in range(12):
+            for code, liste in statuts.items():
+                if i < len(liste):
+                    CommandeService.objects.create(
+                        numero_commande=f"CMD-{code}-{i}", service=services[code], statut=liste[i]
+                    )
+
+        overview = {
+            row["service_code"]: row for row in compute_orders_overview()["magasins"]
+        }
+        for code, liste in statuts.items():
+            pending = list(
+                CommandeService.objects.filter(
+                    service=services[code], statut__in=["EN_ATTENTE", "VALIDEE"]
+                )
+                .order_by("id")
+                .values_list("numero_commande", flat=True)[:PENDING_PREVIEW_SIZE]
+            )
+            self.assertEqual(
+                [o["numero_commande"] for o in overview[code]["pending_orders"]], pending
+            )
+            self.assertEqual(overview[code]["total_commandes"], len(liste))
+        self.assertEqual(len(overview["A"]["pending_orders"]), PENDING_PREVIEW_SIZE)
+        self.assertEqual(overview["A"]["en_attente"], 4)
+        self.assertEqual(len(overview["B"]["pending_orders"]), 1)
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        magasin = Magasin.objects.create(code_magasin="PRINCIPAL", nom="Pharmacie Centrale")
+        produit = Produit.objects.create(
+            code_national="CN1",
+            denomination="Produit <é> & \"cité\"",
+            forme_pharmaceutique="-",
+            dosage="-",
+            conditionnement="-",
+            unite_mesure="U",
+        )
+        today = timezone.now().date()
+        LotProduit.objects.bulk_create(
+            [
+                LotProduit(
+                    produit=produit,
+                    magasin=magasin,
+                    numero_lot=f"L{i}",
+                    date_peremption=today + timedelta(days=i),
+                    date_reception=today,
+                    quantite_initiale=i,
+                    quantite_actuelle=i,
+                )
+                for i in range(20)
+            ]
+        )
+        cls.admin = Utilisateur.objects.create_superuser("export", "x@x.dz", "x")
+
+    def export(self, extension):
+        token = RefreshToken.for_user(self.admin).access_token
+        # Streamed in several chunks
+        with mock.patch("core.exports.CHUNK_SIZE", 7):
+            response = self.client.get(
+                f"/api/exports/lots.{extension}", HTTP_AUTHORIZATION=f"Bearer {token}"
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            return b"".join(response.streaming_content)
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export("csv").decode("utf-8-sig"))))
+        self.assertEqual(rows[0], [title for title, _ in LOT_COLUMNS])
+        self.assertEqual(len(rows), 21)
+        self.assertEqual(rows[1][2], 'Produit <é> & "cité"')
+
+    def test_xlsx(self):
+        with zipfile.ZipFile(io.BytesIO(self.export("xlsx"))) as archive:
+            self.assertIsNone(archive.testzip())
+            sheet = archive.read("xl/worksheets/sheet1.xml").decode()
+        self.assertEqual(sheet.count("<row>"), 21)
+        self.assertIn("Numéro de lot", sheet)
+        self.assertIn("Produit &lt;é&gt; &amp; \"cité\"", sheet)
+
+
+class JournalSinkTests(TestCase):
+    def setUp(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+        settings_override = override_settings(
+            JOURNAL_WRITER={
+                "MODE": "buffered",
+                "BATCH_SIZE": 3,
+                "FLUSH_INTERVAL": 3600,
+                "SPOOL_DIR": self.spool_dir,
+            }
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def entry(self, description):
+        return {"categorie": "STOCK", "action": "CREATE", "description": description}
+
+    def write(self, sink, *descriptions):
+        with self.captureOnCommitCallbacks(execute=True):
+            for description in descriptions:
+                sink.write(self.entry(description))
+
+    def spool(self, name, *descriptions):
+        with open(os.path.join(self.spool_dir, name), "w", encoding="utf-8") as spool:
+            for description in descriptions:
+                spool.write(json.dumps(self.entry(description)) + "\n")
+
+    def descriptions(self):
+        return sorted(Journal.objects.values_list("description", flat=True))
+
+    def test_flushes_full_batches(self):
+        sink = JournalSink()
+        self.write(sink, "a", "b")
+        self.assertEqual(Journal.objects.count(), 0)
+        with open(sink.spool_path, encoding="utf-8") as spool:
+            self.assertEqual(len(spool.readlines()), 2)
+
+        self.write(sink, "c")
+        self.assertEqual(self.descriptions(), ["a", "b", "c"])
+        self.assertEqual(sink.spool_path.stat().st_size, 0)
+
+        self.write(sink, "d")
+        sink.close()
+        self.assertEqual(self.descriptions(), ["a", "b", "c", "d"])
+        self.assertFalse(sink.spool_path.exists())
+
+    def test_replays_dead_spools_before_appending(self):
+        # Left by a worker that had this process's PID
+        self.spool(f"journal-{os.getpid()}.jsonl", "old 1", "old 2")
+        sink = JournalSink()
+        self.write(sink, "new")
+        self.assertEqual(self.descriptions(), ["old 1", "old 2"])
+        self.assertEqual(os.listdir(self.spool_dir), [sink.spool_path.name])
+        sink.close()
+        self.assertEqual(self.descriptions(), ["new", "old 1", "old 2"])
+
+    def test_live_spools_are_left_alone(self):
+        live = JournalSink()
+        self.write(live, "live")
+        self.spool("journal-1-dead.jsonl", "dead")
+
+        self.assertEqual(recover_spool(all_files=True), 1)
+        self.assertEqual(self.descriptions(), ["dead"])
+        self.assertTrue(live.spool_path.exists())
+        live.close()
+        self.assertEqual(self.descriptions(), ["dead", "live"])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_replayed_spool_left_behind_is_not_replayed_again(self):
+        # Emptied by a replay that died before removing it
+        self.spool("journal-1-replayed.jsonl")
+        self.spool("journal-2-dead.jsonl", "dead")
+        self.assertEqual(recover_spool(all_files=True), 1)
+        self.assertEqual(recover_spool(all_files=True), 0)
+        self.assertEqual(self.descriptions(), ["dead"])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_sync_mode(self):
+        with override_settings(JOURNAL_WRITER={"MODE": "sync", "SPOOL_DIR": self.spool_dir}):
+            JournalSink().write(self.entry("sync"))
+        self.assertEqual(self.descriptions(), ["sync"])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SharedCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_stamped_key_changes_after_commit(self):
+        key, _ = project_cache.stamped_key("test", ["catalogue"], "x")
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            project_cache.invalidate(["catalogue"])
+        self.assertEqual(project_cache.stamped_key("test", ["catalogue"], "x")[0], key)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(project_cache.stamped_key("test", ["catalogue"], "x")[0], key)
+
+    def test_saved_instance_invalidates_its_scopes(self):
+        magasin = Magasin.objects.create(nom="Cache", code_magasin="CACHE")
+        with self.captureOnCommitCallbacks(execute=True):
+            produit = Produit.objects.create(
+                code_national="CACHE-1",
+                denomination="Cache",
+                forme_pharmaceutique="-",
+                dosage="-",
+                conditionnement="-",
+                unite_mesure="U",
+            )
+        before = project_cache.stamps([f"magasin:{magasin.pk}", "catalogue"])
+        with self.captureOnCommitCallbacks(execute=True):
+            LotProduit.objects.create(
+                produit=produit,
+                magasin=magasin,
+                numero_lot="C1",
+                date_peremption=timezone.now().date() + timedelta(days=30),
+                date_reception=timezone.now().date(),
+                quantite_initiale=1,
+                quantite_actuelle=1,
+            )
+        after = project_cache.stamps([f"magasin:{magasin.pk}", "catalogue"])
+        self.assertNotEqual(before[0], after[0])
+        self.assertEqual(before[1], after[1])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PermissionMatrixTests(TestCase):
+    """The cached permission matrix follows role and permission changes."""
+
+    def status(self, user):
+        token = RefreshToken.for_user(user).access_token
+        return self.client.get(
+            "/api/utilisateurs/", HTTP_AUTHORIZATION=f"Bearer {token}"
+        ).status_code
+
+    def permission(self, codename):
+        return Permission.objects.create(
+            name=codename, codename=codename, resource="utilisateurs", can_view=True
+        )
+
+    def test_changes_seen_by_the_next_request(self):
+        # Created in the test: invalidations made earlier in the test
+        # transaction would only run when it commits
+        with self.captureOnCommitCallbacks(execute=True):
+            permission = self.permission("can_view_utilisateurs")
+            role = Role.objects.create(name="Lecteur")
+            user = Utilisateur.objects.create_user("lecteur", "l@x.dz", "x", role=role)
+        self.assertEqual(self.status(user), 403)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            role.permissions.add(permission)
+        self.assertEqual(self.status(user), 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            permission.can_view = False
+            permission.save()
+        self.assertEqual(self.status(user), 403)
+
+        # The user's own permissions: those of another role
+        with self.captureOnCommitCallbacks(execute=True):
+            autre = Role.objects.create(name="Gestionnaire")
+            autre.permissions.add(self.permission("can_manage_utilisateurs"))
+            user.role = autre
+            user.save()
+        self.assertEqual(self.status(user), 200)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DashboardSnapshotTests(TestCase):
+    def test_conditional_get(self):
+        # Created in the test so that the cache stamps are bumped on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            magasin = Magasin.objects.create(
+                code_magasin="PRINCIPAL", nom="Pharmacie Centrale", type_magasin="PRINCIPAL"
+            )
+            lot = LotProduit.objects.create(
+                produit=Produit.objects.create(
+                    code_national="CN1",
+                    denomination="Produit",
+                    forme_pharmaceutique="-",
+                    dosage="-",
+                    conditionnement="-",
+                    unite_mesure="U",
+                ),
+                magasin=magasin,
+                numero_lot="L1",
+                date_peremption=timezone.now().date() + timedelta(days=20),
+                date_reception=timezone.now().date(),
+                quantite_initiale=10,
+                quantite_actuelle=10,
+                prix_unitaire_achat=Decimal("2.00"),
+            )
+            rebuild_soldes()
+            admin = Utilisateur.objects.create_superuser("etag", "e@x.dz", "x")
+        token = RefreshToken.for_user(admin).access_token
+        self.client.defaults["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+
+        response = self.client.get("/api/dashboard/kpis/")
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        response = self.client.get("/api/dashboard/kpis/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f"/api/lots/{lot.pk}/", {"quantite_actuelle": 4}, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/api/dashboard/kpis/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["stock_value"], 8.0)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class AsyncViewTests(TestCase):
+    """The async views serve the same payloads as the DRF views."""
+
+    @classmethod
+    def setUpTestData(cls):
+        magasin = Magasin.objects.create(
+            code_magasin="PRINCIPAL", nom="Pharmacie Centrale", type_magasin="PRINCIPAL"
+        )
+        for i in range(3):
+            produit = Produit.objects.create(
+                code_national=f"AS{i}",
+                denomination=f"Async {i}",
+                forme_pharmaceutique="-",
+                dosage="-",
+                conditionnement="-",
+                unite_mesure="U",
+            )
+            LotProduit.objects.create(
+                produit=produit,
+                magasin=magasin,
+                numero_lot=f"AS{i}",
+                date_peremption=timezone.now().date() + timedelta(days=10),
+                date_reception=timezone.now().date(),
+                quantite_initiale=5,
+                quantite_actuelle=5,
+            )
+        Journal.objects.create(categorie="STOCK", action="UPDATE", description="Async")
+        cls.user = Utilisateur.objects.create_superuser("async", "a@x.dz", "x")
+
+    def setUp(self):
+        cache.clear()
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.factory = RequestFactory(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_same_payloads(self):
+        for name, query in (
+            ("stock_list", "?page=1&page_size=2"),
+            ("stock_list", "?cursor=&search=async"),
+            ("produits_with_stock", ""),
+            ("journal_list", "?cursor="),
+            ("dashboard_kpis", ""),
+        ):
+            with self.subTest(name=name, query=query):
+                expected = getattr(api_views, name)(self.factory.get("/" + query))
+                expected.render()
+                response = async_to_sync(getattr(async_views, name))(
+                    self.factory.get("/" + query)
+                )
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(json.loads(response.content), json.loads(expected.content))
+
+    def test_invalid_cursors(self):
+        cursors = [
+            "not-base64!",
+            encode_cursor([{"a": 1}, 1]),
+            encode_cursor([None, 1]),
+            encode_cursor(["pas une date", 1]),
+            encode_cursor([timezone.now().isoformat(), "abc"]),
+        ]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                request = self.factory.get("/", {"cursor": cursor})
+                self.assertEqual(api_views.journal_list(request).status_code, 400)
+                response = async_to_sync(async_views.journal_list)(
+                    self.factory.get("/", {"cursor": cursor})
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(json.loads(response.content), {"error": "Curseur invalide"})
+
+    def test_requires_authentication(self):
+        response = async_to_sync(async_views.stock_list)(RequestFactory().get("/"))
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("WWW-Authenticate", response)
+
+
+class WriteTransactionTests(TransactionTestCase):
+    def test_begins_immediate_on_sqlite(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite only")
+        with CaptureQueriesContext(connection) as queries:
+            with write_transaction():
+                Magasin.objects.count()
+            with transaction.atomic():
+                Magasin.objects.count()
+        begins = [q["sql"] for q in queries if q["sql"].startswith("BEGIN")]
+        self.assertEqual(begins, ["BEGIN IMMEDIATE", "BEGIN"])
+
+    def test_nested_is_a_savepoint(self):
+        with transaction.atomic():
+            with write_transaction():
+                self.assertTrue(connection.in_atomic_block)
+
+
+class ConnectionTimingTests(TestCase):
+    def test_connect_is_timed(self):
+        count, seconds = connection_stats().get("default", (0, 0.0))
+        extra = connections.create_connection("default")
+        try:
+            extra.ensure_connection()
+        finally:
+            extra.close()
+        self.assertEqual(connection_stats()["default"][0], count + 1)
+        self.assertGreater(connection_stats()["default"][1], seconds)
+
+
+class SqliteTemplateTests(SimpleTestCase):
+    def test_runtime_database_copied_once(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        template = os.path.join(directory.name, "shipped.sqlite3")
+        path = os.path.join(directory.name, "runtime.sqlite3")
+        with open(template, "wb") as f:
+            f.write(b"shipped")
+
+        with override_settings(SQLITE_TEMPLATE=template, SQLITE_PATH=path):
+            copy_sqlite_template(os.path.join(directory.name, "other.sqlite3"))
+            self.assertEqual(os.listdir(directory.name), ["shipped.sqlite3"])
+            copy_sqlite_template(path)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"shipped")
+            with open(path, "wb") as f:
+                f.write(b"runtime")
+            copy_sqlite_template(path)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"runtime")
+        self.assertEqual(
+            sorted(os.listdir(directory.name)), ["runtime.sqlite3", "shipped.sqlite3"]
+        )
+
+
+class ProfilingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Magasin.objects.create(
+            code_magasin="PRINCIPAL", nom="Pharmacie Centrale", type_magasin="PRINCIPAL"
+        )
+        cls.admin = Utilisateur.objects.create_superuser("prof", "p@x.dz", "x")
+        cls.user = Utilisateur.objects.create_user("prof_user", "u@x.dz", "x")
+
+    def auth(self, user):
+        return {"HTTP_AUTHORIZATION": f"Bearer {RefreshToken.for_user(user).access_token}"}
+
+    def test_server_timing_and_metrics(self):
+        response = self.client.get("/api/stock/", **self.auth(self.admin))
+        self.assertNotIn("Server-Timing", response)
+
+        client = self.client_class()
+        with override_settings(PROFILING={**settings.PROFILING, "SERVER_TIMING": True}):
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get("/api/stock/", **self.auth(self.admin))
+        self.assertEqual(response.status_code, 200)
+        timing = response["Server-Timing"]
+        self.assertIn(f'desc="{len(queries)} queries"', timing)
+        self.assertIn("serialization;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+        response = self.client.get("/api/_metrics/", **self.auth(self.admin))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'pharmacie_request_queries_count{view="stock_list"}', response.content.decode()
+        )
+        response = self.client.get("/api/_metrics/", **self.auth(self.user))
+        self.assertEqual(response.status_code, 401)
+
+    def test_query_budget(self):
+        with override_settings(
+            PROFILING={"QUERY_BUDGETS": {"stock_list": 1}, "FAIL_ON_QUERY_BUDGET": True}
+        ):
+            client = self.client_class()
+            with self.assertRaises(QueryBudgetExceeded):
+                client.get("/api/stock/", **self.auth(self.admin))
+            self.assertEqual(client.get("/api/user/me/", **self.auth(self.admin)).status_code, 200)
+
+    @skipIf(os.name == "nt", "the metrics are only shared with fcntl")
+    def test_remove_shared_store(self):
+        # Not the block of a server running from this directory
+        with override_settings(PROFILING={"SLOTS": 2, "WINDOW": 4}):
+            store = MetricsStore(get_config())
+            store.close()
+            remove_shared_store()
+            remove_shared_store()
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(store.name)
+
+
+def seed_reference():
+    """Permissions, roles, magasins, services, fournisseurs and users of seed_db."""
+    permissions = {}
+    for resource in RESOURCES:
+        for action in ("view", "add", "change", "delete"):
+            permissions[f"{resource}.{action}"] = Permission.objects.create(
+                name=f"Can {action} {resource}",
+                codename=f"can_{action}_{resource}",
+                resource=resource,
+                **{f"can_{action}": True},
+            )
+    roles = {}
+    for name, config in PERMISSIONS_CONFIG.items():
+        role = roles[name] = Role.objects.create(name=name)
+        role.permissions.set(
+            [
+                permissions[f"{resource}.{action}"]
+                for resource, actions in config.items()
+                for action in actions
+            ]
+        )
+    magasins = {
+        m["code"]: Magasin.objects.create(
+            code_magasin=m["code"], nom=m["nom"], type_magasin=m["type"]
+        )
+        for m in MAGASINS
+    }
+    services = {
+        s["code"]: Service.objects.create(
+            code_service=s["code"],
+            nom=s["nom"],
+            type_service=s["type"],
+            magasin=magasins.get(s.get("magasin")),
+        )
+        for s in SERVICES
+    }
+    Fournisseur.objects.bulk_create(
+        [
+            Fournisseur(
+                code_fournisseur=f["code"], raison_sociale=f["name"], type_fournisseur=f["type"]
+            )
+            for f in FOURNISSEURS
+        ]
+    )
+    Utilisateur.objects.bulk_create(
+        [
+            Utilisateur(
+                username=u["username"],
+                email=u["email"],
+                fonction=u["fonction"],
+                role=roles.get(u["fonction"]),
+                service=services[u["service"]],
+            )
+            for u in USERS
+        ]
+    )
+
+
+def seed_scale(start, stop):
+    """Add copies ``start`` to ``stop - 1`` of the seed_db catalogue: every
+    medication with its lots (main and service magasins), movements, service
+    orders and journal entries."""
+    rng = random.Random(stop)
+    today = timezone.now().date()
+    principal = Magasin.objects.get(code_magasin="PRINCIPAL")
+    services = list(Service.objects.exclude(magasin=principal).exclude(magasin=None))
+    users = list(Utilisateur.objects.all())
+    for copy in range(start, stop):
+        produits = Produit.objects.bulk_create(
+            [
+                Produit(
+                    code_national=f"3{copy:03d}{i + 1:08d}",
+                    code_interne=f"PR{copy:02d}{i + 1:04d}",
+                    denomination=med["name"] if copy == 0 else f"{med['name']} ({copy})",
+                    forme_pharmaceutique=med["form"],
+                    dosage=med["dosage"],
+                    dci=med["dci"],
+                    conditionnement=med["cond"],
+                    unite_mesure="Unité",
+                    fabricant=med["fab"],
+                    stock_alerte=rng.randint(50, 200),
+                )
+                for i, med in enumerate(MEDICATIONS)
+            ]
+        )
+        lots = []
+        for produit in produits:
+            for magasin in (principal, principal, rng.choice(services).magasin):
+                quantite = rng.randint(0, 500)
+                lots.append(
+                    LotProduit(
+                        produit=produit,
+                        magasin=magasin,
+                        numero_lot=f"L{produit.code_national}-{len(lots)}",
+                        date_peremption=today + timedelta(days=rng.randint(-30, 700)),
+                        date_reception=today - timedelta(days=rng.randint(1, 180)),
+                        quantite_initiale=500,
+                        quantite_actuelle=quantite,
+                        statut="DISPONIBLE" if quantite else "EPuISE",
+                        prix_unitaire_achat=Decimal(rng.randint(50, 5000)),
+                    )
+                )
+        LotProduit.objects.bulk_create(lots)
+        MouvementStock.objects.bulk_create(
+            [
+                MouvementStock(
+                    numero_mouvement=f"MVT-S{copy}-{i}",
+                    produit=lot.produit,
+                    lot=lot,
+                    type_mouvement="ENTREE_ACHAT",
+                    quantite=lot.quantite_initiale,
+                    magasin_destination=lot.magasin,
+                )
+                for i, lot in enumerate(lots)
+            ]
+        )
+        commandes = CommandeService.objects.bulk_create(
+            [
+                CommandeService(
+                    numero_commande=f"CMD-S{copy}-{service.pk}-{i}",
+                    service=service,
+                    statut=rng.choice(["EN_ATTENTE", "LIVREE", "ANNULEE"]),
+                )
+                for service in services
+                for i in range(5)
+            ]
+        )
+        LigneCommandeService.objects.bulk_create(
+            [
+                LigneCommandeService(
+                    commande=commande, produit=produit, quantite_demandee=rng.randint(1, 20)
+                )
+                for commande in commandes
+                for produit in rng.sample(produits, 3)
+            ]
+        )
+        Journal.objects.bulk_create(
+            [
+                Journal(
+                    categorie="STOCK",
+                    action="RECEPTION",
+                    description=f"Réception {copy}-{i}",
+                    utilisateur=rng.choice(users),
+                )
+                for i in range(50)
+            ]
+        )
+    rebuild_soldes()
+    index_produits()
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    PROFILING={**settings.PROFILING, "FAIL_ON_QUERY_BUDGET": True},
+    CACHES=TEST_CACHES,
+)
+class QueryBudgetTests(TestCase):
+    """Every route makes as many queries whatever the size of the data.
+
+    The seed_db catalogue is loaded at several scale factors and every
+    route is requested, as an admin and as a pharmacist, with the same
+    payloads; the query counts must not change, and stay within the query
+    budgets of settings.PROFILING.
+    """
+
+    SCALES = (1, 3)
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_reference()
+        cls.admin = Utilisateur.objects.create_superuser("budget", "b@x.dz", "x")
+        cls.pharmacien = Utilisateur.objects.get(username="bridja_fatima")
+        cls.pharmacien.set_password("x")
+        cls.pharmacien.save()
+
+    def measure(self, user, copy):
+        """{route: queries} for every route, the writes on the products of ``copy``."""
+        cache.clear()
+        self.runs += 1
+        token = RefreshToken.for_user(user)
+        headers = {"Authorization": f"Bearer {token.access_token}"}
+        counts = {}
+
+        def call(method, path, data=None, label=None, **kwargs):
+            if data is not None and "content_type" not in kwargs and method != "get":
+                kwargs["content_type"] = "application/json"
+                data = json.dumps(data)
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(self.client, method)(path, data, headers=headers, **kwargs)
+                if response.streaming:
+                    b"".join(response.streaming_content)
+            self.assertLess(response.status_code, 500, f"{method} {path}")
+            if user.is_superuser:
+                self.assertLess(response.status_code, 400, f"{method} {path}")
+            self.covered.add(resolve(path.split("?")[0]).view_name)
+            counts[label or f"{method} {path}"] = len(queries)
+            return response
+
+        call("post", "/api/token/", {"username": user.username, "password": "x"})
+        call("post", "/api/token/refresh/", {"refresh": str(token)})
+        for path in (
+            "/api/",
+            "/api/user/me/",
+            "/api/produits-with-stock/",
+            "/api/produits-with-stock/?search=amox",
+            "/api/dashboard/kpis/",
+            "/api/dashboard/valuation/",
+            "/api/dashboard/magasins-orders/",
+            "/api/lots/expiring/",
+            "/api/stock/",
+            "/api/stock/?search=amox",
+            "/api/stock/?cursor=",
+            "/api/stock/alertes/",
+            "/api/journals/",
+            "/api/journals/?cursor=",
+            "/api/exports/lots.csv",
+            "/api/exports/mouvements.csv",
+            "/api/exports/journal.xlsx",
+            "/api/exports/stock.csv",
+        ):
+            call("get", path)
+        if user.is_superuser:
+            call("get", "/api/_metrics/")
+        for prefix, model in (
+            ("produits", Produit),
+            ("lots", LotProduit),
+            ("mouvements", MouvementStock),
+            ("fournisseurs", Fournisseur),
+            ("services", Service),
+            ("commandes", CommandeService),
+            ("magasins", Magasin),
+            ("utilisateurs", Utilisateur),
+            ("roles", Role),
+            ("permissions", Permission),
+        ):
+            call("get", f"/api/{prefix}/", label=f"get {prefix}-list")
+            call(
+                "get",
+                f"/api/{prefix}/{model.objects.order_by('pk').first().pk}/",
+                label=f"get {prefix}-detail",
+            )
+
+        # Products that never left the main magasin, so that every run
+        # makes a first delivery to the service
+        produits = list(
+            Produit.objects.filter(code_national__startswith=f"3{copy:03d}").order_by("pk")[
+                5 * self.runs : 5 * self.runs + 5
+            ]
+        )
+        call(
+            "post",
+            "/api/stock/reception/",
+            {
+                "fournisseur_id": Fournisseur.objects.first().pk,
+                "lignes": [
+                    {
+                        "produit_id": p.pk,
+                        "numero_lot": f"REC-{self.runs}-{p.pk}",
+                        "quantite": 1000,
+                        "date_peremption": "2031-01-01",
+                    }
+                    for p in produits
+                ],
+            },
+        )
+        service = Service.objects.get(code_service="ONCOLOGIE")
+        response = call(
+            "post",
+            "/api/commandes-rapides/",
+            {
+                "service_id": service.pk,
+                "lignes": [{"produit_id": p.pk, "quantite_demandee": 10} for p in produits],
+            },
+        )
+        commande = f"/api/commandes/{response.json()['id']}/"
+        call("patch", commande, {"statut": "VALIDEE"}, label="patch commande VALIDEE")
+        call("patch", commande, {"statut": "EN_COURS"}, label="patch commande EN_COURS")
+        call("post", "/api/commandes/livrer/", {"commande_id": response.json()["id"]})
+        rows = "code_national,denomination,forme_pharmaceutique,dosage,conditionnement,unite_mesure\n"
+        rows += "".join(
+            f"9{self.runs:04d}{i},Import {i},Comprimé,1mg,Boîte,U\n" for i in range(5)
+        )
+        call(
+            "post",
+            "/api/produits/import/",
+            {"file": SimpleUploadedFile("produits.csv", rows.encode())},
+            label="post produits_import",
+            content_type=MULTIPART_CONTENT,
+        )
+        return counts
+
+    def test_query_counts_do_not_grow_with_the_data(self):
+        self.covered = set()
+        self.runs = 0
+        seed_scale(0, self.SCALES[0])
+        # Once beforehand, for the one-time queries of a process
+        self.measure(self.admin, 0)
+        self.measure(self.pharmacien, 0)
+
+        counts = {}
+        loaded = self.SCALES[0]
+        for scale in self.SCALES:
+            seed_scale(loaded, scale)
+            loaded = scale
+            for user in (self.admin, self.pharmacien):
+                counts[scale, user.username] = self.measure(user, scale - 1)
+
+        for user in (self.admin, self.pharmacien):
+            expected = counts[self.SCALES[0], user.username]
+            for scale in self.SCALES[1:]:
+                grown = {
+                    route: (expected[route], count)
+                    for route, count in counts[scale, user.username].items()
+                    if count != expected[route]
+                }
+                self.assertEqual(
+                    grown, {}, f"{user.username}: query counts at scale {scale}"
+                )
+
+        # Every route of the API is measured (the admin site aside)
+        routes = {name for name in view_names() if not name.startswith("admin:")}
+        self.assertEqual(routes - self.covered, set())
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class SyntheticDataTests(TestCase):
+    def test_seed_db_scale(self):
+        call_command("seed_db", scale=1, days=60, stdout=StringIO())
+
+        today = timezone.now().date()
+        copy = Produit.objects.filter(code_national__startswith="3001")
+        self.assertEqual(copy.count(), len(MEDICATIONS))
+        mouvements = MouvementStock.objects.filter(produit__in=copy)
+        lots = LotProduit.objects.filter(produit__in=copy)
+
+        def total(queryset, field):
+            return queryset.aggregate(total=Sum(field))["total"] or 0
+
+        entrees = total(mouvements.filter(type_mouvement="ENTREE_ACHAT"), "quantite")
+        transferts = mouvements.filter(type_mouvement="TRANSFERT")
+        sorties = mouvements.filter(type_mouvement="SORTIE_SERVICE")
+        self.assertGreater(total(sorties, "quantite"), 0)
+        # Stock is conserved: in the main magasin, and in the wards
+        principal = Magasin.objects.get(code_magasin="PRINCIPAL")
+        self.assertEqual(
+            total(lots.filter(magasin=principal), "quantite_actuelle"),
+            entrees - total(transferts, "quantite"),
+        )
+        self.assertEqual(
+            total(lots.exclude(magasin=principal), "quantite_actuelle"),
+            total(transferts, "quantite") - total(sorties, "quantite"),
+        )
+        # Deliveries match the order lines, and happened in the past
+        self.assertEqual(
+            total(LigneCommandeService.objects.filter(produit__in=copy), "quantite_livree"),
+            total(transferts, "quantite"),
+        )
+        self.assertLess(mouvements.latest("date_mouvement").date_mouvement.date(), today)
+        expired = lots.filter(
+            statut="DISPONIBLE",
+            quantite_actuelle__gt=0,
+            date_peremption__lt=today - timedelta(days=1),
+        )
+        self.assertFalse(expired.exists())
+        self.assertFalse(
+            Journal.objects.filter(entity_type="CommandeService", entity_id=None).exists()
+        )
+        self.assertEqual(check_soldes(), [])
+        self.assertEqual(check_echeances(), [])
@@ -0,0 +1,102 @@
+"""Stock valuation computed in the database.
+
+The value of a lot is quantite_actuelle * prix_unitaire_achat; only
+DISPONIBLE lots with a purchase price are valued. Sums are Decimal.
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+
+from .models import LotProduit
+
+VALEUR_LOT = ExpressionWrapper(
+    F("quantite_actuelle") * F("prix_unitaire_achat"),
+    output_field=DecimalField(max_digits=20, decimal_places=2),
+)
+ZERO = Decimal("0.00")
+
+
+def _money(value):
+    return (value or ZERO).quantize(ZERO)
+
+
+def valued_lots(magasin=None):
+    lots = LotProduit.objects.filter(
+        statut="DISPONIBLE", prix_unitaire_achat__isnull=False
+    )
+    if magasin is not None:
+        lots = lots.filter(magasin=magasin)
+    return lots
+
+
+def stock_value(magasin=None):
+    """Total value of the stock of ``magasin`` (every magasin if None)."""
+    return _money(valued_lots(magasin).aggregate(valeur=Sum(VALEUR_LOT))["valeur"])
+
+
+def valuation_rows(magasin=None):
+    """One grouped query: value, quantity and lot count per
+    (magasin, type_produit, categorie_surveillance)."""
+    return (
+        valued_lots(magasin)
+        .values(
+            "magasin_id",
+            "magasin__nom",
+            "produit__type_produit",
+            "produit__categorie_surveillance",
+        )
+        .annotate(
+            valeur=Sum(VALEUR_LOT),
+            quantite=Sum("quantite_actuelle"),
+            nombre_lots=Count("id"),
+        )
+        .order_by(
+            "magasin__nom", "produit__type_produit", "produit__categorie_surveillance"
+        )
+    )
+
+
+def _rollup(rows, key, label):
+    totals = defaultdict(lambda: {"valeur": ZERO, "quantite": 0, "nombre_lots": 0})
+    for row in rows:
+        total = totals[row[key]]
+        total["valeur"] += row["valeur"]
+        total["quantite"] += row["quantite"] or 0
+        total["nombre_lots"] += row["nombre_lots"]
+    return [
+        {label: value, **total}
+        for value, total in sorted(totals.items(), key=lambda item: -item[1]["valeur"])
+    ]
+
+
+def valuation(magasin=None):
+    """Stock value with breakdowns by magasin, type_produit and
+    categorie_surveillance, all derived from valuation_rows()."""
+    rows = [
+        {
+            "magasin_id": row["magasin_id"],
+            "magasin": row["magasin__nom"],
+            "type_produit": row["produit__type_produit"],
+            "categorie_surveillance": row["produit__categorie_surveillance"],
+            "valeur": _money(row["valeur"]),
+            "quantite": row["quantite"] or 0,
+            "nombre_lots": row["nombre_lots"],
+        }
+        for row in valuation_rows(magasin)
+    ]
+    par_magasin = _rollup(rows, "magasin_id", "magasin_id")
+    noms = {row["magasin_id"]: row["magasin"] for row in rows}
+    for total in par_magasin:
+        total["magasin"] = noms[total["magasin_id"]]
+
+    return {
+        "valeur_totale": sum((row["valeur"] for row in rows), ZERO),
+        "par_magasin": par_magasin,
+        "par_type_produit": _rollup(rows, "type_produit", "type_produit"),
+        "par_categorie_surveillance": _rollup(
+            rows, "categorie_surveillance", "categorie_surveillance"
+        ),
+        "details": rows,
+    }
@@ -1,4 +1,4 @@
-from django.db.models import Sum
+from django.db.models import F, Sum
 from django.utils.timezone import now, timedelta
 from .models import LotProduit, Produit
 
@@ -23,21 +23,15 @@ def dashboard_kpis():
     }
 
 def produits_en_alerte():
-    from .models import Produit, LotProduit
-
-    data = LotProduit.objects.values("produit").annotate(
-        total=Sum("quantite_actuelle")
+    """Products whose lots (every magasin and statut) hold no more than
+    stock_securite, in one query. Products without any lot are not listed;
+    see core.alertes for the tiers of the available stock."""
+    return list(
+        Produit.objects.annotate(total=Sum("lotproduit__quantite_actuelle"))
+        .filter(total__isnull=False, total__lte=F("stock_securite"))
+        .order_by("id")
     )
 
-    result = []
-
-    for item in data:
-        produit = Produit.objects.get(id=item["produit"])
-        if item["total"] <= produit.stock_securite:
-            result.append(produit)
-
-    return result
-
 def lots_proches_peremption(days=60):
     limit = now().date() + timedelta(days=days)
 
@@ -1,13 +1,35 @@
-"""Gunicorn config for Pharma Django project"""
+"""Gunicorn config for Pharma Django project
+
+SERVER_PROFILE selects how requests are served:
+- "sync" (default): pharmacie.wsgi with sync workers, one request at a time
+  per worker.
+- "async": pharmacie.asgi with uvicorn workers (pip install uvicorn); the
+  read-heavy endpoints run as async views (settings.ASYNC_VIEWS) so a slow
+  dashboard query no longer blocks the whole worker.
+
+Compare both with: python manage.py bench_dashboard
+"""
 import multiprocessing
+import os
+
+profile = os.environ.get("SERVER_PROFILE", "sync")
 
 # Server socket
-bind = "0.0.0.0:8000"
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+if profile == "async":
+    wsgi_app = "pharmacie.asgi:application"
+    worker_class = "uvicorn.workers.UvicornWorker"
+    raw_env = ["ASYNC_VIEWS=1"]
+elif profile == "sync":
+    wsgi_app = "pharmacie.wsgi:application"
+    worker_class = "sync"
+else:
+    raise RuntimeError(f"Unknown SERVER_PROFILE: {profile!r} (sync or async)")
+# Concurrent connections per worker (async profile only)
 worker_connections = 1000
 max_requests = 1000
 max_requests_jitter = 50
@@ -34,3 +56,14 @@ tmp_upload_dir = None
 # SSL (disable for development)
 keyfile = None
 certfile = None
+
+
+def on_exit(server):
+    """Remove the request metrics shared by the workers (core/profiling.py)."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pharmacie.settings")
+    import django
+
+    django.setup()
+    from core.profiling import remove_shared_store
+
+    remove_shared_store()
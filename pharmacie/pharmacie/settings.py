@@ -11,7 +11,9 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
 from pathlib import Path
+import hashlib
 from datetime import timedelta
+import os
 import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -59,16 +61,8 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
 }
 
-# Cache configuration (use local memory cache for development)
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
-    }
-}
-
 CORS_ALLOW_ALL_ORIGINS = True
-CORS_EXPOSE_HEADERS = ["X-Total-Count"]
+CORS_EXPOSE_HEADERS = ["X-Total-Count", "X-Approximate-Count", "ETag", "Last-Modified"]
 
 CORS_ALLOW_CREDENTIALS = True
 
@@ -87,6 +81,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -121,18 +116,179 @@ WSGI_APPLICATION = 'pharmacie.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
+# The backends of core/backends are Django's, timing the connections they
+# open (core/database.py).
+# The installation's database is SQLITE_PATH, db.sqlite3 by default (not
+# tracked: the journal mode of the tuned profile is recorded in the file).
+# When it does not exist yet it is created as a copy of the shipped initial
+# data, db.template.sqlite3 (tracked, and bundled by pharmacie_server.spec).
+SQLITE_TEMPLATE = BASE_DIR / 'db.template.sqlite3'
+SQLITE_PATH = Path(os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'))
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'ENGINE': 'core.backends.sqlite3',
+        'NAME': SQLITE_PATH,
     }
 }
 
-# Support for Railway/Koyeb PostgreSQL
-import os
+# Serve the read-heavy endpoints with the async views of core/async_views.py;
+# set by gunicorn.conf.py for the "async" (uvicorn) server profile.
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', '').lower() in ('1', 'true')
+
+# SQLite profile (SQLITE_PROFILE). "tuned", the default:
+# - WAL journal: readers no longer block the writer, nor the writer readers.
+# - synchronous=NORMAL: no fsync per commit; safe from corruption in WAL mode,
+#   a power loss may only lose the last commits.
+# - 256 MB memory map and 32 MB page cache per connection, temporary tables
+#   in memory.
+# - busy_timeout: wait up to 20 s for the write lock instead of failing with
+#   "database is locked"; stock writes take it up front (core/database.py).
+# - Connections are kept open between requests (not with the async views,
+#   whose ORM calls run in a different thread per request).
+# "legacy": Django's defaults (rollback journal, one connection per request).
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'tuned')
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -32 * 1024,  # in KiB when negative
+    'temp_store': 'MEMORY',
+    'busy_timeout': 20000,
+}
+if SQLITE_PROFILE == 'tuned':
+    DATABASES['default'].update(
+        CONN_MAX_AGE=0 if ASYNC_VIEWS else 600,
+        CONN_HEALTH_CHECKS=True,
+        OPTIONS={
+            'init_command': ';'.join(
+                f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()
+            ),
+        },
+    )
+elif SQLITE_PROFILE != 'legacy':
+    raise ValueError(f"Unknown SQLITE_PROFILE: {SQLITE_PROFILE!r} (tuned or legacy)")
+
+# Support for Railway/Koyeb PostgreSQL (DATABASE_URL). Connections are:
+# - kept open between requests and checked before reuse (CONN_MAX_AGE),
+# - or, with DB_POOL_MAX_SIZE set, taken from a psycopg pool shared by the
+#   threads of a worker, which checks them on checkout too (requires
+#   psycopg[pool]; use it with the async views, whose ORM calls run in a
+#   different thread per request).
+# Queries are sent with server-side parameter binding, so psycopg prepares
+# a statement once it ran DB_PREPARE_THRESHOLD times on a connection and
+# reuses it: the dashboard, stock and journal queries are parsed and
+# planned once per connection. Set DB_PREPARE_THRESHOLD=off behind a
+# pgbouncer older than 1.21 in transaction mode, together with
+# DB_DISABLE_SERVER_SIDE_CURSORS=1: QuerySet.iterator() (exports, KPI and
+# expiry rebuilds) otherwise reads through named server-side cursors,
+# chunk by chunk.
 if os.environ.get('DATABASE_URL'):
     import dj_database_url
-    DATABASES['default'] = dj_database_url.parse(os.environ.get('DATABASE_URL'))
+    DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '0'))
+    DB_PREPARE_THRESHOLD = os.environ.get('DB_PREPARE_THRESHOLD', '5')
+    DATABASES['default'] = dj_database_url.parse(
+        os.environ.get('DATABASE_URL'),
+        conn_max_age=0 if DB_POOL_MAX_SIZE or ASYNC_VIEWS else 600,
+        conn_health_checks=True,
+    )
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+        DATABASES['default']['ENGINE'] = 'core.backends.postgresql'
+        options = DATABASES['default'].setdefault('OPTIONS', {})
+        if DB_PREPARE_THRESHOLD.lower() != 'off':
+            options['server_side_binding'] = True
+            options['prepare_threshold'] = int(DB_PREPARE_THRESHOLD)
+        if DB_POOL_MAX_SIZE:
+            options['pool'] = {
+                'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', '2')),
+                'max_size': DB_POOL_MAX_SIZE,
+                'timeout': float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+                'max_idle': 300,
+            }
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = os.environ.get(
+            'DB_DISABLE_SERVER_SIDE_CURSORS', ''
+        ).lower() in ('1', 'true')
+
+# Journal (audit log) writer: "buffered" batches entries per worker and writes
+# them with bulk_create after the response, backed by a spool file in
+# SPOOL_DIR; "sync" inserts every entry during the request.
+JOURNAL_WRITER = {
+    'MODE': os.environ.get('JOURNAL_MODE', 'buffered'),
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 2.0,
+    'SPOOL_DIR': BASE_DIR / 'journal_spool',
+}
+
+# Request profiling (core/profiling.py): the metrics of /api/_metrics/
+# (Prometheus format; scraped with METRICS_TOKEN as a bearer token, or with
+# a superuser's JWT), and Server-Timing headers with SERVER_TIMING=1, which
+# are sent to every client (development only). Views making more queries
+# than their budget (QUERY_BUDGETS by URL name, else QUERY_BUDGET) are
+# logged, and fail with QueryBudgetExceeded when QUERY_BUDGET_FAIL is set,
+# as in the test suite.
+PROFILING = {
+    'ENABLED': os.environ.get('PROFILING', '1').lower() not in ('0', 'false'),
+    'SERVER_TIMING': os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true'),
+    'METRICS_TOKEN': os.environ.get('METRICS_TOKEN', ''),
+    'QUERY_BUDGET': 10,
+    # Stock writes: locks, ledger (soldes, échéances), sequences and
+    # reservations, in a number of queries independent of the lines
+    'QUERY_BUDGETS': {
+        'stock_reception': 30,
+        'quick_order': 15,
+        'deliver_order': 40,
+        'commandeservice-detail': 30,
+        'lotproduit-list': 15,
+        'lotproduit-detail': 15,
+    },
+    'FAIL_ON_QUERY_BUDGET': os.environ.get('QUERY_BUDGET_FAIL', '').lower() in ('1', 'true'),
+}
+
+# Cache shared by every worker process. The default is a file cache next to
+# the database, which needs no server and works in the PyInstaller build;
+# CACHE_URL selects another backend:
+#   redis://host:6379/0        (requires the redis package)
+#   memcached://host:11211     (requires pymemcache)
+#   file:///path/to/dir
+#   locmem://                  (per process, for tests)
+# Keys are prefixed with CACHE_KEY_PREFIX and a digest of the database they
+# describe, so two installations (or a test run) sharing a cache never read
+# each other's stamps; bumping CACHE_VERSION drops every cached entry at once
+# (see core/cache.py for the key scheme).
+CACHE_URL = os.environ.get('CACHE_URL', '')
+CACHE_DATABASE = hashlib.sha1('|'.join(
+    str(DATABASES['default'].get(part) or '')
+    for part in ('ENGINE', 'HOST', 'PORT', 'NAME')
+).encode()).hexdigest()[:8]
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+        'KEY_PREFIX': f"{os.environ.get('CACHE_KEY_PREFIX', 'pharmacie')}-{CACHE_DATABASE}",
+        'VERSION': int(os.environ.get('CACHE_VERSION', '1')),
+    }
+}
+if CACHE_URL.startswith(('redis://', 'rediss://')):
+    CACHES['default'].update(
+        BACKEND='django.core.cache.backends.redis.RedisCache',
+        LOCATION=CACHE_URL,
+        OPTIONS={},
+    )
+elif CACHE_URL.startswith('memcached://'):
+    CACHES['default'].update(
+        BACKEND='django.core.cache.backends.memcached.PyMemcacheCache',
+        LOCATION=CACHE_URL.removeprefix('memcached://'),
+        OPTIONS={},
+    )
+elif CACHE_URL.startswith('file://'):
+    CACHES['default']['LOCATION'] = CACHE_URL.removeprefix('file://')
+elif CACHE_URL.startswith('locmem://') or sys.argv[1:2] == ['test']:
+    # manage.py test never touches the cache of the installation it runs in.
+    CACHES['default'].update(
+        BACKEND='django.core.cache.backends.locmem.LocMemCache',
+        LOCATION='pharmacie',
+    )
 
 
 # Password validation
@@ -15,37 +15,66 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from core.profiling import metrics_view
 from core.api_views import (
     current_user,
     produits_with_stock,
     quick_order,
     stock_reception,
     dashboard_kpis,
+    dashboard_valuation,
     deliver_order,
     journal_list,
     stock_list,
+    stock_alertes,
     dashboard_magasins_orders,
+    export_data,
+    produits_import,
+    lots_expiring,
 )
 
+if settings.ASYNC_VIEWS:
+    from core.async_views import (  # noqa: F811
+        dashboard_kpis,
+        journal_list,
+        produits_with_stock,
+        stock_list,
+    )
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
     path("api/user/me/", current_user, name="current_user"),
+    path("api/produits/import/", produits_import, name="produits_import"),
     path("api/produits-with-stock/", produits_with_stock, name="produits_with_stock"),
     path("api/commandes/livrer/", deliver_order, name="deliver_order"),
     path("api/commandes-rapides/", quick_order, name="quick_order"),
     path("api/stock/reception/", stock_reception, name="stock_reception"),
     path("api/dashboard/kpis/", dashboard_kpis, name="dashboard_kpis"),
+    path(
+        "api/dashboard/valuation/",
+        dashboard_valuation,
+        name="dashboard_valuation",
+    ),
     path(
         "api/dashboard/magasins-orders/",
         dashboard_magasins_orders,
         name="dashboard_magasins_orders",
     ),
+    path("api/lots/expiring/", lots_expiring, name="lots_expiring"),
     path("api/stock/", stock_list, name="stock_list"),
+    path("api/stock/alertes/", stock_alertes, name="stock_alertes"),
     path("api/journals/", journal_list, name="journal_list"),
+    path(
+        "api/exports/<str:dataset>.<str:extension>",
+        export_data,
+        name="export_data",
+    ),
+    path("api/_metrics/", metrics_view, name="metrics"),
     path("api/", include("core.api_urls")),
 ]
@@ -30,7 +30,7 @@ binaries = django_binaries + rest_binaries + jwt_binaries + cors_binaries
 datas += [
     ("pharmacie", "pharmacie"),
     ("core", "core"),
-    ("db.sqlite3", "."),
+    ("db.template.sqlite3", "."),
 ]
 
 
@@ -35,8 +35,7 @@ import rest_framework_simplejwt.authentication  # noqa: F401,E402
 
 def ensure_database_ready() -> None:
     """Apply migrations automatically when bundled SQLite DB is empty/outdated."""
-    db_engine = connection.settings_dict.get("ENGINE", "")
-    if db_engine != "django.db.backends.sqlite3":
+    if connection.vendor != "sqlite":
         return
 
     try:
@@ -54,6 +53,11 @@ def ensure_database_ready() -> None:
     print("[startup] Database schema not initialized. Running migrations...")
     call_command("migrate", interactive=False, run_syncdb=True, verbosity=1)
 
+    # Entries cached for a previous database must not leak into the new one
+    from django.core.cache import cache
+
+    cache.clear()
+
 
 def should_prepare_database(argv: list[str]) -> bool:
     if len(argv) == 1:
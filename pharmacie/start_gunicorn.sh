@@ -9,4 +9,5 @@ if [ -d "../venv" ]; then
 fi
 
 # Run gunicorn
-exec gunicorn --config gunicorn.conf.py pharmacie.wsgi:application
+# SERVER_PROFILE=async serves pharmacie.asgi with uvicorn workers (see gunicorn.conf.py)
+exec gunicorn --config gunicorn.conf.py